@@ -0,0 +1,141 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import typing
+
+from common_dpu import logger
+
+
+# ioctl(FICLONE) from <linux/fs.h>, to reflink a file (btrfs, xfs).
+_FICLONE = 0x40049409
+
+
+def _reflink_or_copy(src: str, fdst: typing.BinaryIO) -> None:
+    with open(src, "rb") as fsrc:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(fsrc, fdst)
+
+
+class ArtifactCache:
+    """
+    A content-addressed store for the files that pxeboot serves via TFTP and
+    HTTP. Each file is stored once, under its SHA-256, and staged into the
+    served directories as hard link (or reflink, or copy as last resort).
+
+    The stored files are read-only. Never write to a staged file, stage a
+    new one instead. Beyond "keep_bytes", the least recently used files are
+    deleted when the cache is opened.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        keep_bytes: int = 1024 * 1024 * 1024,
+    ) -> None:
+        self.directory = directory
+        self.keep_bytes = keep_bytes
+        self._objects = f"{directory}/objects"
+        os.makedirs(self._objects, exist_ok=True)
+        self.cleanup()
+
+    def __repr__(self) -> str:
+        return f"ArtifactCache({self.directory!r})"
+
+    def path(self, digest: str) -> str:
+        return f"{self._objects}/{digest[:2]}/{digest}"
+
+    def _put(
+        self, digest: str, write: typing.Callable[[typing.BinaryIO], typing.Any]
+    ) -> str:
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return digest
+
+    def put_bytes(self, data: bytes) -> str:
+        return self._put(hashlib.sha256(data).hexdigest(), lambda f: f.write(data))
+
+    def put_file(self, filename: str) -> str:
+        h = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        return self._put(digest, lambda f: _reflink_or_copy(filename, f))
+
+    def stage(self, digest: str, dest: str) -> None:
+        # Make "dest" have the content of "digest". An existing file is
+        # replaced atomically. If "dest" is already a link to the object,
+        # this does nothing.
+        src = self.path(digest)
+        try:
+            if os.path.samefile(src, dest):
+                return
+        except FileNotFoundError:
+            pass
+        os.utime(src)
+        tmp = f"{os.path.dirname(dest) or '.'}/.{os.path.basename(dest)}.{os.getpid()}.tmp"
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(src, tmp)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            # Different file systems, like the container's "/www" and the
+            # cache on the host.
+            with open(tmp, "wb") as f:
+                _reflink_or_copy(src, f)
+            os.chmod(tmp, 0o444)
+        os.replace(tmp, dest)
+
+    def cleanup(self) -> None:
+        # Delete the least recently used objects beyond "keep_bytes".
+        objects = []
+        for dirpath, _, filenames in os.walk(self._objects):
+            for name in filenames:
+                path = f"{dirpath}/{name}"
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                objects.append((st.st_mtime, st.st_size, path, name))
+        objects.sort(reverse=True)
+        now = time.time()
+        total = 0
+        for mtime, size, path, name in objects:
+            if name.startswith(".tmp."):
+                # Left over by a crash, unless another process writes it
+                # right now.
+                if mtime > now - 3600:
+                    continue
+            else:
+                total += size
+                if total <= self.keep_bytes:
+                    continue
+            logger.info(f"artifact-cache: delete {path!r}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
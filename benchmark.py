@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import dataclasses
+import os
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+from typing import Optional
+
+from ktoolbox import common
+
+import common_dpu
+import console_broker
+import dpu_simulator
+import fwupdate
+import pxeboot
+import reset
+
+from common_dpu import logger
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class StageResult:
+    name: str
+    seconds: float
+    keys: int
+    bytes_read: int
+
+
+class Benchmark:
+    def __init__(self, sim: dpu_simulator.DpuSimulator) -> None:
+        self.sim = sim
+        self.results: list[StageResult] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> typing.Iterator[None]:
+        keys = self.sim.keys_received
+        bytes_sent = self.sim.bytes_sent
+        logger.info(f"benchmark: start stage {name!r}")
+        time_start = time.monotonic()
+        yield
+        result = StageResult(
+            name=name,
+            seconds=time.monotonic() - time_start,
+            keys=self.sim.keys_received - keys,
+            bytes_read=self.sim.bytes_sent - bytes_sent,
+        )
+        logger.info(f"benchmark: stage {name!r} took {result.seconds:.2f}s")
+        self.results.append(result)
+
+
+def bench_pxeboot(bench: Benchmark, host_path: str) -> None:
+    ctx = pxeboot.RunContext(cfg=pxeboot.Config(host_path=host_path))
+    with ctx.serial_open():
+        with bench.stage("pxeboot-reset-and-enter-boot-menu"):
+            pxeboot.uefi_reset_and_enter_boot_menu(ctx)
+        with bench.stage("pxeboot-detect-macs"):
+            dpu_macs = pxeboot.uefi_boot_menu_process(ctx)
+        with bench.stage("pxeboot-select-boot-entry"):
+            pxeboot.uefi_boot_menu_process(ctx, select_boot=dpu_macs[max(dpu_macs)])
+    if bench.sim.booted is None or not bench.sim.booted.startswith("UEFI PXEv4"):
+        raise RuntimeError(f"Simulated DPU did not PXE boot (got {bench.sim.booted!r})")
+
+
+def bench_reset(bench: Benchmark, host_path: str) -> None:
+    with bench.stage("reset"):
+        reset.reset()
+
+
+def bench_fwupdate(bench: Benchmark, host_path: str) -> None:
+    with bench.stage("fwupdate-reset"):
+        reset.reset()
+    with bench.stage("fwupdate-flash"):
+        fwupdate.firmware_update("/tmp/fwupdate.img", "secondary")
+    if bench.sim.flashed.get(2) != "fwupdate.img":
+        raise RuntimeError(f"Simulated DPU was not flashed (got {bench.sim.flashed})")
+
+
+BENCHMARKS: dict[str, typing.Callable[[Benchmark, str], None]] = {
+    "reset": bench_reset,
+    "pxeboot": bench_pxeboot,
+    "fwupdate": bench_fwupdate,
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Measure the serial console choreography of reset.py, pxeboot.py and fwupdate.py against the DPU simulator.\n\n"
+        "This reports the wall-clock time per stage. The simulated firmware answers quickly, so the numbers mostly show the time that the tools spend waiting.",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "benchmark",
+        nargs="*",
+        help=f"The benchmarks to run. Defaults to all ({', '.join(BENCHMARKS)}).",
+    )
+    parser.add_argument(
+        "--json",
+        type=str,
+        default=None,
+        help="Write the results as JSON to this file.",
+    )
+    parser.add_argument(
+        "--budget",
+        action="append",
+        default=[],
+        help='A "STAGE=SECONDS" limit. If a stage takes longer, the command fails. Can be specified multiple times.',
+    )
+    parser.add_argument(
+        "--uart-shell",
+        action="store_true",
+        help='Simulate the "uart:~$" shell on the MCU console instead of the SCP menu.',
+    )
+    parser.add_argument(
+        "--console-broker",
+        action="store_true",
+        help="Run the tools via console_broker.py instead of opening the serial ports directly.",
+    )
+    args = parser.parse_args()
+
+    budgets: dict[str, float] = {}
+    for budget in args.budget:
+        name, _, seconds = budget.partition("=")
+        try:
+            budgets[name] = float(seconds)
+        except ValueError:
+            parser.error(f"Invalid --budget {budget!r}. Must be STAGE=SECONDS")
+    args.budget = budgets
+
+    for name in args.benchmark:
+        if name not in BENCHMARKS:
+            parser.error(f"Invalid benchmark {name!r}. Choose from {list(BENCHMARKS)}")
+    args.benchmark = args.benchmark or list(BENCHMARKS)
+    return args
+
+
+@contextlib.contextmanager
+def run_console_broker(sim: dpu_simulator.DpuSimulator) -> typing.Iterator[None]:
+    broker = console_broker.Broker()
+    broker.add(sim.console_path)
+    broker.add(sim.mcu_path)
+    stop = threading.Event()
+    th = threading.Thread(target=broker.run, kwargs={"until": stop.is_set})
+    th.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        th.join()
+        broker.close()
+
+
+def print_results(results: list[StageResult]) -> None:
+    width = max([len("stage"), *(len(r.name) for r in results)])
+    print(f"{'stage':<{width}}  {'seconds':>8}  {'keys':>5}  {'bytes':>7}")
+    for r in results:
+        print(f"{r.name:<{width}}  {r.seconds:8.2f}  {r.keys:5}  {r.bytes_read:7}")
+    print(f"{'total':<{width}}  {sum(r.seconds for r in results):8.2f}")
+
+
+def main() -> None:
+    args = parse_args()
+
+    sim_cfg = dpu_simulator.SimConfig(scp_menu=not args.uart_shell)
+    with dpu_simulator.DpuSimulator(sim_cfg) as sim:
+        with tempfile.TemporaryDirectory(prefix="marvell-tools-bench-") as host_path:
+            os.makedirs(f"{host_path}/tmp")
+
+            # The tools look up the serial ports at the time of use.
+            common_dpu.TTYUSB0 = sim.console_path
+            common_dpu.TTYUSB1 = sim.mcu_path
+            common_dpu.CONSOLE_BROKER_DIR = f"{host_path}/run"
+
+            with contextlib.ExitStack() as stack:
+                if args.console_broker:
+                    stack.enter_context(run_console_broker(sim))
+
+                bench = Benchmark(sim)
+                for name in args.benchmark:
+                    BENCHMARKS[name](bench, host_path)
+
+    print_results(bench.results)
+
+    if args.json:
+        common.json_dump(
+            {
+                "results": [dataclasses.asdict(r) for r in bench.results],
+                "total": sum(r.seconds for r in bench.results),
+            },
+            args.json,
+        )
+
+    over_budget: list[str] = []
+    for r in bench.results:
+        limit: Optional[float] = args.budget.get(r.name)
+        if limit is not None and r.seconds > limit:
+            over_budget.append(f"{r.name} ({r.seconds:.2f}s > {limit:.2f}s)")
+    if over_budget:
+        logger.error(f"benchmark: stages over budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    common_dpu.run_main(main)
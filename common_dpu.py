@@ -1,7 +1,17 @@
+import abc
+import contextlib
+import dataclasses
+import json
 import logging
 import os
+import re
 import shlex
-import shutil
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
 import typing
 
 from collections.abc import Iterable
@@ -32,6 +42,70 @@ KEY_CTRL_M = "\r"
 TTYUSB0 = "/dev/ttyUSB0"
 TTYUSB1 = "/dev/ttyUSB1"
 
+# The serial ports by the USB port they are plugged into (see
+# serial_usb_adapters()).
+SERIAL_BY_PATH = "/dev/serial/by-path"
+
+# console_broker.py listens here on one Unix socket per serial port.
+CONSOLE_BROKER_DIR = "/run/marvell-tools"
+
+# The number of DPUs that can be attached to one host (see dpu_get()).
+DPU_MAX = 32
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class Dpu:
+    # One of the DPUs attached to the host, with its own pair of serial ports
+    # and its own address in "dpu_subnet".
+    index: int
+    # The console (UEFI, u-boot and Linux).
+    tty0: str
+    # The SCP console, for resetting.
+    tty1: str
+    ip4addr: str
+
+    @property
+    def name(self) -> str:
+        return f"dpu{self.index}"
+
+    @property
+    def ip4addrnet(self) -> str:
+        return f"{self.ip4addr}/24"
+
+
+def dpu_get(index: int) -> Dpu:
+    # DPU 0 is the one of a host with only one DPU, on TTYUSB0 and TTYUSB1.
+    # The other DPUs use the other USB serial adapters, in the order of the
+    # USB ports they are plugged into. Unlike the numbering of
+    # "/dev/ttyUSB*", that does not change with the order in which the
+    # adapters are detected. Only if the adapters cannot be identified, DPU
+    # "index" uses /dev/ttyUSB{2*index} and /dev/ttyUSB{2*index+1}. DPU
+    # "index" gets the address 172.131.100.{100+index}.
+    if index < 0 or index >= DPU_MAX:
+        raise ValueError(f"Invalid DPU index {index}")
+    if index == 0:
+        return Dpu(index=0, tty0=TTYUSB0, tty1=TTYUSB1, ip4addr=dpu_ip4addr)
+    adapters = serial_usb_adapters()
+    if not adapters:
+        tty0 = f"/dev/ttyUSB{2 * index}"
+        tty1 = f"/dev/ttyUSB{2 * index + 1}"
+    else:
+        usb_id0 = serial_usb_id(TTYUSB0)
+        others = [
+            ttys for usb_id, ttys in adapters if usb_id != usb_id0 and len(ttys) >= 2
+        ]
+        if index > len(others):
+            raise ValueError(
+                f"No USB serial adapter for DPU {index}. Found {len(others)} besides the one of {TTYUSB0}"
+            )
+        tty0, tty1 = others[index - 1][:2]
+    return Dpu(
+        index=index,
+        tty0=tty0,
+        tty1=tty1,
+        ip4addr=f"172.131.100.{100 + index}",
+    )
+
 
 global_cleanup = common.CleanupList(common.thread_list_join_all)
 
@@ -39,6 +113,36 @@ logger = common.ExtendedLogger("marvell_toolbox")
 
 common.log_config_logger(logging.DEBUG, logger, "ktoolbox")
 
+_log_local = threading.local()
+
+
+class _LogPrefixFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        prefix = log_prefix_get()
+        if prefix is not None:
+            record.msg = f"{prefix}: {record.msg}"
+        return True
+
+
+logger.addFilter(_LogPrefixFilter())
+
+
+def log_prefix_get() -> Optional[str]:
+    prefix: Optional[str] = getattr(_log_local, "prefix", None)
+    return prefix
+
+
+@contextlib.contextmanager
+def log_prefix(prefix: str) -> typing.Iterator[None]:
+    # Prefix the messages, that this thread logs, with "prefix". With several
+    # DPUs, this tells which one a message is about.
+    old = log_prefix_get()
+    _log_local.prefix = prefix
+    try:
+        yield
+    finally:
+        _log_local.prefix = old
+
 
 def run_process(
     tag: str,
@@ -54,76 +158,181 @@ def run_process(
     )
 
 
+class Service(abc.ABC):
+    # A service (like the HTTP server) that runs in threads of this process,
+    # instead of as external process via run_process(). Start it with
+    # service_start().
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    @abc.abstractmethod
+    def start(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def stop(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def is_running(self) -> bool:
+        pass
+
+
+_services: list[Service] = []
+
+
+def service_start(service: Service) -> None:
+    logger.info(f"Starting service {service.name}")
+    service.start()
+    _services.append(service)
+
+    def _stop() -> None:
+        logger.info(f"Stopping service {service.name}")
+        service.stop()
+        _services.remove(service)
+
+    global_cleanup.add(_stop)
+
+
+def service_get(name: str) -> Optional[Service]:
+    # The running service "name" (started with service_start()), if any.
+    # provisiond.py keeps the services running between jobs.
+    for service in _services:
+        if service.name == name and service.is_running():
+            return service
+    return None
+
+
+# The threads of processes that we stopped on purpose, like dhcpd before it
+# is restarted with a new configuration.
+_retired_threads: set[common.FutureThread[host.Result]] = set()
+
+
 def check_services_running() -> None:
     for th in common.thread_list_get():
         assert isinstance(th, common.FutureThread)
-        if th.poll() is None:
+        if th.poll() is None or th in _retired_threads:
             continue
         logger.error_and_exit(
             f"Service {th.user_data} unexpectedly not running. Check logging output!!"
         )
+    for service in _services:
+        if service.is_running():
+            continue
+        logger.error_and_exit(
+            f"Service {service.name} unexpectedly not running. Check logging output!!"
+        )
+
+
+def _conf_delete_block(text: str, start_tag: str, end_tag: str) -> str:
+    # Delete the lines from the "# {start_tag}" line to the "# {end_tag}"
+    # line, inclusive.
+    return _conf_repeat_block(text, start_tag, end_tag, [])
+
+
+def _conf_repeat_block(
+    text: str,
+    start_tag: str,
+    end_tag: str,
+    replacements: Iterable[dict[str, str]],
+) -> str:
+    # Replace the lines from the "# {start_tag}" line to the "# {end_tag}"
+    # line with one copy per element of "replacements", where each
+    # "@__KEY__@" is replaced.
+    def _repeat(m: re.Match[str]) -> str:
+        blocks = []
+        for replacement in replacements:
+            block = m.group(0)
+            for key, value in replacement.items():
+                block = block.replace(f"@__{key}__@", value)
+            blocks.append(block)
+        return "".join(blocks)
+
+    return re.sub(
+        f"(?ms)^[ \\t]*#[ \\t]*{re.escape(start_tag)}[ \\t]*$.*?^[ \\t]*#[ \\t]*{re.escape(end_tag)}[ \\t]*(\\n|$)",
+        _repeat,
+        text,
+    )
+
+
+def dhcpd_conf_render(
+    template: str,
+    *,
+    pxe_filename: Optional[str] = None,
+    hosts: Iterable[tuple[str, str]] = (),
+    dhcp_restricted: bool = False,
+) -> str:
+    # "hosts" are the (MAC address, IP address) of the DPUs.
+    text = template
+    text = text.replace("@__PXE_FILENAME__@", pxe_filename or "")
+    text = text.replace(
+        "@__DHCP_RESTRICTED__@", common.bool_to_str(dhcp_restricted, format="yes")
+    )
+    text = _conf_repeat_block(
+        text,
+        "__HOST_DPU_HOST_START__",
+        "__HOST_DPU_HOST_END__",
+        [
+            {
+                "HOST_NAME": "dpu-host" if i == 0 else f"dpu-host-{i}",
+                "HARDWARE_ETHERNET": hardware_ethernet,
+                "FIXED_ADDRESS": fixed_address,
+            }
+            for i, (hardware_ethernet, fixed_address) in enumerate(hosts)
+        ],
+    )
+    if dhcp_restricted:
+        text = _conf_delete_block(
+            text, "__DHCP_UNRESTRICTED_START__", "__DHCP_UNRESTRICTED_END__"
+        )
+    else:
+        text = _conf_delete_block(
+            text, "__DHCP_RESTRICTED_START__", "__DHCP_RESTRICTED_END__"
+        )
+    return text
+
+
+# The configuration and thread of the dhcpd that we started.
+_dhcpd: Optional[tuple[str, common.FutureThread[host.Result]]] = None
 
 
 def run_dhcpd(
     *,
     dhcpd_conf: str,
     pxe_filename: Optional[str] = None,
-    hardware_ethernet: Optional[str] = None,
+    hosts: Iterable[tuple[str, str]] = (),
     dhcp_restricted: Optional[bool] = None,
 ) -> None:
+    global _dhcpd
 
+    hosts = list(hosts)
     if dhcp_restricted is None:
-        dhcp_restricted = hardware_ethernet is not None
+        dhcp_restricted = bool(hosts)
     else:
-        if hardware_ethernet is None and dhcp_restricted:
-            raise ValueError("dhcp_restricted requires a hardware_ethernet parameter")
+        if not hosts and dhcp_restricted:
+            raise ValueError("dhcp_restricted requires a hosts parameter")
 
     logger.info(f"Configuring DHCP using {dhcpd_conf} (restricted={dhcp_restricted})")
 
-    shutil.copy(
-        dhcpd_conf,
-        "/etc/dhcp/dhcpd.conf",
-    )
-
-    def _sed_repl(pattern: str, val: Optional[str]) -> str:
-        val_escaped = common.sed_escape_repl(val or "")
-        return f"s/{pattern}/{val_escaped}/g"
-
-    def _sed_delete(start_tag: str, end_tag: str) -> str:
-        start = common.sed_escape_repl(start_tag)
-        end = common.sed_escape_repl(end_tag)
-        return f"/^[[:space:]]*#[[:space:]]*{start}[[:space:]]*$/,/^[[:space:]]*#[[:space:]]*{end}[[:space:]]*$/d"
-
-    sed_args = []
-
-    sed_args.append(_sed_repl("@__PXE_FILENAME__@", pxe_filename))
-    sed_args.append(_sed_repl("@__HARDWARE_ETHERNET__@", hardware_ethernet))
-    sed_args.append(
-        _sed_repl(
-            "@__DHCP_RESTRICTED__@", common.bool_to_str(dhcp_restricted, format="yes")
+    with open(dhcpd_conf) as f:
+        conf = dhcpd_conf_render(
+            f.read(),
+            pxe_filename=pxe_filename,
+            hosts=hosts,
+            dhcp_restricted=dhcp_restricted,
         )
-    )
 
-    if hardware_ethernet is None:
-        sed_args.append(_sed_delete("__HOST_DPU_HOST_START__", "__HOST_DPU_HOST_END__"))
-
-    if dhcp_restricted:
-        sed_args.append(
-            _sed_delete("__DHCP_UNRESTRICTED_START__", "__DHCP_UNRESTRICTED_END__")
-        )
-    else:
-        sed_args.append(
-            _sed_delete("__DHCP_RESTRICTED_START__", "__DHCP_RESTRICTED_END__")
-        )
+    if _dhcpd is not None:
+        running_conf, th = _dhcpd
+        if th.poll() is None and running_conf == conf:
+            # dhcpd cannot reload its configuration. Only restart it, if the
+            # configuration changed.
+            logger.info("dhcpd already runs with this configuration")
+            return
+        _retired_threads.add(th)
 
-    host.local.run(
-        [
-            "sed",
-            "-i",
-            *[arg for cmd in sed_args for arg in ["-e", cmd]],
-            "/etc/dhcp/dhcpd.conf",
-        ]
-    )
+    text_write_atomic("/etc/dhcp/dhcpd.conf", conf, mode=0o644)
 
     host.local.run("killall dhcpd")
 
@@ -136,10 +345,11 @@ def run_dhcpd(
         "ip addr del 192.168.122.101/32 dev br-ex scope global label vip && ip addr add 192.168.122.101/32 dev br-ex scope global"
     )
 
-    run_process(
+    th = run_process(
         "dhcpd",
         "/usr/sbin/dhcpd -d -f -cf /etc/dhcp/dhcpd.conf -user dhcpd -group dhcpd",
     )
+    _dhcpd = (conf, th)
 
 
 cwd, basedir = common.path_basedir(__file__)
@@ -247,6 +457,272 @@ def ssh_read_pubkey(ssh_privkey_file: str) -> str:
     raise RuntimeError('failure to read SSH public key from "{ssh_pubkey_file}"')
 
 
+def cache_dir(host_path: str) -> str:
+    # Persistent state that we keep on the host between runs.
+    path = f"{host_path}/var/cache/marvell-tools"
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def log_dir(host_path: str) -> str:
+    path = f"{host_path}/var/log/marvell-tools"
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def json_read(filename: str) -> Optional[typing.Any]:
+    try:
+        with open(filename, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"failure to read {filename!r}: {e}")
+        return None
+
+
+def text_write_atomic(
+    filename: str,
+    text: str,
+    *,
+    mode: Optional[int] = None,
+) -> None:
+    # Write to a temporary file first. Concurrent readers either see the
+    # old or the new content.
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(filename),
+        prefix=f".{os.path.basename(filename)}.",
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def json_write_atomic(filename: str, data: typing.Any) -> None:
+    text_write_atomic(filename, json.dumps(data, indent=2) + "\n")
+
+
+def serial_usb_id(tty: str) -> Optional[str]:
+    # Find the USB serial adapter for "tty" in sysfs and return an ID built
+    # from its vendor, product and serial number. The ID stays the same,
+    # even if the tty gets a different name after reboot.
+    path = f"/sys/class/tty/{os.path.basename(tty)}/device"
+    try:
+        path = os.path.realpath(path)
+    except OSError:
+        return None
+    while path.startswith("/sys/devices/"):
+        try:
+            with open(f"{path}/serial") as f:
+                serial = f.read().strip()
+            with open(f"{path}/idVendor") as f:
+                vendor = f.read().strip()
+            with open(f"{path}/idProduct") as f:
+                product = f.read().strip()
+        except OSError:
+            path = os.path.dirname(path)
+            continue
+        if not serial:
+            return None
+        return f"usb:{vendor}:{product}:{serial}"
+    return None
+
+
+def _natural_sort_key(s: str) -> list[typing.Any]:
+    return [int(x) if x.isdigit() else x for x in re.split("([0-9]+)", s)]
+
+
+def serial_usb_adapters() -> list[tuple[str, list[str]]]:
+    # The USB serial adapters of the host, by the USB port they are plugged
+    # into, as their serial_usb_id() and their ttys (in the order of their
+    # interfaces).
+    try:
+        names = os.listdir(SERIAL_BY_PATH)
+    except OSError:
+        return []
+    adapters: dict[str, list[str]] = {}
+    for name in sorted(names, key=_natural_sort_key):
+        tty = os.path.realpath(f"{SERIAL_BY_PATH}/{name}")
+        usb_id = serial_usb_id(tty)
+        if usb_id is None:
+            continue
+        ttys = adapters.setdefault(usb_id, [])
+        if tty not in ttys:
+            ttys.append(tty)
+    return list(adapters.items())
+
+
+def console_broker_socket(tty: str) -> str:
+    name = tty.strip("/").replace("/", "-")
+    return f"{CONSOLE_BROKER_DIR}/console-{name}.sock"
+
+
+class ConsoleBrokerConnection:
+    # The control connection to console_broker.py. Messages are JSON objects,
+    # one per line.
+
+    def __init__(self, tty: str) -> None:
+        self.tty = tty
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(console_broker_socket(tty))
+        except BaseException:
+            self.sock.close()
+            raise
+        self._buffer = b""
+        # Whether we hold the keyboard, as last reported by the broker.
+        self.keyboard = False
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def send(self, msg: dict[str, typing.Any]) -> None:
+        self.sock.sendall(json.dumps(msg).encode() + b"\n")
+
+    def recv(self, timeout: float) -> Optional[dict[str, typing.Any]]:
+        end = time.monotonic() + timeout
+        while b"\n" not in self._buffer:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return None
+            r, _, _ = select.select([self.sock], [], [], remaining)
+            if not r:
+                return None
+            data = self.sock.recv(65536)
+            if not data:
+                raise RuntimeError(f"console broker for {self.tty} closed connection")
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        msg: dict[str, typing.Any] = json.loads(line)
+        if "error" in msg:
+            raise RuntimeError(f"console broker for {self.tty}: {msg['error']}")
+        if "keyboard" in msg:
+            self.keyboard = msg["keyboard"]
+        return msg
+
+    def request(
+        self, msg: dict[str, typing.Any], timeout: float = 5.0
+    ) -> dict[str, typing.Any]:
+        self.send(msg)
+        while True:
+            reply = self.recv(timeout)
+            if reply is None:
+                raise RuntimeError(
+                    f"console broker for {self.tty} did not reply to {msg['op']!r}"
+                )
+            if "event" not in reply:
+                return reply
+
+    def keyboard_wait(self, timeout: float) -> bool:
+        # Wait until the broker tells us that we hold the keyboard.
+        end = time.monotonic() + timeout
+        while not self.keyboard:
+            if self.recv(max(0.0, end - time.monotonic())) is None:
+                return False
+        return True
+
+
+class ConsoleBrokerSerial(common.Serial):
+    """
+    A serial console shared through console_broker.py. The broker gives us a
+    pty of our own, which we use like the real tty. Keys that we send only
+    reach the DPU while we hold the keyboard.
+    """
+
+    def __init__(
+        self,
+        conn: ConsoleBrokerConnection,
+        pty: str,
+        *,
+        log_stream: Optional[typing.BinaryIO] = None,
+        own_log_stream: bool = False,
+    ) -> None:
+        super().__init__(pty, log_stream=log_stream, own_log_stream=own_log_stream)
+        self.tty = conn.tty
+        self.conn = conn
+
+    def keyboard_release(self) -> None:
+        logger.info(f"serial[{self.port}]: release keyboard of {self.tty}")
+        self.conn.request({"op": "keyboard", "mode": "release"})
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self.conn.close()
+
+
+def console_broker_offset(tty: str) -> Optional[int]:
+    # The current position in the output of "tty", if console_broker.py
+    # owns it. Pass it to serial_open(since=) to not miss the output that
+    # comes in between.
+    try:
+        conn = ConsoleBrokerConnection(tty)
+    except OSError:
+        return None
+    try:
+        offset: int = conn.request({"op": "status"})["offset"]
+        return offset
+    finally:
+        conn.close()
+
+
+def serial_open(
+    tty: str,
+    *,
+    log_stream: Optional[typing.BinaryIO] = None,
+    own_log_stream: bool = False,
+    since: Optional[int] = None,
+    keyboard_timeout: float = 60.0,
+) -> common.Serial:
+    """
+    Open the serial console "tty". If console_broker.py is running, attach to
+    it and take the keyboard. Otherwise, open the tty directly.
+    """
+    try:
+        conn = ConsoleBrokerConnection(tty)
+    except OSError:
+        return common.Serial(tty, log_stream=log_stream, own_log_stream=own_log_stream)
+
+    try:
+        reply = conn.request(
+            {
+                "op": "attach",
+                "name": f"{os.path.basename(sys.argv[0])}[{os.getpid()}]",
+                "keyboard": "wait",
+                "since": since,
+            }
+        )
+        logger.info(f"serial[{tty}]: attached to console broker on {reply['pty']}")
+        ser = ConsoleBrokerSerial(
+            conn,
+            reply["pty"],
+            log_stream=log_stream,
+            own_log_stream=own_log_stream,
+        )
+    except BaseException:
+        conn.close()
+        raise
+
+    try:
+        # Only now that the pty is open, the broker starts sending data.
+        conn.request({"op": "start"})
+        if not conn.keyboard_wait(keyboard_timeout):
+            raise RuntimeError(
+                f"serial[{tty}]: keyboard is held by {reply['holder']!r} for more than {keyboard_timeout} seconds"
+            )
+    except BaseException:
+        ser.close()
+        raise
+    return ser
+
+
 DEFAULT_RHEL_ISO = "9.6"
 
 
@@ -268,25 +744,12 @@ def check_files(
     return True
 
 
-def mount_iso(
-    iso_path: str,
-    *,
-    mount_path: str,
-) -> bool:
-    os.makedirs(mount_path, exist_ok=True)
-    host.local.run(["umount", mount_path])
-    ret = host.local.run(
-        ["mount", "-o", "loop", iso_path, mount_path],
-        log_level_fail=logging.WARN,
-    )
-    return ret.success
-
-
 def create_iso_file(
     iso: str,
     chroot_path: str,
     *,
     force: bool = False,
+    resolver_ttl: Optional[float] = None,
 ) -> tuple[str, Optional[str], bool]:
 
     cached_http_file = False
@@ -302,16 +765,27 @@ def create_iso_file(
             # This is the default.
             rhel_version = DEFAULT_RHEL_ISO
         url = f"https://download.eng.brq.redhat.com/rhel-9/nightly/RHEL-9/latest-RHEL-{rhel_version}/compose/BaseOS/aarch64/iso/"
-        res = host.local.run(
-            f'curl -L -k -s {shlex.quote(url)} | sed -n \'s/.*href="\\(RHEL-[^"]\\+-dvd1.iso\\)".*/\\1/p\' | head -n1',
-            log_level_fail=logging.ERROR,
-        )
-        url_part = res.out.strip()
-        if not res.success or not url_part:
-            raise RuntimeError(
-                f'failure to detect URL for RHEL ISO image "{iso0}" at URL "{url}"'
+
+        def _fetch() -> str:
+            res = host.local.run(
+                f'curl -L -k -s {shlex.quote(url)} | sed -n \'s/.*href="\\(RHEL-[^"]\\+-dvd1.iso\\)".*/\\1/p\' | head -n1',
+                log_level_fail=logging.ERROR,
             )
-        iso1 = f"{url}{url_part}"
+            url_part = res.out.strip()
+            if not res.success or not url_part:
+                raise RuntimeError(
+                    f'failure to detect URL for RHEL ISO image "{iso0}" at URL "{url}"'
+                )
+            return f"{url}{url_part}"
+
+        import resolver_cache
+
+        # The latest compose changes at most daily. Back-to-back runs reuse
+        # the result.
+        resolver = resolver_cache.ResolverCache(
+            resolver_cache.cache_filename(chroot_path)
+        )
+        iso1 = resolver.resolve(f"rhel-iso:{rhel_version}", _fetch, ttl=resolver_ttl)
     else:
         # Not a "rhel:" URL. This is either a HTTP/HTTPS URL or a pathname.
         # Pass on to iso1.
@@ -322,6 +796,9 @@ def create_iso_file(
     if iso1.startswith("http://") or iso1.startswith("https://"):
         import hashlib
 
+        import downloader
+        import iso_store
+
         filename = iso1[(iso1.rfind("/") + 1) :]
 
         filename_name, filename_ext = os.path.splitext(filename)
@@ -329,18 +806,19 @@ def create_iso_file(
 
         filename = f"{filename_name}.{filename_digest}{filename_ext}"
 
-        iso2 = os.path.join(chroot_path, f"root/rhel-iso-{filename}")
-        if force or not os.path.exists(iso2):
-            iso2_tmp = f"{iso2}.tmp"
-            ret = host.local.run(
-                f"curl -L -k -o {shlex.quote(iso2_tmp)} {shlex.quote(iso1)} && mv {shlex.quote(iso2_tmp)} {shlex.quote(iso2)}",
-                log_level_fail=logging.ERROR,
+        # The image is kept in the store. Images that were not used for a
+        # while are deleted, when the store exceeds its budget. Older
+        # versions downloaded to "/root/rhel-iso-*".
+        store = iso_store.IsoStore(iso_store.store_dir(chroot_path))
+        try:
+            iso2, downloaded = store.fetch(
+                iso1,
+                force=force,
+                adopt=os.path.join(chroot_path, f"root/rhel-iso-{filename}"),
             )
-            if not ret.success:
-                raise RuntimeError(
-                    f'failure to download RHEL ISO image "{iso1}" to "{iso2}"'
-                )
-        else:
+        except (OSError, downloader.DownloadError) as e:
+            raise RuntimeError(f'failure to download RHEL ISO image "{iso1}": {e}')
+        if not downloaded:
             cached_http_file = True
             iso_url = iso1
     else:
@@ -0,0 +1,596 @@
+#!/usr/bin/env python3
+
+import argparse
+import errno
+import json
+import os
+import pty
+import selectors
+import socket
+import subprocess
+import sys
+import time
+import tty as ttymod
+import typing
+
+from typing import Optional
+
+import serial
+
+import common_dpu
+import serial_capture
+
+from common_dpu import logger
+
+
+DEFAULT_RING_SIZE = 4 * 1024 * 1024
+
+# After "attach" started the command (minicom), wait a bit before sending it
+# the buffered output. Programs tend to flush the input of the tty when they
+# open it.
+ATTACH_START_DELAY = 0.5
+
+# The replies and events that a client did not read yet. A client that lets
+# more pile up is disconnected, it must not stall the other consoles.
+CLIENT_SEND_BUFFER = 64 * 1024
+
+
+class Client:
+    def __init__(self, console: "Console", sock: socket.socket) -> None:
+        self.console = console
+        self.sock = sock
+        self.name = f"client[{sock.fileno()}]"
+        self.rbuf = b""
+        self.wbuf = bytearray()
+        self.disconnected = False
+        self.master_fd: Optional[int] = None
+        self.slave_fd: Optional[int] = None
+        self.pty: Optional[str] = None
+        self.start_offset = 0
+        self.streaming = False
+        self.pending = bytearray()
+        self.dropped = 0
+        self.warned_keyboard = False
+
+    def send(self, msg: dict[str, typing.Any]) -> None:
+        # The socket is non-blocking. What does not fit is sent once it is
+        # writable again (see sock_flush()).
+        if self.disconnected:
+            return
+        self.wbuf += json.dumps(msg).encode() + b"\n"
+        if len(self.wbuf) > CLIENT_SEND_BUFFER:
+            logger.warning(
+                f"console[{self.console.tty}]: {self.name}: not reading, disconnect"
+            )
+            self.disconnect()
+            return
+        self.sock_flush()
+
+    def sock_flush(self) -> None:
+        while self.wbuf:
+            try:
+                n = self.sock.send(self.wbuf)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logger.debug(
+                    f"console[{self.console.tty}]: {self.name}: send failed: {e}"
+                )
+                self.disconnect()
+                return
+            del self.wbuf[:n]
+        self.console.broker.want_write(self.sock.fileno(), bool(self.wbuf))
+
+    def disconnect(self) -> None:
+        # The selector loop sees the end of the stream on the next round, and
+        # removes the client (see Console._on_client()).
+        self.disconnected = True
+        self.wbuf.clear()
+        self.console.broker.want_write(self.sock.fileno(), False)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def pty_create(self) -> str:
+        master_fd, slave_fd = pty.openpty()
+        # No echo and no line editing. Otherwise, the output that we write to
+        # the pty would be echoed back to us as input.
+        ttymod.setraw(slave_fd)
+        os.set_blocking(master_fd, False)
+        self.master_fd = master_fd
+        # We keep the slave side open ourselves. The pty stays usable even
+        # while the client has it closed.
+        self.slave_fd = slave_fd
+        self.pty = os.ttyname(slave_fd)
+        return self.pty
+
+    def queue(self, data: bytes) -> None:
+        if not self.streaming or self.master_fd is None:
+            return
+        self.pending += data
+        excess = len(self.pending) - self.console.ring_size
+        if excess > 0:
+            # The client does not keep up. Drop the oldest data.
+            del self.pending[:excess]
+            self.dropped += excess
+        self.flush()
+
+    def flush(self) -> None:
+        assert self.master_fd is not None
+        while self.pending:
+            try:
+                n = os.write(self.master_fd, self.pending)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logger.debug(
+                    f"console[{self.console.tty}]: {self.name}: write failed: {e}"
+                )
+                self.pending.clear()
+                break
+            del self.pending[:n]
+        self.console.broker.want_write(self.master_fd, bool(self.pending))
+
+    def close(self) -> None:
+        if self.master_fd is not None:
+            self.console.broker.unregister(self.master_fd)
+            os.close(self.master_fd)
+            self.master_fd = None
+        if self.slave_fd is not None:
+            os.close(self.slave_fd)
+            self.slave_fd = None
+        self.console.broker.unregister(self.sock.fileno())
+        self.sock.close()
+
+
+class Console:
+    """
+    Owns one serial port. All output goes to a ring buffer and to the ptys of
+    the attached clients. At most one client at a time holds the keyboard,
+    input from the others is dropped.
+    """
+
+    def __init__(
+        self,
+        broker: "Broker",
+        tty: str,
+        ring_size: int,
+        capture_dir: Optional[str],
+    ) -> None:
+        self.broker = broker
+        self.tty = tty
+        self.ring_size = ring_size
+        self.capture: Optional[serial_capture.SerialCapture] = None
+        if capture_dir is not None:
+            name = tty.strip("/").replace("/", "-")
+            self.capture = serial_capture.SerialCapture(capture_dir, f"console-{name}")
+        self.ring = bytearray()
+        # The total number of bytes read from the tty. The ring buffer holds
+        # the bytes from "offset - len(ring)" up to "offset".
+        self.offset = 0
+        self.ser: Optional[serial.Serial] = None
+        self.clients: list[Client] = []
+        self.keyboard: Optional[Client] = None
+        self.keyboard_queue: list[Client] = []
+        self.socket_path = common_dpu.console_broker_socket(tty)
+        self.listener = self._listen()
+
+    def _listen(self) -> socket.socket:
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                s.connect(self.socket_path)
+            except OSError:
+                # Stale socket from an earlier run.
+                os.unlink(self.socket_path)
+            else:
+                raise RuntimeError(
+                    f"console broker for {self.tty} already running on {self.socket_path}"
+                )
+            finally:
+                s.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o660)
+        listener.listen()
+        listener.setblocking(False)
+        logger.info(f"console[{self.tty}]: listening on {self.socket_path}")
+        return listener
+
+    def open(self) -> bool:
+        if self.ser is not None:
+            return True
+        try:
+            # Exclusive, so that tools which don't know about the broker fail
+            # instead of stealing the output.
+            self.ser = serial.Serial(
+                self.tty, baudrate=115200, timeout=0, exclusive=True
+            )
+        except (OSError, serial.SerialException) as e:
+            logger.debug(f"console[{self.tty}]: cannot open: {e}")
+            return False
+        logger.info(f"console[{self.tty}]: opened")
+        self.broker.register(self.ser.fileno(), selectors.EVENT_READ, self._on_tty)
+        return True
+
+    def _tty_close(self) -> None:
+        assert self.ser is not None
+        self.broker.unregister(self.ser.fileno())
+        self.ser.close()
+        self.ser = None
+
+    def _on_tty(self, mask: int) -> None:
+        assert self.ser is not None
+        try:
+            data = self.ser.read(65536)
+        except (OSError, serial.SerialException) as e:
+            logger.warning(f"console[{self.tty}]: read failed, reopening: {e}")
+            self._tty_close()
+            return
+        if not data:
+            return
+        self.ring += data
+        excess = len(self.ring) - self.ring_size
+        if excess > 0:
+            del self.ring[:excess]
+        self.offset += len(data)
+        if self.capture is not None:
+            self.capture.write(data)
+        for client in self.clients:
+            client.queue(data)
+
+    def on_accept(self, mask: int) -> None:
+        sock, _ = self.listener.accept()
+        sock.setblocking(False)
+        client = Client(self, sock)
+        self.clients.append(client)
+        self.broker.register(
+            sock.fileno(), selectors.EVENT_READ, lambda m: self._on_client(client, m)
+        )
+
+    def _on_client(self, client: Client, mask: int) -> None:
+        if mask & selectors.EVENT_WRITE:
+            client.sock_flush()
+        if not (mask & selectors.EVENT_READ):
+            return
+        try:
+            data = client.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._client_remove(client)
+            return
+        client.rbuf += data
+        while b"\n" in client.rbuf and not client.disconnected:
+            line, client.rbuf = client.rbuf.split(b"\n", 1)
+            try:
+                msg = json.loads(line)
+                reply = self._handle(client, msg)
+            except Exception as e:
+                reply = {"error": str(e)}
+            client.send(reply)
+
+    def _handle(
+        self, client: Client, msg: dict[str, typing.Any]
+    ) -> dict[str, typing.Any]:
+        op = msg.get("op")
+        if op == "status":
+            return {
+                "tty": self.tty,
+                "connected": self.ser is not None,
+                "offset": self.offset,
+                "ring": len(self.ring),
+                "holder": self.keyboard.name if self.keyboard else None,
+                "clients": [c.name for c in self.clients if c.pty is not None],
+            }
+        if op == "attach":
+            if client.pty is not None:
+                raise ValueError("already attached")
+            client.name = str(msg.get("name") or client.name)
+            ring_start = self.offset - len(self.ring)
+            since = msg.get("since")
+            if since is None:
+                since = self.offset - int(msg.get("replay") or 0)
+            client.start_offset = min(max(int(since), ring_start), self.offset)
+            pty_path = client.pty_create()
+            assert client.master_fd is not None
+            self.broker.register(
+                client.master_fd,
+                selectors.EVENT_READ,
+                lambda m: self._on_client_pty(client, m),
+            )
+            self._keyboard_request(client, msg.get("keyboard", "none"), notify=False)
+            logger.info(
+                f"console[{self.tty}]: {client.name} attached on {pty_path} (keyboard {self.keyboard is client})"
+            )
+            return {
+                "pty": pty_path,
+                "offset": client.start_offset,
+                "keyboard": self.keyboard is client,
+                "holder": self.keyboard.name if self.keyboard else None,
+            }
+        if op == "start":
+            if client.pty is None:
+                raise ValueError("not attached")
+            if not client.streaming:
+                ring_start = self.offset - len(self.ring)
+                # The ring may have rotated since "attach".
+                client.start_offset = max(client.start_offset, ring_start)
+                client.streaming = True
+                client.queue(bytes(self.ring[client.start_offset - ring_start :]))
+            return {"ok": True}
+        if op == "keyboard":
+            if client.pty is None:
+                raise ValueError("not attached")
+            self._keyboard_request(client, str(msg.get("mode")), notify=False)
+            return {"keyboard": self.keyboard is client}
+        raise ValueError(f"invalid op {op!r}")
+
+    def _keyboard_request(self, client: Client, mode: str, *, notify: bool) -> None:
+        if mode == "none":
+            return
+        if mode == "release":
+            self._keyboard_release(client)
+            return
+        if mode == "wait":
+            if self.keyboard is None:
+                self._keyboard_grant(client, notify=notify)
+            elif self.keyboard is not client and client not in self.keyboard_queue:
+                self.keyboard_queue.append(client)
+            return
+        if mode == "take":
+            if self.keyboard is not None and self.keyboard is not client:
+                previous = self.keyboard
+                self.keyboard_queue.insert(0, previous)
+                logger.info(
+                    f"console[{self.tty}]: {client.name} takes keyboard from {previous.name}"
+                )
+                previous.send(
+                    {"event": "keyboard", "keyboard": False, "holder": client.name}
+                )
+            if client in self.keyboard_queue:
+                self.keyboard_queue.remove(client)
+            self._keyboard_grant(client, notify=notify)
+            return
+        raise ValueError(f"invalid keyboard mode {mode!r}")
+
+    def _keyboard_grant(self, client: Client, *, notify: bool = True) -> None:
+        self.keyboard = client
+        client.warned_keyboard = False
+        if notify:
+            logger.info(f"console[{self.tty}]: keyboard to {client.name}")
+            client.send({"event": "keyboard", "keyboard": True})
+
+    def _keyboard_release(self, client: Client) -> None:
+        if client in self.keyboard_queue:
+            self.keyboard_queue.remove(client)
+        if self.keyboard is not client:
+            return
+        self.keyboard = None
+        if self.keyboard_queue:
+            self._keyboard_grant(self.keyboard_queue.pop(0))
+
+    def _on_client_pty(self, client: Client, mask: int) -> None:
+        if mask & selectors.EVENT_WRITE:
+            client.flush()
+        if not (mask & selectors.EVENT_READ):
+            return
+        assert client.master_fd is not None
+        try:
+            data = os.read(client.master_fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if e.errno != errno.EIO:
+                raise
+            return
+        if self.keyboard is not client:
+            if not client.warned_keyboard:
+                client.warned_keyboard = True
+                holder = self.keyboard.name if self.keyboard else None
+                logger.info(
+                    f"console[{self.tty}]: drop input from {client.name} (keyboard held by {holder})"
+                )
+            return
+        if self.ser is None:
+            logger.warning(f"console[{self.tty}]: drop input, tty not open")
+            return
+        self.ser.write(data)
+
+    def _client_remove(self, client: Client) -> None:
+        if client.pty is not None:
+            logger.info(
+                f"console[{self.tty}]: {client.name} detached"
+                + (f" ({client.dropped} bytes dropped)" if client.dropped else "")
+            )
+        self._keyboard_release(client)
+        self.clients.remove(client)
+        client.close()
+
+    def close(self) -> None:
+        for client in list(self.clients):
+            self._client_remove(client)
+        if self.ser is not None:
+            self._tty_close()
+        self.broker.unregister(self.listener.fileno())
+        self.listener.close()
+        if self.capture is not None:
+            self.capture.close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+
+class Broker:
+    def __init__(self) -> None:
+        self.sel = selectors.DefaultSelector()
+        self.consoles: list[Console] = []
+
+    def register(
+        self, fd: int, events: int, callback: typing.Callable[[int], None]
+    ) -> None:
+        self.sel.register(fd, events, callback)
+
+    def unregister(self, fd: int) -> None:
+        try:
+            self.sel.unregister(fd)
+        except KeyError:
+            pass
+
+    def want_write(self, fd: int, want: bool) -> None:
+        key = self.sel.get_key(fd)
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want else 0)
+        if key.events != events:
+            self.sel.modify(fd, events, key.data)
+
+    def add(
+        self,
+        tty: str,
+        *,
+        ring_size: int = DEFAULT_RING_SIZE,
+        capture_dir: Optional[str] = None,
+    ) -> Console:
+        console = Console(self, tty, ring_size, capture_dir)
+        self.register(
+            console.listener.fileno(), selectors.EVENT_READ, console.on_accept
+        )
+        self.consoles.append(console)
+        return console
+
+    def run(self, *, until: Optional[typing.Callable[[], bool]] = None) -> None:
+        while until is None or not until():
+            for console in self.consoles:
+                # Retry opening a tty that is not (or no longer) there.
+                console.open()
+            for key, mask in self.sel.select(timeout=1.0):
+                key.data(mask)
+
+    def close(self) -> None:
+        for console in self.consoles:
+            console.close()
+        self.consoles.clear()
+        self.sel.close()
+
+
+def serve(args: argparse.Namespace) -> None:
+    broker = Broker()
+    try:
+        for tty in args.tty:
+            broker.add(tty, ring_size=args.ring_size, capture_dir=args.capture_dir)
+        broker.run()
+    finally:
+        broker.close()
+
+
+def status(args: argparse.Namespace) -> None:
+    for tty in args.tty:
+        try:
+            conn = common_dpu.ConsoleBrokerConnection(tty)
+        except OSError as e:
+            print(f"{tty}: no console broker ({e})")
+            continue
+        try:
+            print(json.dumps(conn.request({"op": "status"})))
+        finally:
+            conn.close()
+
+
+def attach(args: argparse.Namespace) -> None:
+    conn = common_dpu.ConsoleBrokerConnection(args.tty[0])
+    try:
+        reply = conn.request(
+            {
+                "op": "attach",
+                "name": f"attach[{os.getpid()}]",
+                "keyboard": "none" if args.read_only else "take",
+                "replay": args.replay,
+            }
+        )
+        cmd = [s.replace("{pty}", reply["pty"]) for s in args.cmd]
+        logger.info(f"attached to {args.tty[0]} on {reply['pty']}: run {cmd}")
+        proc = subprocess.Popen(cmd)
+        time.sleep(ATTACH_START_DELAY)
+        conn.request({"op": "start"})
+        rc = proc.wait()
+    finally:
+        conn.close()
+    sys.exit(rc)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Share the serial consoles of the Marvell DPU.\n\n"
+        f'"serve" owns the serial ports and keeps their recent output in a ring buffer. Clients connect via Unix sockets in {common_dpu.CONSOLE_BROKER_DIR} and each gets its own pty with a copy of the output. '
+        "One client at a time holds the keyboard. While the broker runs, reset.py, fwupdate.py and pxeboot.py attach to it instead of opening the serial ports.",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_serve = subparsers.add_parser("serve", help="Run the broker.")
+    parser_serve.add_argument(
+        "tty",
+        nargs="*",
+        default=[common_dpu.TTYUSB0, common_dpu.TTYUSB1],
+        help=f"The serial ports. Defaults to {common_dpu.TTYUSB0} and {common_dpu.TTYUSB1}.",
+    )
+    parser_serve.add_argument(
+        "--ring-size",
+        type=int,
+        default=DEFAULT_RING_SIZE,
+        help=f"The number of bytes of output to keep per serial port. Defaults to {DEFAULT_RING_SIZE}.",
+    )
+    parser_serve.add_argument(
+        "--capture-dir",
+        type=str,
+        default=None,
+        help='Also write the output to compressed, rotated log files "console-*.log.gz" in this directory. For example "/var/log/marvell-tools".',
+    )
+    parser_serve.set_defaults(func=serve)
+
+    parser_status = subparsers.add_parser("status", help="Show the broker state.")
+    parser_status.add_argument(
+        "tty",
+        nargs="*",
+        default=[common_dpu.TTYUSB0, common_dpu.TTYUSB1],
+    )
+    parser_status.set_defaults(func=status)
+
+    parser_attach = subparsers.add_parser(
+        "attach",
+        help="Take the keyboard and run a terminal program on a pty of the broker.",
+    )
+    parser_attach.add_argument(
+        "--replay",
+        type=int,
+        default=64 * 1024,
+        help="The number of bytes of past output to show first. Defaults to 65536.",
+    )
+    parser_attach.add_argument(
+        "--read-only",
+        action="store_true",
+        help="Don't take the keyboard.",
+    )
+    parser_attach.add_argument("tty", nargs=1)
+    parser_attach.add_argument(
+        "cmd",
+        nargs="*",
+        default=["minicom", "-D", "{pty}"],
+        help='The command to run. "{pty}" is replaced by the path of the pty. Defaults to "minicom -D {pty}".',
+    )
+    parser_attach.set_defaults(func=attach)
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    common_dpu.run_main(main)
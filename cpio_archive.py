@@ -0,0 +1,203 @@
+import dataclasses
+import gzip
+import io
+import posixpath
+import stat
+import typing
+import zlib
+
+from collections.abc import Iterable
+from collections.abc import Iterator
+from typing import Optional
+
+from ktoolbox import common
+
+
+# The "newc" format (and "crc", which only adds a checksum), as used for
+# initrds. See "man 5 cpio".
+_MAGIC_NEWC = b"070701"
+_MAGIC_CRC = b"070702"
+_HEADER_SIZE = 110
+_TRAILER = "TRAILER!!!"
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+# Bounds, so that corrupt archives cannot make us allocate too much.
+_MAX_NAME_SIZE = 4096
+_MAX_READ_SIZE = 64 * 1024 * 1024
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class Member:
+    name: str
+    mode: int
+    size: int
+    mtime: int
+
+
+def _pad4(n: int) -> int:
+    return (4 - n % 4) % 4
+
+
+def _normalize(name: str) -> str:
+    return posixpath.normpath("/" + name).lstrip("/")
+
+
+def _read_exact(f: typing.BinaryIO, n: int) -> bytes:
+    data = f.read(n)
+    if len(data) != n:
+        raise ValueError("cpio: truncated archive")
+    return data
+
+
+def _skip(f: typing.BinaryIO, n: int) -> None:
+    while n > 0:
+        data = f.read(min(n, 1024 * 1024))
+        if not data:
+            raise ValueError("cpio: truncated archive")
+        n -= len(data)
+
+
+def _open(f: typing.BinaryIO) -> typing.BinaryIO:
+    # Initrds are usually gzip compressed. Read through the decompression.
+    reader = io.BufferedReader(typing.cast(io.RawIOBase, f))
+    if reader.peek(2)[:2] == _GZIP_MAGIC:
+        return typing.cast(typing.BinaryIO, gzip.GzipFile(fileobj=reader, mode="rb"))
+    return typing.cast(typing.BinaryIO, reader)
+
+
+class _MemberReader(io.RawIOBase):
+    # The data of one member. Reading stops at its end.
+
+    def __init__(self, f: typing.BinaryIO, size: int) -> None:
+        super().__init__()
+        self._f = f
+        self.remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: typing.Any) -> int:
+        data = self._f.read(min(len(b), self.remaining))
+        b[: len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+def _members(f: typing.BinaryIO) -> Iterator[tuple[Member, typing.BinaryIO]]:
+    # Yields each member, with "f" positioned at its data. If the data is
+    # not read, it is skipped. Concatenated archives (with zero padding in
+    # between) are supported.
+    while True:
+        magic = f.read(6)
+        while magic[:4] == b"\0\0\0\0":
+            # Padding after a trailer.
+            magic = magic[4:] + f.read(4)
+        if not magic:
+            return
+        if magic not in (_MAGIC_NEWC, _MAGIC_CRC):
+            raise ValueError(f"cpio: not a newc archive (magic {magic!r})")
+        header = magic + _read_exact(f, _HEADER_SIZE - 6)
+        try:
+            fields = [int(header[i : i + 8], 16) for i in range(6, _HEADER_SIZE, 8)]
+        except ValueError:
+            raise ValueError("cpio: corrupt header")
+        mode, mtime, size, namesize = fields[1], fields[5], fields[6], fields[11]
+        if namesize == 0 or namesize > _MAX_NAME_SIZE:
+            raise ValueError("cpio: corrupt header")
+        name = _read_exact(f, namesize)[:-1].decode(errors="surrogateescape")
+        _skip(f, _pad4(_HEADER_SIZE + namesize))
+        if name == _TRAILER:
+            continue
+
+        member = Member(name=_normalize(name), mode=mode, size=size, mtime=mtime)
+        reader = _MemberReader(f, size)
+        yield member, typing.cast(typing.BinaryIO, reader)
+        _skip(f, reader.remaining)
+        _skip(f, _pad4(size))
+
+
+def list_members(f: typing.BinaryIO) -> list[Member]:
+    try:
+        return [m for m, _ in _members(_open(f))]
+    except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+        raise ValueError(f"cpio: corrupt compression: {e}")
+
+
+def read_file(
+    f: typing.BinaryIO,
+    name: str,
+    *,
+    max_size: int = _MAX_READ_SIZE,
+) -> Optional[bytes]:
+    # The content of regular file "name" in the (maybe gzip compressed)
+    # archive. Reading stops when it is found. Returns None, if the archive
+    # has no such file. Raises ValueError for corrupt archives.
+    name = _normalize(name)
+    try:
+        for member, data in _members(_open(f)):
+            if member.name != name or not stat.S_ISREG(member.mode):
+                continue
+            if member.size > max_size:
+                raise ValueError(f"cpio: {name} is too large ({member.size} bytes)")
+            return _read_exact(data, member.size)
+    except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+        raise ValueError(f"cpio: corrupt compression: {e}")
+    return None
+
+
+def write(
+    files: Iterable[tuple[str, bytes]],
+    *,
+    mode: int = 0o644,
+    mtime: int = 0,
+    compress: bool = True,
+) -> bytes:
+    # A newc archive with regular "files" (name and content), like
+    # ignition.img. With the default "mtime", the result is reproducible.
+    out = io.BytesIO()
+    ino = 0
+
+    def _entry(name: str, mode: int, data: bytes) -> None:
+        nonlocal ino
+        ino += 1
+        encoded = name.encode() + b"\0"
+        fields = (
+            ino,
+            mode,
+            0,  # uid
+            0,  # gid
+            1,  # nlink
+            mtime,
+            len(data),
+            0,  # devmajor
+            0,  # devminor
+            0,  # rdevmajor
+            0,  # rdevminor
+            len(encoded),
+            0,  # check
+        )
+        out.write(_MAGIC_NEWC + b"".join(b"%08X" % v for v in fields))
+        out.write(encoded + b"\0" * _pad4(_HEADER_SIZE + len(encoded)))
+        out.write(data + b"\0" * _pad4(len(data)))
+
+    dirs: set[str] = set()
+    for name, data in files:
+        name = _normalize(name)
+        parent = posixpath.dirname(name)
+        missing = []
+        while parent and parent not in dirs:
+            missing.append(parent)
+            parent = posixpath.dirname(parent)
+        for d in reversed(missing):
+            dirs.add(d)
+            _entry(d, stat.S_IFDIR | 0o755, b"")
+        _entry(name, stat.S_IFREG | mode, data)
+    _entry(_TRAILER, 0, b"")
+    # Like the cpio tool, pad to a block of 512 bytes.
+    out.write(b"\0" * ((512 - out.tell() % 512) % 512))
+
+    archive = out.getvalue()
+    if compress:
+        return gzip.compress(archive, mtime=0)
+    return archive
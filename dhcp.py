@@ -0,0 +1,201 @@
+import dataclasses
+import os
+import select
+import socket
+import struct
+import threading
+
+from typing import Optional
+
+from ktoolbox import common
+
+import common_dpu
+import events
+
+from common_dpu import logger
+
+
+SERVER_PORT = 67
+CLIENT_PORT = 68
+
+DISCOVER = 1
+OFFER = 2
+REQUEST = 3
+DECLINE = 4
+ACK = 5
+NAK = 6
+RELEASE = 7
+INFORM = 8
+
+MESSAGE_TYPE_NAMES = {
+    DISCOVER: "discover",
+    OFFER: "offer",
+    REQUEST: "request",
+    DECLINE: "decline",
+    ACK: "ack",
+    NAK: "nak",
+    RELEASE: "release",
+    INFORM: "inform",
+}
+
+_ETH_P_IP = 0x0800
+
+_MAGIC_COOKIE = b"\x63\x82\x53\x63"
+_OPT_PAD = 0
+_OPT_MESSAGE_TYPE = 53
+_OPT_PARAMETER_LIST = 55
+_OPT_END = 255
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class Message:
+    # The fields of a DHCP message that we care about.
+    op: int
+    xid: int
+    chaddr: str
+    yiaddr: str
+    message_type: Optional[int]
+
+
+def discover(xid: int, chaddr: bytes) -> bytes:
+    # A DHCPDISCOVER from "chaddr", asking for a broadcast reply.
+    return (
+        struct.pack(
+            "!BBBBIHH4s4s4s4s16s64s128s",
+            1,  # op: BOOTREQUEST
+            1,  # htype: ethernet
+            6,  # hlen
+            0,  # hops
+            xid,
+            0,  # secs
+            0x8000,  # flags: broadcast
+            b"",  # ciaddr
+            b"",  # yiaddr
+            b"",  # siaddr
+            b"",  # giaddr
+            chaddr,
+            b"",  # sname
+            b"",  # file
+        )
+        + _MAGIC_COOKIE
+        + bytes((_OPT_MESSAGE_TYPE, 1, DISCOVER))
+        + bytes((_OPT_PARAMETER_LIST, 2, 1, 3))
+        + bytes((_OPT_END,))
+    )
+
+
+def _message_type(options: bytes) -> Optional[int]:
+    i = 0
+    while i < len(options):
+        code = options[i]
+        if code == _OPT_END:
+            break
+        if code == _OPT_PAD:
+            i += 1
+            continue
+        if i + 1 >= len(options):
+            break
+        length = options[i + 1]
+        if code == _OPT_MESSAGE_TYPE and length == 1 and i + 2 < len(options):
+            return options[i + 2]
+        i += 2 + length
+    return None
+
+
+def parse(payload: bytes) -> Optional[Message]:
+    # Parse the UDP payload of a DHCP message.
+    if len(payload) < 240 or payload[236:240] != _MAGIC_COOKIE:
+        return None
+    return Message(
+        op=payload[0],
+        xid=struct.unpack_from("!I", payload, 4)[0],
+        chaddr=":".join(f"{b:02x}" for b in payload[28:34]),
+        yiaddr=socket.inet_ntoa(payload[16:20]),
+        message_type=_message_type(payload[240:]),
+    )
+
+
+def parse_ip(packet: bytes) -> Optional[Message]:
+    # Parse a DHCP message from an IPv4 packet, as seen on a packet socket.
+    if len(packet) < 20 or packet[0] >> 4 != 4 or packet[9] != socket.IPPROTO_UDP:
+        return None
+    ihl = (packet[0] & 0x0F) * 4
+    udp = packet[ihl:]
+    if len(udp) < 8:
+        return None
+    (dport,) = struct.unpack_from("!H", udp, 2)
+    if dport not in (SERVER_PORT, CLIENT_PORT):
+        return None
+    return parse(udp[8:])
+
+
+def open_packet_socket(dev: str) -> socket.socket:
+    # A socket that sees the IPv4 packets on "dev", in both directions. dhcpd
+    # sends its replies via its own packet socket, so they are not seen on
+    # UDP sockets of the host. Raises PermissionError without CAP_NET_RAW.
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(_ETH_P_IP))
+    try:
+        sock.bind((dev, _ETH_P_IP))
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+class Watcher(common_dpu.Service):
+    """
+    Watch the DHCP messages on "dev" and emit them as events ("dhcp-discover",
+    "dhcp-offer", "dhcp-ack", ...) with the MAC address of the client and
+    the offered address.
+    """
+
+    def __init__(self, dev: str) -> None:
+        super().__init__(f"dhcp-watch[{dev}]")
+        self.dev = dev
+        self._sock: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop_r = -1
+        self._stop_w = -1
+
+    def start(self) -> None:
+        assert self._sock is None
+        self._sock = open_packet_socket(self.dev)
+        self._stop_r, self._stop_w = os.pipe()
+        self._thread = threading.Thread(
+            target=self._run,
+            name=self.name,
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._sock is None:
+            return
+        os.write(self._stop_w, b"x")
+        assert self._thread is not None
+        self._thread.join()
+        self._sock.close()
+        os.close(self._stop_r)
+        os.close(self._stop_w)
+        self._sock = None
+        self._thread = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self) -> None:
+        assert self._sock is not None
+        while True:
+            r, _, _ = select.select([self._sock.fileno(), self._stop_r], [], [])
+            if self._stop_r in r:
+                return
+            try:
+                packet = self._sock.recv(65536)
+            except OSError:
+                continue
+            msg = parse_ip(packet)
+            if msg is None or msg.message_type not in MESSAGE_TYPE_NAMES:
+                continue
+            name = MESSAGE_TYPE_NAMES[msg.message_type]
+            logger.debug(f"dhcp-watch: {name} for {msg.chaddr} ({msg.yiaddr})")
+            events.emit(f"dhcp-{name}", mac=msg.chaddr, addr=msg.yiaddr)
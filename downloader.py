@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+
+import argparse
+import dataclasses
+import hashlib
+import os
+import queue
+import ssl
+import threading
+import time
+import typing
+import urllib.error
+import urllib.request
+
+from typing import Optional
+
+from ktoolbox import common
+
+import common_dpu
+
+from common_dpu import logger
+
+
+STATE_VERSION = 1
+
+_READ_SIZE = 1024 * 1024
+
+# Save the progress (for resuming) at most this often.
+_STATE_INTERVAL = 1.0
+
+_PROGRESS_INTERVAL = 10.0
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class DownloadResult:
+    filename: str
+    size: int
+    # The SHA-256 of the file. None for files that were downloaded by an
+    # older version of the tool.
+    sha256: Optional[str]
+    # False, if the existing file was up to date.
+    downloaded: bool
+
+
+class DownloadError(Exception):
+    pass
+
+
+class _RemoteChanged(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class _Remote:
+    url: str
+    size: Optional[int]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    accept_ranges: bool
+
+
+def state_filename(filename: str) -> str:
+    return f"{filename}.download.json"
+
+
+def _ssl_context(insecure: bool) -> ssl.SSLContext:
+    ctx = ssl.create_default_context()
+    if insecure:
+        # Like "curl -k". Our download servers use an internal CA.
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+class _Download:
+    def __init__(
+        self,
+        url: str,
+        filename: str,
+        *,
+        connections: int,
+        segment_size: int,
+        timeout: float,
+        retries: int,
+        insecure: bool,
+    ) -> None:
+        self.url = url
+        self.filename = filename
+        self.part_filename = f"{filename}.part"
+        self.state_filename = state_filename(filename)
+        self.connections = connections
+        self.segment_size = segment_size
+        self.timeout = timeout
+        self.retries = retries
+        self.ssl_context = _ssl_context(insecure)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # [start, end, done] of each segment. "done" is the absolute offset
+        # up to which the data was written.
+        self._segments: list[list[int]] = []
+        # How often a stream without ranges started again at 0 (see _hash()).
+        self._restarts = 0
+        self._error: Optional[BaseException] = None
+        self._bytes_fetched = 0
+        self._state_saved = 0.0
+
+    def _open(
+        self,
+        method: str = "GET",
+        headers: Optional[dict[str, str]] = None,
+    ) -> typing.Any:
+        req = urllib.request.Request(self.url, method=method, headers=headers or {})
+        return urllib.request.urlopen(
+            req, timeout=self.timeout, context=self.ssl_context
+        )
+
+    def probe(self, headers: Optional[dict[str, str]] = None) -> Optional[_Remote]:
+        # HEAD the URL. Returns None, if the server replied "304 Not
+        # Modified".
+        try:
+            with self._open("HEAD", headers) as resp:
+                h = resp.headers
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+        size = h.get("Content-Length")
+        return _Remote(
+            url=self.url,
+            size=int(size) if size is not None and size.isdigit() else None,
+            etag=h.get("ETag"),
+            last_modified=h.get("Last-Modified"),
+            accept_ranges=h.get("Accept-Ranges", "").strip().lower() == "bytes",
+        )
+
+    def _state_save(
+        self, remote: _Remote, *, complete: bool = False, **extra: typing.Any
+    ) -> None:
+        common_dpu.json_write_atomic(
+            self.state_filename,
+            {
+                "version": STATE_VERSION,
+                "url": remote.url,
+                "size": remote.size,
+                "etag": remote.etag,
+                "last_modified": remote.last_modified,
+                "complete": complete,
+                "segments": self._segments,
+                **extra,
+            },
+        )
+
+    def _state_resume(self, remote: _Remote) -> bool:
+        # Continue a previous, interrupted download of the same remote file.
+        state = common_dpu.json_read(self.state_filename)
+        if (
+            not isinstance(state, dict)
+            or state.get("version") != STATE_VERSION
+            or state.get("complete")
+            or state.get("url") != remote.url
+            or state.get("size") != remote.size
+            or (state.get("etag"), state.get("last_modified"))
+            != (remote.etag, remote.last_modified)
+            or not (remote.etag or remote.last_modified)
+            or not os.path.exists(self.part_filename)
+        ):
+            return False
+        try:
+            segments = [[int(x) for x in s] for s in state["segments"]]
+        except (KeyError, TypeError, ValueError):
+            return False
+        self._segments = segments
+        done = sum(s[2] - s[0] for s in segments)
+        logger.info(
+            f"download: resume {self.url} at {done} of {remote.size} bytes ({100 * done // max(1, remote.size or 1)}%)"
+        )
+        return True
+
+    def _fetch_segment(self, fd: int, remote: _Remote, idx: int) -> None:
+        tries = 0
+        ranged = remote.accept_ranges and remote.size is not None
+        while True:
+            with self._cond:
+                start, end, done = self._segments[idx]
+                if self._error is not None:
+                    return
+                if not ranged and done > start:
+                    # Without ranges, the server sends the file from the
+                    # start again.
+                    done = start
+                    self._segments[idx][2] = done
+                    self._restarts += 1
+                    self._cond.notify_all()
+            if done >= end:
+                return
+            headers = {}
+            if ranged:
+                headers["Range"] = f"bytes={done}-{end - 1}"
+                # If the file changed since we started, the server sends all
+                # of it (200) instead of the range (206).
+                if remote.etag or remote.last_modified:
+                    headers["If-Range"] = common.unwrap(
+                        remote.etag or remote.last_modified
+                    )
+            try:
+                with self._open("GET", headers) as resp:
+                    if ranged and resp.status != 206:
+                        raise _RemoteChanged(f"server replied {resp.status} to range")
+                    offset = done
+                    while offset < end:
+                        data = resp.read(min(_READ_SIZE, end - offset))
+                        if not data:
+                            break
+                        os.pwrite(fd, data, offset)
+                        offset += len(data)
+                        with self._cond:
+                            self._segments[idx][2] = offset
+                            self._bytes_fetched += len(data)
+                            self._cond.notify_all()
+                        if ranged:
+                            tries = 0
+                        self._maybe_save(fd, remote)
+                    if offset < end and remote.size is not None:
+                        raise DownloadError("connection closed early")
+                return
+            except _RemoteChanged:
+                raise
+            except (OSError, DownloadError) as e:
+                tries += 1
+                if tries > self.retries:
+                    raise DownloadError(
+                        f"failure to download range {done}-{end - 1} of {self.url}: {e}"
+                    ) from e
+                logger.warning(
+                    f"download: range {done}-{end - 1} failed ({e}), retry {tries}/{self.retries}"
+                )
+                time.sleep(min(2**tries, 30))
+
+    def _maybe_save(self, fd: int, remote: _Remote) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._state_saved < _STATE_INTERVAL:
+                return
+            self._state_saved = now
+        # The data must be on disk before the state claims it is.
+        os.fdatasync(fd)
+        with self._lock:
+            self._state_save(remote)
+
+    def _hash(self, fd: int, size: int) -> str:
+        # Hash the data in order, as soon as it is written. The data is
+        # still in the page cache.
+        h = hashlib.sha256()
+        offset = 0
+        restarts = self._restarts
+        while offset < size:
+            with self._cond:
+                while True:
+                    if self._error is not None:
+                        raise self._error
+                    if self._restarts != restarts:
+                        restarts = self._restarts
+                        h = hashlib.sha256()
+                        offset = 0
+                    available = offset
+                    for start, end, done in self._segments:
+                        if start > available:
+                            break
+                        available = max(available, done)
+                        if done < end:
+                            break
+                    if available > offset:
+                        break
+                    self._cond.wait(1.0)
+            while offset < available:
+                data = os.pread(fd, min(_READ_SIZE, available - offset), offset)
+                if not data:
+                    raise DownloadError("short read while hashing")
+                h.update(data)
+                offset += len(data)
+        return h.hexdigest()
+
+    def _progress(self, size: Optional[int], stop: threading.Event) -> None:
+        time_start = time.monotonic()
+        while not stop.wait(_PROGRESS_INTERVAL):
+            with self._lock:
+                done = sum(s[2] - s[0] for s in self._segments)
+                fetched = self._bytes_fetched
+            rate = fetched / (time.monotonic() - time_start) / (1024 * 1024)
+            total = f" of {size}" if size is not None else ""
+            logger.info(f"download: {done}{total} bytes ({rate:.1f} MiB/s)")
+
+    def run(self, remote: _Remote) -> str:
+        # Download into the ".part" file, and return the SHA-256.
+        size = remote.size
+        resumed = size is not None and self._state_resume(remote)
+        if not resumed:
+            if remote.accept_ranges and size is not None:
+                segment_size = max(
+                    self.segment_size, -(-size // (self.connections * 4))
+                )
+                self._segments = [
+                    [start, min(start + segment_size, size), start]
+                    for start in range(0, size, segment_size)
+                ]
+            else:
+                # One stream. Without ranges, we cannot resume.
+                self._segments = [[0, size if size is not None else 2**63, 0]]
+            with open(self.part_filename, "wb") as f:
+                if size is not None:
+                    f.truncate(size)
+
+        fd = os.open(self.part_filename, os.O_RDWR | os.O_CLOEXEC)
+        try:
+            work: queue.SimpleQueue[int] = queue.SimpleQueue()
+            for idx in range(len(self._segments)):
+                work.put(idx)
+
+            def _worker() -> None:
+                try:
+                    while True:
+                        try:
+                            idx = work.get_nowait()
+                        except queue.Empty:
+                            return
+                        self._fetch_segment(fd, remote, idx)
+                except BaseException as e:
+                    with self._cond:
+                        if self._error is None:
+                            self._error = e
+                        self._cond.notify_all()
+
+            if size is None:
+                # The length is only known at the end. Hash after the fact.
+                _worker()
+                if self._error is not None:
+                    raise self._error
+                size = os.fstat(fd).st_size
+                self._segments = [[0, size, size]]
+                return self._hash(fd, size)
+
+            stop_progress = threading.Event()
+            threads = [
+                threading.Thread(target=_worker, name=f"download-{i}", daemon=True)
+                for i in range(min(self.connections, len(self._segments)))
+            ]
+            progress = threading.Thread(
+                target=self._progress, args=(size, stop_progress), daemon=True
+            )
+            for th in threads:
+                th.start()
+            progress.start()
+            try:
+                sha256 = self._hash(fd, size)
+            finally:
+                for th in threads:
+                    th.join()
+                stop_progress.set()
+                progress.join()
+                if self._error is not None:
+                    os.fdatasync(fd)
+                    self._state_save(remote)
+            if self._error is not None:
+                raise self._error
+            os.fdatasync(fd)
+            return sha256
+        finally:
+            os.close(fd)
+
+
+def download(
+    url: str,
+    filename: str,
+    *,
+    force: bool = False,
+    revalidate: bool = True,
+    connections: int = 4,
+    segment_size: int = 64 * 1024 * 1024,
+    timeout: float = 60.0,
+    retries: int = 5,
+    insecure: bool = True,
+) -> DownloadResult:
+    """
+    Download "url" to "filename", with "connections" parallel range
+    requests. The progress is kept in "{filename}.download.json", so that an
+    interrupted download continues where it stopped. The SHA-256 is computed
+    while downloading.
+
+    If "filename" exists, it is kept. With "revalidate", the server is asked
+    (If-None-Match/If-Modified-Since) whether the file changed. With "force",
+    the file is downloaded again.
+    """
+    dl = _Download(
+        url,
+        filename,
+        connections=connections,
+        segment_size=segment_size,
+        timeout=timeout,
+        retries=retries,
+        insecure=insecure,
+    )
+
+    state = common_dpu.json_read(dl.state_filename)
+    if not isinstance(state, dict) or state.get("url") != url:
+        state = None
+    complete = (
+        state is not None
+        and state.get("complete")
+        and os.path.exists(filename)
+        and os.path.getsize(filename) == state.get("size")
+    )
+
+    if not force and os.path.exists(filename):
+        if not complete or not revalidate:
+            logger.info(f"download: use existing {filename!r}")
+            return DownloadResult(
+                filename=filename,
+                size=os.path.getsize(filename),
+                sha256=state.get("sha256") if complete and state else None,
+                downloaded=False,
+            )
+        assert state is not None
+        headers = {}
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+        try:
+            remote = dl.probe(headers)
+        except OSError as e:
+            logger.warning(
+                f"download: cannot revalidate {url} ({e}). Use existing {filename!r}"
+            )
+            return DownloadResult(
+                filename=filename,
+                size=os.path.getsize(filename),
+                sha256=state.get("sha256"),
+                downloaded=False,
+            )
+        if remote is None or (
+            (remote.etag or remote.last_modified)
+            and (remote.etag, remote.last_modified)
+            == (state.get("etag"), state.get("last_modified"))
+        ):
+            logger.info(f"download: {filename!r} is up to date with {url}")
+            return DownloadResult(
+                filename=filename,
+                size=os.path.getsize(filename),
+                sha256=state.get("sha256"),
+                downloaded=False,
+            )
+        logger.info(f"download: {url} changed. Download again")
+    else:
+        remote = None
+
+    if force:
+        for f in (dl.state_filename, dl.part_filename):
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+
+    time_start = time.monotonic()
+    for attempt in range(2):
+        if remote is None:
+            try:
+                remote = dl.probe()
+            except OSError as e:
+                raise DownloadError(f"failure to download {url}: {e}") from e
+            assert remote is not None
+        logger.info(
+            f"download: {url} to {filename!r} ({remote.size} bytes, {connections if remote.accept_ranges else 1} connections)"
+        )
+        try:
+            sha256 = dl.run(remote)
+            break
+        except _RemoteChanged:
+            if attempt > 0:
+                raise DownloadError(f"{url} keeps changing")
+            logger.warning(f"download: {url} changed while downloading. Restart")
+            try:
+                os.remove(dl.state_filename)
+            except FileNotFoundError:
+                pass
+            remote = None
+            dl._error = None
+
+    size = os.path.getsize(dl.part_filename)
+    os.replace(dl.part_filename, filename)
+    dl._segments = [[0, size, size]]
+    dl._state_save(
+        dataclasses.replace(common.unwrap(remote), size=size),
+        complete=True,
+        sha256=sha256,
+    )
+    duration = time.monotonic() - time_start
+    logger.info(
+        f"download: {filename!r} done, {size} bytes in {duration:.1f}s ({dl._bytes_fetched / max(duration, 0.001) / (1024 * 1024):.1f} MiB/s), sha256 {sha256}"
+    )
+    return DownloadResult(
+        filename=filename,
+        size=size,
+        sha256=sha256,
+        downloaded=True,
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Download a file (like an ISO or firmware image) with parallel range requests.\n\n"
+        'Interrupted downloads continue where they stopped (see the "FILENAME.download.json" state file). '
+        "An existing file is only downloaded again if it changed on the server.",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("url", help="The HTTP/HTTPS URL.")
+    parser.add_argument("filename", help="Where to write the file.")
+    parser.add_argument(
+        "-c",
+        "--connections",
+        type=int,
+        default=4,
+        help="The number of parallel connections. Defaults to 4.",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Download again, even if the file exists.",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    try:
+        result = download(
+            args.url,
+            args.filename,
+            force=args.force,
+            connections=args.connections,
+        )
+    except DownloadError as e:
+        logger.error_and_exit(str(e))
+    print(f"{result.sha256 or '-'}  {result.filename}")
+
+
+if __name__ == "__main__":
+    common_dpu.run_main(main)
@@ -0,0 +1,611 @@
+#!/usr/bin/env python3
+
+import argparse
+import dataclasses
+import os
+import re
+import select
+import threading
+import time
+import tty
+import typing
+
+from typing import Optional
+
+from ktoolbox import common
+
+import common_dpu
+
+from common_dpu import ESC
+from common_dpu import KEY_DOWN
+from common_dpu import KEY_UP
+from common_dpu import logger
+
+
+# The ANSI sequences the UEFI setup browser uses for a menu line. The cursor
+# line is drawn white-on-black, all other lines black-on-white. See
+# "line_pattern" in pxeboot.uefi_boot_menu_process().
+SGR_NORMAL = "\x1b[0m\x1b[30m\x1b[47m"
+SGR_HIGHLIGHT = "\x1b[0m\x1b[37m\x1b[40m"
+
+UBOOT_PROMPT = "crb106-pcie> "
+
+UEFI_FRONT_PAGE = (
+    (
+        "Select Language",
+        "This is the option\r\none adjusts to change\r\nthe language for the\r\ncurrent system",
+    ),
+    (
+        "Device Manager",
+        "This selection will\r\ntake you to the Device\r\nManager",
+    ),
+    (
+        "Boot Manager",
+        "This selection will\r\ntake you to the Boot\r\nManager",
+    ),
+    (
+        "Boot Maintenance Manager",
+        "This selection will\r\ntake you to the Boot\r\nMaintenance Manager",
+    ),
+)
+
+
+class _ResetRequest(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class SimConfig:
+    # The MAC addresses of the PXE boot entries, in menu order. The last one
+    # is the "primary" interface.
+    macs: tuple[str, ...] = ("00:0f:b7:10:00:01", "00:0f:b7:10:00:02")
+    # Whether the MCU console on ttyUSB1 shows the SCP menu or a Zephyr
+    # "uart:~$" shell.
+    scp_menu: bool = True
+    # Which flash the firmware boots from, if no key is pressed (1 or 2).
+    default_boot_device: int = 2
+    baudrate: int = 115200
+    # Delays, in seconds, that the simulated firmware takes.
+    boot_delay: float = 2.0
+    uefi_delay: float = 0.2
+    key_delay: float = 0.01
+    dhcp_delay: float = 0.05
+    tftp_delay: float = 0.2
+    flash_delay: float = 0.2
+    # How long the firmware waits for the user at the various prompts.
+    boot_menu_timeout: float = 10.0
+    uefi_escape_timeout: float = 5.0
+    uboot_autoboot_timeout: float = 3.0
+    # Let "tftpboot" fail, to test error handling.
+    tftp_fail: bool = False
+
+    def boot_entries(self) -> list[str]:
+        entries = ["UEFI Misc Device"]
+        for mac in self.macs:
+            entries.append(f"UEFI PXEv4 (MAC:{mac.replace(':', '').upper()})")
+        for mac in self.macs:
+            entries.append(f"UEFI HTTPv4 (MAC:{mac.replace(':', '').upper()})")
+        entries.append("UEFI Shell")
+        return entries
+
+
+class _PtyPort:
+    def __init__(self, name: str, *, baudrate: int) -> None:
+        self.name = name
+        self._baudrate = baudrate
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.path = os.ttyname(self._slave)
+        self._lock = threading.Condition()
+        self._input = ""
+        self._closed = False
+        self.keys_received = 0
+        self.bytes_sent = 0
+        self._thread = threading.Thread(
+            target=self._reader,
+            name=f"dpu-simulator-{name}",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _reader(self) -> None:
+        while not self._closed:
+            try:
+                r, _, _ = select.select([self._master], [], [], 0.1)
+                if not r:
+                    continue
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            with self._lock:
+                self._input += data.decode(errors="replace")
+                self._lock.notify_all()
+
+    def close(self) -> None:
+        self._closed = True
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def write(self, msg: str) -> None:
+        data = msg.encode()
+        # Roughly emulate the line speed of the UART (8N1).
+        if self._baudrate > 0:
+            time.sleep(len(data) * 10.0 / self._baudrate)
+        os.write(self._master, data)
+        self.bytes_sent += len(data)
+
+    def flush_input(self) -> None:
+        with self._lock:
+            self._input = ""
+
+    def read_key(
+        self,
+        timeout: Optional[float],
+        *,
+        interrupt: Optional[threading.Event] = None,
+    ) -> Optional[str]:
+        # Returns one key press. Escape sequences for the arrow keys are
+        # returned as a whole. Returns None on timeout.
+        end_time = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while True:
+                if interrupt is not None and interrupt.is_set():
+                    raise _ResetRequest()
+                if self._input:
+                    key = self._pop_key()
+                    if key is not None:
+                        self.keys_received += 1
+                        return key
+                wait = 0.05
+                if end_time is not None:
+                    remaining = end_time - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    wait = min(wait, remaining)
+                self._lock.wait(wait)
+
+    def _pop_key(self) -> Optional[str]:
+        s = self._input
+        if s.startswith(ESC):
+            if s in (ESC, f"{ESC}["):
+                # Give the rest of an escape sequence a moment to arrive.
+                self._lock.wait(0.02)
+                s = self._input
+            if len(s) >= 3 and s[1] == "[":
+                key = s[:3]
+                self._input = s[3:]
+                return key
+            self._input = s[1:]
+            return ESC
+        self._input = s[1:]
+        return s[0]
+
+    def read_line(
+        self,
+        *,
+        interrupt: threading.Event,
+        echo: bool = True,
+    ) -> str:
+        line = ""
+        while True:
+            key = self.read_key(None, interrupt=interrupt)
+            assert key is not None
+            if key == "\r":
+                if echo:
+                    self.write("\r\n")
+                return line
+            if key == "\n":
+                # The "\n" of a "\r\n" sequence (KEY_ENTER).
+                continue
+            if key in ("\x08", "\x7f"):
+                if line:
+                    line = line[:-1]
+                    if echo:
+                        self.write("\x08 \x08")
+                continue
+            if len(key) > 1:
+                continue
+            line += key
+            if echo:
+                self.write(key)
+
+
+class DpuSimulator:
+    """
+    Simulates the serial consoles of a Marvell CN106xx DPU on two
+    pseudo-terminals. "console_path" stands in for /dev/ttyUSB0 and
+    "mcu_path" for /dev/ttyUSB1.
+    """
+
+    def __init__(self, cfg: Optional[SimConfig] = None) -> None:
+        self.cfg = cfg or SimConfig()
+        self._console = _PtyPort("console", baudrate=self.cfg.baudrate)
+        self._mcu = _PtyPort("mcu", baudrate=self.cfg.baudrate)
+        self._reset_event = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.resets = 0
+        self.booted: Optional[str] = None
+        self.flashed: dict[int, str] = {}
+        self.uboot_env: dict[str, str] = {}
+        self._threads = [
+            threading.Thread(target=self._mcu_run, daemon=True),
+            threading.Thread(target=self._console_run, daemon=True),
+        ]
+        for th in self._threads:
+            th.start()
+
+    @property
+    def console_path(self) -> str:
+        return self._console.path
+
+    @property
+    def mcu_path(self) -> str:
+        return self._mcu.path
+
+    @property
+    def keys_received(self) -> int:
+        return self._console.keys_received + self._mcu.keys_received
+
+    @property
+    def bytes_sent(self) -> int:
+        return self._console.bytes_sent + self._mcu.bytes_sent
+
+    def close(self) -> None:
+        self._stop.set()
+        self._reset_event.set()
+        for th in self._threads:
+            th.join()
+        self._console.close()
+        self._mcu.close()
+
+    def __enter__(self) -> "DpuSimulator":
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.close()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.resets += 1
+            self.booted = None
+        self._reset_event.set()
+
+    def _sleep(self, timeout: float) -> None:
+        if self._reset_event.wait(timeout):
+            raise _ResetRequest()
+
+    def _read_key(self, timeout: Optional[float]) -> Optional[str]:
+        return self._console.read_key(timeout, interrupt=self._reset_event)
+
+    # MCU console (ttyUSB1)
+
+    def _mcu_run(self) -> None:
+        port = self._mcu
+        while not self._stop.is_set():
+            try:
+                line = port.read_line(interrupt=self._stop, echo=True)
+            except _ResetRequest:
+                return
+            line = line.strip()
+            if self.cfg.scp_menu:
+                if line == "m":
+                    port.write("\r\nSCP Management Menu\r\n  r) Reset\r\n> ")
+                elif line == "r":
+                    port.write("\r\nResetting AP cores...\r\n")
+                    self.reset()
+                else:
+                    port.write(
+                        "\r\nSCP Main Menu\r\n  m) SCP Management Menu\r\n  q) Quit\r\n> "
+                    )
+            else:
+                if line == "kernel reboot warm":
+                    self.reset()
+                    port.write("\r\n")
+                elif line:
+                    port.write(f"{line}: command not found\r\n")
+                port.write("uart:~$ ")
+
+    # Main console (ttyUSB0)
+
+    def _console_run(self) -> None:
+        # The card was already running when we got attached. Nothing happens
+        # until the first reset.
+        while not self._stop.is_set():
+            if not self._reset_event.wait(0.1):
+                continue
+            while self._reset_event.is_set() and not self._stop.is_set():
+                self._reset_event.clear()
+                self._console.flush_input()
+                try:
+                    self._boot()
+                except _ResetRequest:
+                    continue
+
+    def _boot(self) -> None:
+        w = self._console.write
+        self._sleep(self.cfg.boot_delay)
+        boot_device = self.cfg.default_boot_device
+        w("\r\nMarvell CN106XX simulated firmware\r\n")
+        w(f"Boot: SPI flash, using SPI{boot_device - 1}_CS0\r\n")
+        w(
+            f"Press 'B' within {int(self.cfg.boot_menu_timeout)} seconds for boot menu\r\n"
+        )
+        key = self._read_key(self.cfg.boot_menu_timeout)
+        if key in ("b", "B"):
+            w(
+                "\r\nBoot Menu\r\n"
+                "1) Boot from Primary Boot Device\r\n"
+                "2) Boot from Secondary Boot Device\r\n"
+                "Choice: "
+            )
+            while True:
+                key = self._read_key(None)
+                if key in ("1", "2"):
+                    boot_device = int(key)
+                    w(f"{key}\r\n")
+                    break
+        if boot_device == 1:
+            self._boot_uboot()
+        else:
+            self._boot_uefi()
+        self._idle()
+
+    def _idle(self) -> None:
+        # The OS is running. Swallow all input until the next reset.
+        while True:
+            self._read_key(None)
+
+    def _boot_os(self, what: str) -> None:
+        with self._lock:
+            self.booted = what
+        self._console.write(f"\r\nBooting {what}\r\n")
+
+    # u-boot
+
+    def _boot_uboot(self) -> None:
+        w = self._console.write
+        self._sleep(self.cfg.uefi_delay)
+        w("\r\nU-Boot 2024.01 (simulated)\r\n\r\nModel: Marvell CN106XX board\r\n")
+        w(f"Hit any key to stop autoboot: {int(self.cfg.uboot_autoboot_timeout)} ")
+        if self._read_key(self.cfg.uboot_autoboot_timeout) is None:
+            self._boot_os("autoboot")
+            return
+        w("\r\n")
+        status = 0
+        while True:
+            w(UBOOT_PROMPT)
+            line = self._console.read_line(interrupt=self._reset_event)
+            for cmd in line.split(";"):
+                status = self._uboot_cmd(cmd.strip(), status)
+
+    def _uboot_cmd(self, cmd: str, status: int) -> int:
+        w = self._console.write
+        if not cmd:
+            return status
+        argv = [self._uboot_expand(s, status) for s in cmd.split()]
+        name = argv[0]
+        if name == "echo":
+            w(" ".join(argv[1:]) + "\r\n")
+            return 0
+        if name == "setenv":
+            if len(argv) < 2:
+                w("Usage:\r\nsetenv name value ...\r\n")
+                return 1
+            self.uboot_env[argv[1]] = " ".join(argv[2:])
+            return 0
+        if name == "saveenv":
+            w("Saving Environment to SPI Flash... Erasing SPI flash...")
+            self._sleep(self.cfg.key_delay)
+            w("Writing to SPI flash...done\r\nOK\r\n")
+            return 0
+        if name == "dhcp":
+            w("BOOTP broadcast 1\r\n")
+            self._sleep(self.cfg.dhcp_delay)
+            w("DHCP client bound to address 172.131.100.10 (50 ms)\r\n")
+            self.uboot_env["ipaddr"] = "172.131.100.10"
+            return 0
+        if name == "tftpboot":
+            filename = argv[-1] if len(argv) > 1 else ""
+            server = self.uboot_env.get("serverip", "")
+            w(
+                f"Using {self.uboot_env.get('ethact', 'eth0')} device\r\n"
+                f"TFTP from server {server}; our IP address is 172.131.100.10\r\n"
+                f"Filename '{filename}'.\r\nLoad address: 0x20080000\r\nLoading: "
+            )
+            self._sleep(self.cfg.tftp_delay)
+            if self.cfg.tftp_fail or not server:
+                w("T T T \r\nRetry count exceeded; starting again\r\n")
+                return 1
+            w("#################################################\r\n\t done\r\n")
+            w("Bytes transferred = 33554432 (2000000 hex)\r\n")
+            self.uboot_env["fileaddr"] = "20080000"
+            self.uboot_env["filesize"] = "2000000"
+            self.uboot_env["_filename"] = filename
+            return 0
+        if argv[:2] == ["sf", "probe"]:
+            bus = argv[2] if len(argv) > 2 else "0:0"
+            self.uboot_env["_sf"] = bus
+            w(
+                "SF: Detected mx25u12835f with page size 256 Bytes, erase size 64 KiB, total 16 MiB\r\n"
+            )
+            return 0
+        if argv[:2] == ["sf", "update"]:
+            if "_sf" not in self.uboot_env or "_filename" not in self.uboot_env:
+                w("No SPI flash selected. Please run `sf probe'\r\n")
+                return 1
+            w("device 0 offset 0x0, size 0x2000000\r\n")
+            self._sleep(self.cfg.flash_delay)
+            w("33554432 bytes written, 0 bytes skipped in 2.5s, speed 13421772 B/s\r\n")
+            flash = 1 if self.uboot_env["_sf"].startswith("0") else 2
+            with self._lock:
+                self.flashed[flash] = self.uboot_env["_filename"]
+            return 0
+        if name == "reset":
+            w("resetting ...\r\n")
+            self.reset()
+            self._sleep(1.0)
+            return 0
+        w(f"Unknown command '{name}' - try 'help'\r\n")
+        return 1
+
+    def _uboot_expand(self, arg: str, status: int) -> str:
+        def _repl(m: re.Match[str]) -> str:
+            name = m.group(1) or m.group(2)
+            if name == "?":
+                return str(status)
+            return self.uboot_env.get(name, "")
+
+        return re.sub(r"\$\{([^}]+)\}|\$([A-Za-z_][A-Za-z0-9_]*|\?)", _repl, arg)
+
+    # UEFI
+
+    def _boot_uefi(self) -> None:
+        w = self._console.write
+        self._sleep(self.cfg.uefi_delay)
+        w("\r\nUEFI firmware (simulated)\r\n")
+        w("Press ESCAPE for boot options ")
+        end_time = time.monotonic() + self.cfg.uefi_escape_timeout
+        while True:
+            key = self._read_key(max(0.0, end_time - time.monotonic()))
+            if key is None:
+                self._boot_os("default boot entry")
+                return
+            if key == ESC:
+                break
+        # The firmware reads all the pending escapes.
+        while self._read_key(0.1) == ESC:
+            pass
+        self._uefi_menu(
+            "Front Page",
+            [title for title, _ in UEFI_FRONT_PAGE],
+            [helptext for _, helptext in UEFI_FRONT_PAGE],
+            on_enter=self._uefi_front_page_enter,
+        )
+
+    def _uefi_front_page_enter(self, idx: int) -> bool:
+        if UEFI_FRONT_PAGE[idx][0] != "Boot Manager":
+            return False
+        entries = self.cfg.boot_entries()
+        self._uefi_menu(
+            "Boot Manager",
+            entries,
+            [
+                f"Device Path :\r\nPciRoot(0x0)/Pci(0x{i:x},0x0)"
+                for i in range(len(entries))
+            ],
+            on_enter=lambda idx: self._uefi_boot_entry(entries[idx]),
+        )
+        return True
+
+    def _uefi_boot_entry(self, entry: str) -> bool:
+        if not entry.startswith("UEFI PXEv4 "):
+            return False
+        self._console.write(
+            f"{SGR_NORMAL}\x1b[2J\x1b[1;1H>>Start PXE over IPv4.\r\n"
+            "  Station IP address is 172.131.100.10\r\n\r\n"
+            "  Server IP address is 172.131.100.1\r\n"
+            "  NBP filename is /grubaa64.efi\r\n"
+        )
+        self._boot_os(entry)
+        return True
+
+    def _uefi_menu(
+        self,
+        title: str,
+        entries: list[str],
+        helptexts: list[str],
+        *,
+        on_enter: typing.Callable[[int], bool],
+    ) -> None:
+        w = self._console.write
+        first_row = 4
+        col = 3
+        help_col = 50
+
+        def _draw_help(idx: int) -> str:
+            s = ""
+            for i, line in enumerate(helptexts[idx].split("\r\n")):
+                s += f"\x1b[{first_row + i};{help_col}H{SGR_NORMAL}{line:<28}"
+            return s
+
+        def _draw_entry(idx: int, highlight: bool) -> str:
+            if highlight:
+                return f"\x1b[{first_row + idx};{col}H{SGR_HIGHLIGHT}{entries[idx]}{SGR_NORMAL}"
+            return f"\x1b[{first_row + idx};{col}H{SGR_NORMAL}{entries[idx]}"
+
+        cursor = 0
+        screen = f"{SGR_NORMAL}\x1b[2J\x1b[1;{col}H{title}"
+        for idx in range(len(entries)):
+            screen += _draw_entry(idx, idx == cursor)
+        screen += _draw_help(cursor)
+        w(screen)
+
+        while True:
+            key = self._read_key(None)
+            if key in (KEY_DOWN, KEY_UP):
+                self._sleep(self.cfg.key_delay)
+                old = cursor
+                if key == KEY_DOWN:
+                    cursor = (cursor + 1) % len(entries)
+                else:
+                    cursor = (cursor - 1) % len(entries)
+                w(
+                    _draw_entry(old, False)
+                    + _draw_entry(cursor, True)
+                    + _draw_help(cursor)
+                )
+            elif key == "\r":
+                if on_enter(cursor):
+                    return
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Simulate the serial consoles of a Marvell DPU on two pseudo-terminals.\n\n"
+        f"The console pty stands in for {common_dpu.TTYUSB0} and the MCU pty for {common_dpu.TTYUSB1}. The simulator runs until interrupted with CTRL+C.",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--mac",
+        action="append",
+        help="The MAC address of a PXE boot entry. Can be specified multiple times. The last one is the primary interface.",
+    )
+    parser.add_argument(
+        "--uart-shell",
+        action="store_true",
+        help='Show a "uart:~$" shell on the MCU console instead of the SCP menu.',
+    )
+    parser.add_argument(
+        "--realistic",
+        action="store_true",
+        help="Use firmware delays close to a real CN106xx board instead of the fast defaults.",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    kwargs: dict[str, typing.Any] = {}
+    if args.mac:
+        kwargs["macs"] = tuple(args.mac)
+    if args.realistic:
+        kwargs.update(
+            boot_delay=20.0,
+            uefi_delay=15.0,
+            key_delay=0.1,
+            dhcp_delay=3.0,
+            tftp_delay=30.0,
+            flash_delay=60.0,
+        )
+    cfg = SimConfig(scp_menu=not args.uart_shell, **kwargs)
+    with DpuSimulator(cfg) as sim:
+        logger.info(f"dpu-simulator: console on {sim.console_path}")
+        logger.info(f"dpu-simulator: mcu on {sim.mcu_path}")
+        while True:
+            time.sleep(3600)
+
+
+if __name__ == "__main__":
+    common_dpu.run_main(main)
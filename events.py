@@ -0,0 +1,66 @@
+import collections
+import dataclasses
+import threading
+import time
+import typing
+
+from ktoolbox import common
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class Event:
+    seq: int
+    name: str
+    # time.monotonic() of the event.
+    time: float
+    data: dict[str, typing.Any]
+
+
+class EventBus:
+    """
+    Collects what our services see of the DPU, like its DHCP requests and the
+    files it fetches via TFTP and HTTP. The services emit() events from their
+    threads. Others wait() for new events and look at the recent() ones.
+    """
+
+    def __init__(self, *, keep_count: int = 1000) -> None:
+        self._cond = threading.Condition()
+        self._events: collections.deque[Event] = collections.deque(maxlen=keep_count)
+        self._seq = 0
+
+    def emit(self, name: str, **data: typing.Any) -> None:
+        with self._cond:
+            self._seq += 1
+            self._events.append(
+                Event(seq=self._seq, name=name, time=time.monotonic(), data=data)
+            )
+            self._cond.notify_all()
+
+    @property
+    def seq(self) -> int:
+        # Increases with each event.
+        with self._cond:
+            return self._seq
+
+    def wait(self, seq: int, timeout: float) -> int:
+        # Wait until there are events after "seq" (or the timeout expires).
+        # Returns the new "seq".
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq != seq, timeout)
+            return self._seq
+
+    def recent(self, after: int = 0) -> list[Event]:
+        # The kept events with a "seq" after "after".
+        with self._cond:
+            return [e for e in self._events if e.seq > after]
+
+
+_bus = EventBus()
+
+
+def get() -> EventBus:
+    return _bus
+
+
+def emit(name: str, **data: typing.Any) -> None:
+    _bus.emit(name, **data)
@@ -1,20 +1,28 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
 import os
 import shlex
 import shutil
 import time
 import typing
 
+from typing import Optional
+
 from ktoolbox import common
 from ktoolbox import host
 
 import common_dpu
+import downloader
+import readiness
+import tftp_server
+import timeline
+import uboot
 
+from common_dpu import KEY_CTRL_M
 from common_dpu import KEY_ENTER
 from common_dpu import logger
-from common_dpu import run_process
 from reset import reset
 
 
@@ -26,7 +34,7 @@ DEFAULT_IMG_UEFI = (
 )
 
 
-def parse_args() -> argparse.Namespace:
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Process FW IMG file.")
     parser.add_argument(
         "img",
@@ -55,7 +63,21 @@ def parse_args() -> argparse.Namespace:
         help='Select primary or secondary boot device. Defaults to "secondary".',
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--dpu",
+        type=int,
+        default=0,
+        help="The DPU to update, if several are attached to the host. DPU 0 uses /dev/ttyUSB0 and /dev/ttyUSB1, DPU N (from 1) the Nth other USB serial adapter, in the order of the USB ports (see /dev/serial/by-path). Defaults to 0.",
+    )
+
+    parser.add_argument(
+        "--host-path",
+        type=str,
+        default="/host",
+        help='Where the host\'s root is mounted. The timeline of the run is written to "{host-path}/var/log/marvell-tools/fwupdate-timeline.*.jsonl". Defaults to "/host".',
+    )
+
+    args = parser.parse_args(argv)
 
     if args.boot_device == "1":
         args.boot_device = "primary"
@@ -65,7 +87,7 @@ def parse_args() -> argparse.Namespace:
     return args
 
 
-def prepare_image(boot_device: str, img: typing.Optional[str]) -> str:
+def prepare_image(boot_device: str, img: typing.Optional[str], host_path: str) -> str:
     if not img:
         if boot_device == "primary":
             img = "uboot"
@@ -78,12 +100,17 @@ def prepare_image(boot_device: str, img: typing.Optional[str]) -> str:
         img = DEFAULT_IMG_UEFI
 
     if img.startswith("http://") or img.startswith("https://"):
-        img2 = "/tmp/fwupdate.img"
-        logger.info(f"downloading {repr(img)} to {repr(img2)}.")
-        host.local.run(
-            ["curl", "-L", "-k", "-o", img2, img],
-            die_on_error=True,
-        )
+        # Downloaded images are kept. Next time, they are only downloaded
+        # again if they changed on the server.
+        name, ext = os.path.splitext(img[(img.rfind("/") + 1) :])
+        digest = hashlib.sha256(img.encode()).hexdigest()[:8]
+        img2 = f"{common_dpu.cache_dir(host_path)}/fwupdate/{name}.{digest}{ext}"
+        os.makedirs(os.path.dirname(img2), exist_ok=True)
+        try:
+            result = downloader.download(img, img2)
+        except (OSError, downloader.DownloadError) as e:
+            logger.error_and_exit(f"Failure to download {img!r}: {e}")
+        logger.info(f"using image {img2!r} (sha256 {result.sha256 or 'unknown'}).")
         img = img2
     else:
         logger.info(f"using image {repr(img)}.")
@@ -94,11 +121,17 @@ def prepare_image(boot_device: str, img: typing.Optional[str]) -> str:
     return img
 
 
-def firmware_update(img_path: str, boot_device: str) -> None:
+def firmware_update(
+    img_path: str,
+    boot_device: str,
+    *,
+    since: Optional[int] = None,
+    tty: Optional[str] = None,
+) -> None:
     img = os.path.basename(img_path)
     logger.info(f"firmware updating (image {repr(img)})")
 
-    with common.Serial(common_dpu.TTYUSB0) as ser:
+    with common_dpu.serial_open(tty or common_dpu.TTYUSB0, since=since) as ser:
         logger.info("waiting for instructions to access boot menu")
         ser.expect("Press 'B' within 10 seconds for boot menu", 30)
         time.sleep(1)
@@ -113,55 +146,59 @@ def firmware_update(img_path: str, boot_device: str) -> None:
         logger.info("Press ENTER for uboot menu")
         ser.send(KEY_ENTER)
         logger.info("waiting on uboot prompt")
-        ser.expect("crb106-pcie>", 5)
+        ser.expect(uboot.UBOOT_PROMPT, 5)
+        timeline.mark("uboot-prompt")
+        ub = uboot.UBoot(ser)
         logger.info("enabling 100G management port")
-        ser.send("setenv ethact rvu_pf#1")
-        ser.send(KEY_ENTER)
-        time.sleep(3)
+        ub.run("setenv ethact rvu_pf#1")
         logger.info("saving environment")
-        ser.send("saveenv")
-        ser.send(KEY_ENTER)
-        ser.expect("OK", 10)
-        time.sleep(3)
+        ub.run("saveenv", timeout=10, expect="OK")
+        # Don't persist these. With "autoload", "dhcp" would also try to
+        # TFTP the boot file. With "netretry", a failing "tftpboot" would
+        # retry forever.
+        ub.run("setenv autoload no")
+        ub.run("setenv netretry once")
+        # Large blocks and several blocks in flight (see tftp_server.py).
+        # u-boot has few receive buffers, so keep the window moderate.
+        ub.run(f"setenv tftpblocksize {tftp_server.DEFAULT_MAX_BLKSIZE}")
+        ub.run("setenv tftpwindowsize 16")
         logger.info("enabling dhcp")
-        ser.send("dhcp")
-        ser.send(KEY_ENTER)
-        ser.expect("DHCP client bound to address", 30)
-        time.sleep(1)
+        with timeline.stage("uboot-dhcp"):
+            ub.run("dhcp", timeout=30, expect="DHCP client bound to address")
         logger.info("set serverip")
-        ser.send("setenv serverip 172.131.100.1")
-        ser.send(KEY_ENTER)
-        time.sleep(1)
+        ub.run(f"setenv serverip {common_dpu.host_ip4addr}")
         logger.info("tftp the image")
-        ser.send(f"tftpboot $loadaddr {img}")
-        ser.send(KEY_ENTER)
-        ser.expect("Bytes transferred", 100)
-        time.sleep(1)
+        with timeline.stage("uboot-tftp", file=img):
+            ub.run(
+                f"tftpboot $loadaddr {img}",
+                timeout=100,
+                expect="Bytes transferred",
+                fail_pattern="TFTP error|Retry count exceeded",
+            )
         logger.info(f"set to {boot_device} SPI flash")
         if boot_device == "primary":
-            ser.send("sf probe 0:0")
+            ub.run("sf probe 0:0", expect="SF: Detected")
         else:
-            ser.send("sf probe 1:0")
-        ser.send(KEY_ENTER)
-        ser.expect("SF: Detected", 10)
-        time.sleep(1)
+            ub.run("sf probe 1:0", expect="SF: Detected")
         logger.info("updating flash!")
-        ser.send("sf update $fileaddr 0 $filesize")
-        ser.send(KEY_ENTER)
-        ser.expect("bytes written", 500)
-        time.sleep(1)
+        with timeline.stage("uboot-flash", boot_device=boot_device):
+            ub.run(
+                "sf update $fileaddr 0 $filesize", timeout=500, expect="bytes written"
+            )
         logger.info("reseting")
-        ser.send("reset")
-        ser.send(KEY_ENTER)
+        ser.send("reset" + KEY_CTRL_M)
 
 
 def setup_tftp(img: str) -> None:
     logger.info("Configuring TFTP")
     os.makedirs("/var/lib/tftpboot", exist_ok=True)
-    logger.info("starting in.tftpd")
-    host.local.run("killall in.tftpd")
-    run_process("tftpd", "/usr/sbin/in.tftpd -s -B 1468 -L /var/lib/tftpboot")
     shutil.copy(f"{img}", "/var/lib/tftpboot")
+    service = common_dpu.service_get(f"tftpd[{tftp_server.DEFAULT_PORT}]")
+    if isinstance(service, tftp_server.TftpServer):
+        # Still running from an earlier job (see provisiond.py).
+        service.links_set(None)
+        return
+    common_dpu.service_start(tftp_server.TftpServer("/var/lib/tftpboot"))
 
 
 def setup_dhcp(dev: str) -> None:
@@ -172,15 +209,39 @@ def setup_dhcp(dev: str) -> None:
     )
 
 
-def main() -> None:
-    args = parse_args()
-    img = prepare_image(args.boot_device, args.img)
-    logger.info("Preparing services for FW update")
-    setup_dhcp(args.dev)
-    setup_tftp(img)
-    logger.info("Giving services time to settle")
-    time.sleep(3)
+def wait_services_ready(dev: str, img: str) -> None:
+    readiness.wait_ready(
+        [
+            readiness.Probe(
+                name="dhcpd",
+                fcn=lambda timeout: readiness.probe_dhcp(dev, timeout),
+                timeout=20.0,
+            ),
+            readiness.Probe(
+                name="tftp",
+                fcn=lambda timeout: readiness.probe_tftp(
+                    common_dpu.host_ip4addr,
+                    tftp_server.DEFAULT_PORT,
+                    os.path.basename(img),
+                    timeout,
+                ),
+                timeout=10.0,
+            ),
+        ]
+    )
+
 
+def run(args: argparse.Namespace) -> None:
+    # Update the firmware. The services keep running: main() stops them at
+    # exit, while provisiond.py keeps them for the next job.
+    with timeline.stage("prepare-image"):
+        img = prepare_image(args.boot_device, args.img, args.host_path)
+    with timeline.stage("setup-services"):
+        logger.info("Preparing services for FW update")
+        setup_dhcp(args.dev)
+        setup_tftp(img)
+    with timeline.stage("wait-services-ready"):
+        wait_services_ready(args.dev, img)
     common_dpu.check_services_running()
 
     if args.prompt:
@@ -190,8 +251,22 @@ def main() -> None:
 
     logger.info("Starting FW Update")
     logger.info("Resetting card")
-    reset()
-    firmware_update(img, args.boot_device)
+    # With the console broker, we also see the output since the reset.
+    dpu = common_dpu.dpu_get(args.dpu)
+    since = common_dpu.console_broker_offset(dpu.tty0)
+    reset(tty=dpu.tty1)
+    with timeline.stage("firmware-update"):
+        firmware_update(img, args.boot_device, since=since, tty=dpu.tty0)
+
+
+def main() -> None:
+    args = parse_args()
+    timeline.start(
+        timeline.filename_create(
+            common_dpu.log_dir(args.host_path), "fwupdate-timeline"
+        )
+    )
+    run(args)
     logger.info("Terminating http, tftp, and dhcpd")
     common.thread_list_join_all()
 
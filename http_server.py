@@ -0,0 +1,441 @@
+import concurrent.futures
+import email.utils
+import errno
+import html
+import http
+import http.server
+import os
+import re
+import select
+import shutil
+import socket
+import socketserver
+import threading
+import time
+import typing
+import urllib.parse
+
+from typing import Optional
+
+import common_dpu
+import events
+import iso_image
+import timeline
+
+from common_dpu import logger
+
+
+DEFAULT_PORT = 24380
+
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class _RangeNotSatisfiable(Exception):
+    pass
+
+
+class _Handler(http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1, for keep-alive. Every response has a Content-Length.
+    protocol_version = "HTTP/1.1"
+
+    server: "_PoolHTTPServer"
+
+    # The status of the last send_response().
+    _status = 0
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        # Each request is logged once it is done, with its size and duration
+        # (see _log_done()).
+        pass
+
+    def log_request(self, code: typing.Any = "-", size: typing.Any = "-") -> None:
+        if isinstance(code, int):
+            self._status = code
+
+    def do_GET(self) -> None:
+        self._serve(head=False)
+
+    def do_HEAD(self) -> None:
+        self._serve(head=True)
+
+    def _serve(self, *, head: bool) -> None:
+        time_start = time.monotonic()
+        events.emit("http-request", client=self.client_address[0], path=self.path)
+        try:
+            image = self._image_lookup()
+        except FileNotFoundError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, "File not found")
+            self._log_done(time_start, http.HTTPStatus.NOT_FOUND, 0)
+            return
+        if image is not None:
+            fs, entry = image
+            with fs:
+                if entry.is_dir:
+                    sent = self._serve_image_dir(fs, entry, head=head)
+                    self._log_done(time_start, self._status, sent)
+                    return
+                self._serve_data(
+                    time_start,
+                    head=head,
+                    fd=fs.fd,
+                    size=entry.size,
+                    mtime=entry.mtime,
+                    ranges=lambda offset, length: [
+                        (r.offset, r.length) for r in fs.ranges(entry, offset, length)
+                    ],
+                )
+            return
+
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            # Directory listings and redirects. These are small.
+            f = self.send_head()
+            sent = 0
+            if f is not None:
+                try:
+                    if not head:
+                        shutil.copyfileobj(f, self.wfile)
+                        sent = f.tell()
+                finally:
+                    f.close()
+            self._log_done(time_start, self._status, sent)
+            return
+
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, "File not found")
+            self._log_done(time_start, http.HTTPStatus.NOT_FOUND, 0)
+            return
+
+        with f:
+            st = os.fstat(f.fileno())
+            self._serve_data(
+                time_start,
+                head=head,
+                fd=f.fileno(),
+                size=st.st_size,
+                mtime=st.st_mtime,
+                ranges=lambda offset, length: [(offset, length)],
+            )
+
+    def _image_lookup(self) -> Optional[tuple[iso_image.ImageFs, iso_image.Entry]]:
+        # The links may be replaced by links_set() at any time.
+        links = self.server.links
+        if links is None:
+            return None
+        path = self.path.split("?", 1)[0].split("#", 1)[0]
+        return links.lookup(urllib.parse.unquote(path))
+
+    def _serve_image_dir(
+        self,
+        fs: iso_image.ImageFs,
+        entry: iso_image.Entry,
+        *,
+        head: bool,
+    ) -> int:
+        # Like SimpleHTTPRequestHandler.list_directory(), for a directory in
+        # an image. Returns the number of bytes sent.
+        path = self.path.split("?", 1)[0].split("#", 1)[0]
+        if not path.endswith("/"):
+            self.send_response(http.HTTPStatus.MOVED_PERMANENTLY)
+            self.send_header("Location", path + "/")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return 0
+        title = html.escape(urllib.parse.unquote(path), quote=False)
+        lines = [
+            "<!DOCTYPE HTML>",
+            "<html>",
+            f"<head><title>Directory listing for {title}</title></head>",
+            f"<body><h1>Directory listing for {title}</h1><hr><ul>",
+        ]
+        for e in fs.listdir(entry):
+            name = e.name + ("/" if e.is_dir else "")
+            lines.append(
+                f'<li><a href="{urllib.parse.quote(name)}">{html.escape(name, quote=False)}</a></li>'
+            )
+        lines.append("</ul><hr></body></html>")
+        body = "\n".join(lines).encode()
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if head:
+            return 0
+        self.wfile.write(body)
+        return len(body)
+
+    def _serve_data(
+        self,
+        time_start: float,
+        *,
+        head: bool,
+        fd: int,
+        size: int,
+        mtime: float,
+        ranges: typing.Callable[[int, int], list[tuple[int, int]]],
+    ) -> None:
+        # Send "size" bytes of a file. "ranges" maps a range of the file to
+        # the (offset, length) ranges of "fd" that hold the data.
+        status = http.HTTPStatus.OK
+        offset = 0
+        length = size
+
+        try:
+            content_range = self._parse_range(size)
+        except _RangeNotSatisfiable:
+            self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self._log_done(
+                time_start, http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, 0
+            )
+            return
+        if content_range is not None:
+            status = http.HTTPStatus.PARTIAL_CONTENT
+            offset, length = content_range
+
+        self.send_response(status)
+        self.send_header("Content-Type", self.guess_type(self.path.split("?", 1)[0]))
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", email.utils.formatdate(mtime, usegmt=True))
+        if content_range is not None:
+            self.send_header(
+                "Content-Range", f"bytes {offset}-{offset + length - 1}/{size}"
+            )
+        self.end_headers()
+
+        sent = 0
+        if not head:
+            self.wfile.flush()
+            for fd_offset, fd_length in ranges(offset, length):
+                n = self._sendfile(fd, fd_offset, fd_length)
+                sent += n
+                if n < fd_length:
+                    break
+            if sent < length:
+                # We promised "length" bytes. The client cannot reuse the
+                # connection.
+                self.close_connection = True
+        self._log_done(time_start, status, sent)
+
+    def _parse_range(self, size: int) -> Optional[tuple[int, int]]:
+        # Returns None to send the whole file, or the (offset, length) to
+        # send. Raises _RangeNotSatisfiable. Only single ranges are
+        # supported. For others, the whole file is sent, which is allowed.
+        header = self.headers.get("Range")
+        if not header:
+            return None
+        m = _RANGE_PATTERN.match(header.strip())
+        if not m:
+            return None
+        first, last = m.groups()
+        if not first:
+            if not last:
+                return None
+            # The last N bytes.
+            n = min(int(last), size)
+            if n == 0:
+                raise _RangeNotSatisfiable()
+            return size - n, n
+        start = int(first)
+        if start >= size:
+            raise _RangeNotSatisfiable()
+        end = size - 1 if not last else min(int(last), size - 1)
+        if end < start:
+            return None
+        return start, end - start + 1
+
+    def _sendfile(self, fd: int, offset: int, length: int) -> int:
+        # Copy with sendfile(2), without going through userspace.
+        sock = self.connection
+        sent = 0
+        while sent < length:
+            try:
+                n = os.sendfile(sock.fileno(), fd, offset + sent, length - sent)
+            except BlockingIOError:
+                # The socket has a timeout, and is thus non-blocking.
+                _, w, _ = select.select([], [sock], [], sock.gettimeout())
+                if not w:
+                    raise TimeoutError("http: timeout sending data")
+                continue
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS) or sent > 0:
+                    raise
+                # sendfile() is not supported for this file. Copy instead.
+                while sent < length:
+                    data = os.pread(fd, min(length - sent, 1024 * 1024), offset + sent)
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    sent += len(data)
+                break
+            if n == 0:
+                # The file got shorter.
+                break
+            sent += n
+        return sent
+
+    def _log_done(self, time_start: float, status: int, sent: int) -> None:
+        duration = time.monotonic() - time_start
+        rate = sent / duration / (1024 * 1024) if duration > 0 else 0.0
+        logger.info(
+            f"http: {self.address_string()} {self.command} {self.path} {int(status)} {sent} bytes in {duration:.3f}s ({rate:.1f} MiB/s)"
+        )
+        self.server.stats_add(sent)
+        if self.server.mark_pattern is not None and self.server.mark_pattern.search(
+            self.path
+        ):
+            timeline.mark(
+                "http-get",
+                path=self.path,
+                status=int(status),
+                bytes=sent,
+                duration=duration,
+            )
+
+
+class _PoolHTTPServer(http.server.HTTPServer):
+    # Like ThreadingHTTPServer, but with a bounded pool of threads.
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        directory: str,
+        *,
+        threads: int,
+        timeout: float,
+        mark_pattern: Optional[re.Pattern[str]],
+        links: Optional[iso_image.Links],
+    ) -> None:
+        self.directory = directory
+        self.links = links
+        self.handler_timeout = timeout
+        self.mark_pattern = mark_pattern
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads,
+            thread_name_prefix="http",
+        )
+        self._stats_lock = threading.Lock()
+        self.stats_requests = 0
+        self.stats_bytes = 0
+        super().__init__(address, self._make_handler)
+
+    def _make_handler(
+        self,
+        request: socket.socket,
+        client_address: typing.Any,
+        server: socketserver.BaseServer,
+    ) -> _Handler:
+        return _Handler(request, client_address, server, directory=self.directory)
+
+    def stats_add(self, sent: int) -> None:
+        with self._stats_lock:
+            self.stats_requests += 1
+            self.stats_bytes += sent
+
+    def process_request(self, request: typing.Any, client_address: typing.Any) -> None:
+        request.settimeout(self.handler_timeout)
+        self.executor.submit(self._process_request_pool, request, client_address)
+
+    def _process_request_pool(
+        self, request: typing.Any, client_address: typing.Any
+    ) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def handle_error(self, request: typing.Any, client_address: typing.Any) -> None:
+        logger.debug(f"http: error serving {client_address}", exc_info=True)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class HttpServer(common_dpu.Service):
+    """
+    Serve the files of "directory" via HTTP. Files are sent with sendfile(2)
+    and support "Range" requests. Connections are kept alive and served by a
+    pool of threads. Requests whose path matches "mark_pattern" are recorded
+    in the timeline. Paths in "links" are served from images, instead of from
+    "directory".
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        port: int = DEFAULT_PORT,
+        host: str = "",
+        threads: int = 64,
+        timeout: float = 30.0,
+        mark_pattern: Optional[str] = None,
+        links: Optional[iso_image.Links] = None,
+    ) -> None:
+        super().__init__(f"httpd[{port}]")
+        self.directory = directory
+        self.port = port
+        self.host = host
+        self.threads = threads
+        self.timeout = timeout
+        self.mark_pattern = mark_pattern
+        self.links = links
+        self._server: Optional[_PoolHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        assert self._server is None
+        self._server = _PoolHTTPServer(
+            (self.host, self.port),
+            self.directory,
+            threads=self.threads,
+            timeout=self.timeout,
+            mark_pattern=(
+                re.compile(self.mark_pattern) if self.mark_pattern is not None else None
+            ),
+            links=self.links,
+        )
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            name=self.name,
+            daemon=True,
+        )
+        self._thread.start()
+        logger.info(f"http: serving {self.directory!r} on port {self.port}")
+
+    def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        assert self._thread is not None
+        self._thread.join()
+        logger.info(
+            f"http: served {self._server.stats_requests} requests with {self._server.stats_bytes} bytes"
+        )
+        self._server = None
+        self._thread = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def links_set(self, links: Optional[iso_image.Links]) -> None:
+        # Serve other images (for the next job), without restarting. The
+        # requests in progress still hold a reference on the old images.
+        old_links = self.links
+        self.links = links
+        if self._server is not None:
+            self._server.links = links
+        if old_links is not None and old_links is not links:
+            old_links.close()
@@ -0,0 +1,132 @@
+import re
+import time
+
+from typing import Optional
+
+import events
+import timeline
+
+from common_dpu import logger
+
+
+# The phases of a PXE install, in order, as seen by our services.
+PHASE_FIRMWARE = "firmware"  # The boot entry is selected.
+PHASE_DHCP = "dhcp"  # The DPU got a DHCP offer.
+PHASE_BOOTLOADER = "bootloader"  # The DPU fetched the bootloader or grub.cfg.
+PHASE_KERNEL = "kernel"  # The DPU fetched the kernel, initrd or rootfs.
+PHASE_INSTALLER = "installer"  # The DPU fetched the kickstart/ignition.
+PHASE_FINISHING = "finishing"  # The installer did not fetch anything for a while.
+
+PHASES = (
+    PHASE_FIRMWARE,
+    PHASE_DHCP,
+    PHASE_BOOTLOADER,
+    PHASE_KERNEL,
+    PHASE_INSTALLER,
+    PHASE_FINISHING,
+)
+
+# If the next phase does not start within these seconds, the boot is stuck.
+# Once the installer runs, only the overall timeout applies.
+DEFAULT_STALL_TIMEOUTS = {
+    PHASE_FIRMWARE: 180.0,
+    PHASE_DHCP: 60.0,
+    PHASE_BOOTLOADER: 300.0,
+    PHASE_KERNEL: 900.0,
+}
+
+_KERNEL_PATTERN = re.compile(r"vmlinuz|initrd|rootfs\.img|/\.treeinfo$")
+
+
+class StalledError(RuntimeError):
+    pass
+
+
+class InstallProgress:
+    """
+    Follows the install of the DPU via the events of our DHCP, TFTP and HTTP
+    services (see events.py). update() moves through the PHASES and raises
+    StalledError, if a phase takes too long. Until the installer runs, SSH
+    cannot answer, so poll_interval() is long. Once the installer got quiet,
+    it is short. With "client_ip", only the requests from that address count
+    (with several DPUs, the others are also fetching files).
+    """
+
+    def __init__(
+        self,
+        *,
+        host_ip: str,
+        config_path: str,
+        dpu_mac: Optional[str] = None,
+        client_ip: Optional[str] = None,
+        stall_timeouts: Optional[dict[str, float]] = None,
+        quiet: float = 30.0,
+        poll_fast: float = 2.0,
+        poll_slow: float = 10.0,
+    ) -> None:
+        self.host_ip = host_ip
+        self.config_path = "/" + config_path.lstrip("/")
+        self.dpu_mac = dpu_mac.lower() if dpu_mac else None
+        self.client_ip = client_ip
+        self.stall_timeouts = (
+            DEFAULT_STALL_TIMEOUTS if stall_timeouts is None else stall_timeouts
+        )
+        self.quiet = quiet
+        self.poll_fast = poll_fast
+        self.poll_slow = poll_slow
+        self.phase = PHASE_FIRMWARE
+        self.phase_since = time.monotonic()
+        self._last_activity = self.phase_since
+        self._seq = events.get().seq
+
+    def _enter(self, phase: str, **data: str) -> None:
+        if PHASES.index(phase) <= PHASES.index(self.phase):
+            return
+        logger.info(
+            f"install-progress: {phase} (after {time.monotonic() - self.phase_since:.1f}s in {self.phase})"
+        )
+        self.phase = phase
+        self.phase_since = time.monotonic()
+        timeline.mark(f"install-{phase}", **data)
+
+    def _handle(self, event: events.Event) -> None:
+        if event.name == "dhcp-offer":
+            if self.dpu_mac is None or event.data.get("mac") == self.dpu_mac:
+                self._enter(PHASE_DHCP, addr=event.data.get("addr", ""))
+            return
+        if event.name not in ("tftp-request", "http-request"):
+            return
+        client = event.data.get("client")
+        if client == self.host_ip:
+            # Our own readiness probes.
+            return
+        if self.client_ip is not None and client != self.client_ip:
+            return
+        self._last_activity = event.time
+        path = str(event.data.get("path", ""))
+        if event.name == "http-request" and path == self.config_path:
+            self._enter(PHASE_INSTALLER, path=path)
+        elif _KERNEL_PATTERN.search(path):
+            self._enter(PHASE_KERNEL, path=path)
+        elif event.name == "tftp-request":
+            self._enter(PHASE_BOOTLOADER, path=path)
+
+    def update(self) -> str:
+        # Process the new events and return the current phase.
+        for event in events.get().recent(after=self._seq):
+            self._seq = event.seq
+            self._handle(event)
+        now = time.monotonic()
+        if self.phase == PHASE_INSTALLER and now > self._last_activity + self.quiet:
+            self._enter(PHASE_FINISHING)
+        timeout = self.stall_timeouts.get(self.phase)
+        if timeout is not None and now > self.phase_since + timeout:
+            raise StalledError(
+                f"Boot of the DPU is stuck in phase {self.phase!r} for {now - self.phase_since:.0f}s"
+            )
+        return self.phase
+
+    def poll_interval(self) -> float:
+        if self.phase == PHASE_FINISHING:
+            return self.poll_fast
+        return self.poll_slow
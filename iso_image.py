@@ -0,0 +1,843 @@
+import abc
+import calendar
+import concurrent.futures
+import dataclasses
+import errno
+import hashlib
+import io
+import json
+import os
+import posixpath
+import stat
+import threading
+import time
+import typing
+
+from collections.abc import Iterable
+from typing import Optional
+
+from ktoolbox import common
+
+import common_dpu
+
+from common_dpu import logger
+
+
+SECTOR_SIZE = 2048
+
+# Bounds, so that corrupt images cannot make us loop forever.
+_MAX_VOLUME_DESCRIPTORS = 64
+_MAX_CONTINUATIONS = 16
+
+
+def _u16(data: bytes, offset: int) -> int:
+    return int.from_bytes(data[offset : offset + 2], "little")
+
+
+def _u32(data: bytes, offset: int) -> int:
+    return int.from_bytes(data[offset : offset + 4], "little")
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class Extent:
+    # A range of bytes in the image file.
+    offset: int
+    length: int
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class Entry:
+    name: str
+    is_dir: bool
+    size: int
+    mtime: float
+    # Where the data is in the image file. The extents of directories are
+    # only meaningful to the ImageFs that created the entry.
+    extents: tuple[Extent, ...]
+
+
+class VerifiedHashes:
+    """
+    The SHA-256 of files in images that were read completely. The key is the
+    identity of the image file (device, inode, size, mtime) and the path in
+    the image. ImageFs.check_files() trusts these, instead of reading the
+    files again. Replacing or modifying the image file invalidates them.
+    """
+
+    def __init__(self, filename: str, *, max_entries: int = 256) -> None:
+        self.filename = filename
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        data = common_dpu.json_read(filename)
+        self._hashes: dict[str, dict[str, typing.Any]] = (
+            data["hashes"]
+            if isinstance(data, dict) and isinstance(data.get("hashes"), dict)
+            else {}
+        )
+
+    @staticmethod
+    def key(identity: list[typing.Any], path: str) -> str:
+        return hashlib.sha256(json.dumps([*identity, path]).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            val = self._hashes.get(key)
+        if not isinstance(val, dict) or not isinstance(val.get("sha256"), str):
+            return None
+        sha256: str = val["sha256"]
+        return sha256
+
+    def put(self, hashes: dict[str, str]) -> None:
+        now = time.time()
+        with self._lock:
+            for key, sha256 in hashes.items():
+                self._hashes[key] = {"sha256": sha256, "time": now}
+            if len(self._hashes) > self.max_entries:
+                # Drop the oldest. Their images are likely gone.
+                keep = sorted(
+                    self._hashes.items(),
+                    key=lambda kv: kv[1].get("time", 0),
+                    reverse=True,
+                )[: self.max_entries]
+                self._hashes = dict(keep)
+            data = {"hashes": dict(self._hashes)}
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        common_dpu.json_write_atomic(self.filename, data)
+
+
+class ImageFs(abc.ABC):
+    """
+    A read-only file system in an image file. The data of files is read
+    directly from the image file (at the offsets of the entry's extents),
+    without mounting it.
+
+    The image is reference counted. The opener holds the first reference,
+    ref() takes another one, and each close() drops one. The file is only
+    closed with the last reference, so that a server thread can still read
+    from an image that was replaced for the next job.
+    """
+
+    def __init__(
+        self,
+        fd: int,
+        *,
+        name: str,
+        case_sensitive: bool = True,
+        owns_fd: bool = True,
+        verified: Optional[VerifiedHashes] = None,
+    ) -> None:
+        self.fd = fd
+        self.name = name
+        self.case_sensitive = case_sensitive
+        self.verified = verified
+        self._owns_fd = owns_fd
+        self._parent: Optional[ImageFs] = None
+        self._refs = 1
+        self._lock = threading.Lock()
+        self._dirs: dict[tuple[Extent, ...], dict[str, Entry]] = {}
+
+    @property
+    @abc.abstractmethod
+    def root(self) -> Entry:
+        pass
+
+    @abc.abstractmethod
+    def _read_dir(self, entry: Entry) -> list[Entry]:
+        pass
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.name!r})"
+
+    def __enter__(self) -> "ImageFs":
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.close()
+
+    def ref(self) -> "ImageFs":
+        with self._lock:
+            if self._refs == 0:
+                raise OSError(errno.EBADF, f"{self.name}: image is closed")
+            self._refs += 1
+        return self
+
+    def close(self) -> None:
+        with self._lock:
+            if self._refs == 0:
+                return
+            self._refs -= 1
+            if self._refs > 0:
+                return
+            if self._owns_fd and self.fd >= 0:
+                os.close(self.fd)
+            self.fd = -1
+        if self._parent is not None:
+            self._parent.close()
+
+    def _pread(self, offset: int, length: int) -> bytes:
+        data = os.pread(self.fd, length, offset)
+        if len(data) != length:
+            # Likely a truncated download.
+            raise OSError(f"{self.name}: short read at offset {offset}")
+        return data
+
+    def _key(self, name: str) -> str:
+        return name if self.case_sensitive else name.lower()
+
+    def _dir(self, entry: Entry) -> dict[str, Entry]:
+        if not entry.is_dir:
+            raise NotADirectoryError(entry.name)
+        with self._lock:
+            d = self._dirs.get(entry.extents)
+        if d is None:
+            d = {self._key(e.name): e for e in self._read_dir(entry)}
+            with self._lock:
+                self._dirs[entry.extents] = d
+        return d
+
+    def listdir(self, entry: Entry) -> list[Entry]:
+        return sorted(self._dir(entry).values(), key=lambda e: e.name)
+
+    def lookup(self, path: str) -> Optional[Entry]:
+        path = posixpath.normpath("/" + path).lstrip("/")
+        entry = self.root
+        if not path:
+            return entry
+        for part in path.split("/"):
+            if not entry.is_dir:
+                return None
+            e = self._dir(entry).get(self._key(part))
+            if e is None:
+                return None
+            entry = e
+        return entry
+
+    def ranges(self, entry: Entry, offset: int, length: int) -> list[Extent]:
+        # The ranges of the image file that hold "length" bytes of the file,
+        # starting at "offset".
+        result = []
+        end = min(offset + length, entry.size)
+        pos = 0
+        for extent in entry.extents:
+            extent_end = pos + extent.length
+            if extent_end > offset and pos < end:
+                start = max(offset, pos)
+                result.append(
+                    Extent(
+                        offset=extent.offset + start - pos,
+                        length=min(end, extent_end) - start,
+                    )
+                )
+            pos = extent_end
+            if pos >= end:
+                break
+        return result
+
+    def read(self, entry: Entry, offset: int, length: int) -> bytes:
+        return b"".join(
+            self._pread(r.offset, r.length) for r in self.ranges(entry, offset, length)
+        )
+
+    def open(self, path: str) -> typing.BinaryIO:
+        entry = self.lookup(path)
+        if entry is None:
+            raise FileNotFoundError(f"{self.name}: {path}")
+        if entry.is_dir:
+            raise IsADirectoryError(f"{self.name}: {path}")
+        return typing.cast(
+            typing.BinaryIO, io.BufferedReader(_EntryReader(self, entry), 1024 * 1024)
+        )
+
+    def _identity(self) -> list[typing.Any]:
+        # Identifies the content of the image, for VerifiedHashes.
+        st = os.fstat(self.fd)
+        return [
+            type(self).__name__,
+            st.st_dev,
+            st.st_ino,
+            st.st_size,
+            st.st_mtime_ns,
+        ]
+
+    def _sha256(self, entry: Entry) -> str:
+        h = hashlib.sha256()
+        for r in self.ranges(entry, 0, entry.size):
+            for pos in range(0, r.length, 1024 * 1024):
+                h.update(self._pread(r.offset + pos, min(1024 * 1024, r.length - pos)))
+        return h.hexdigest()
+
+    def check_files(self, files: Iterable[str], *, read_check: bool = False) -> bool:
+        # Like common_dpu.check_files(), for the files in the image. With
+        # "read_check", all data is read (in parallel), to detect truncated
+        # images. Files in "verified" are not read again.
+        entries: dict[str, Entry] = {}
+        for path in files:
+            entry = self.lookup(path)
+            if entry is None or entry.is_dir:
+                return False
+            entries[path] = entry
+        if not read_check:
+            return True
+
+        keys: dict[str, str] = {}
+        if self.verified is not None:
+            identity = self._identity()
+            for path in list(entries):
+                keys[path] = VerifiedHashes.key(identity, path)
+                if self.verified.get(keys[path]) is not None:
+                    logger.debug(f"iso-image: {self.name}: {path!r} already verified")
+                    del entries[path]
+        if not entries:
+            return True
+
+        hashes: dict[str, str] = {}
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(entries), 4),
+            thread_name_prefix="iso-check",
+        ) as executor:
+            futures = {
+                path: executor.submit(self._sha256, entry)
+                for path, entry in entries.items()
+            }
+            for path, future in futures.items():
+                try:
+                    hashes[path] = future.result()
+                except OSError as e:
+                    logger.warning(f"iso-image: cannot read {path!r}: {e}")
+                    return False
+        if self.verified is not None:
+            self.verified.put({keys[path]: hashes[path] for path in hashes})
+        return True
+
+
+class _EntryReader(io.RawIOBase):
+    def __init__(self, fs: ImageFs, entry: Entry) -> None:
+        super().__init__()
+        self._fs = fs
+        self._entry = entry
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._entry.size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def readinto(self, buffer: typing.Any) -> int:
+        data = self._fs.read(self._entry, self._pos, len(buffer))
+        buffer[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+def _iso_time(data: bytes) -> float:
+    # The 7 byte "recording date and time" of a directory record.
+    year, month, day, hour, minute, second, tz = data[:7]
+    if month == 0:
+        return 0.0
+    if tz >= 128:
+        tz -= 256
+    try:
+        return float(
+            calendar.timegm((1900 + year, month, day, hour, minute, second))
+            - tz * 15 * 60
+        )
+    except (ValueError, OverflowError):
+        return 0.0
+
+
+class IsoImage(ImageFs):
+    """
+    An ISO9660 image, like the RHEL or RHCOS installation ISO. File names
+    come from the Rock Ridge extension, or from Joliet if there is no Rock
+    Ridge. Multi-extent files and relocated directories are supported.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        *,
+        verified: Optional[VerifiedHashes] = None,
+    ) -> None:
+        super().__init__(
+            os.open(filename, os.O_RDONLY | os.O_CLOEXEC),
+            name=filename,
+            verified=verified,
+        )
+        try:
+            self._root = self._parse_volume()
+        except BaseException:
+            self.close()
+            raise
+
+    @property
+    def root(self) -> Entry:
+        return self._root
+
+    def _parse_volume(self) -> Entry:
+        pvd: Optional[bytes] = None
+        joliet: Optional[bytes] = None
+        for i in range(_MAX_VOLUME_DESCRIPTORS):
+            vd = os.pread(self.fd, SECTOR_SIZE, (16 + i) * SECTOR_SIZE)
+            if len(vd) != SECTOR_SIZE or vd[1:6] != b"CD001":
+                raise ValueError(f"{self.name}: not an ISO9660 image")
+            if vd[0] == 1 and pvd is None:
+                pvd = vd
+            elif vd[0] == 2 and vd[88:91] in (b"%/@", b"%/C", b"%/E"):
+                joliet = vd
+            elif vd[0] == 255:
+                break
+        if pvd is None:
+            raise ValueError(f"{self.name}: no primary volume descriptor")
+
+        self._joliet = False
+        self._susp_skip = -1
+        root_entry = self._parse_record(pvd[156:190], name=".")
+        assert root_entry is not None
+
+        # Rock Ridge is announced by a "SP" entry in the "." record of the
+        # root directory.
+        first = self._pread(root_entry.extents[0].offset, SECTOR_SIZE)
+        name_len = first[32]
+        sua = first[33 + name_len + (1 - name_len % 2) : first[0]]
+        if sua[:2] == b"SP" and sua[4:6] == b"\xbe\xef":
+            self._susp_skip = sua[6]
+        elif joliet is not None:
+            self._joliet = True
+            root_entry = self._parse_record(joliet[156:190], name=".")
+            assert root_entry is not None
+        else:
+            # Plain ISO9660 names are upper case.
+            self.case_sensitive = False
+        return root_entry
+
+    def _susp_entries(self, sua: bytes) -> typing.Iterator[tuple[bytes, bytes]]:
+        areas = [sua[self._susp_skip :]]
+        continuations = 0
+        while areas:
+            area = areas.pop()
+            i = 0
+            while i + 4 <= len(area):
+                sig = area[i : i + 2]
+                length = area[i + 2]
+                if length < 4:
+                    break
+                body = area[i + 4 : i + length]
+                i += length
+                if sig == b"ST":
+                    break
+                if sig == b"CE" and len(body) >= 24:
+                    continuations += 1
+                    if continuations > _MAX_CONTINUATIONS:
+                        raise ValueError(f"{self.name}: too many SUSP continuations")
+                    areas.append(
+                        self._pread(
+                            _u32(body, 0) * SECTOR_SIZE + _u32(body, 8), _u32(body, 16)
+                        )
+                    )
+                    continue
+                yield sig, body
+
+    def _parse_record(
+        self,
+        rec: bytes,
+        *,
+        name: Optional[str] = None,
+    ) -> Optional[Entry]:
+        # Returns None for records that are not visible in the directory.
+        lba = _u32(rec, 2)
+        size = _u32(rec, 10)
+        flags = rec[25]
+        if rec[26] or rec[27]:
+            raise ValueError(f"{self.name}: interleaved files are not supported")
+        is_dir = bool(flags & 0x02)
+        name_len = rec[32]
+        raw_name = rec[33 : 33 + name_len]
+
+        if name is None:
+            if raw_name in (b"\0", b"\1"):
+                return None
+            if self._susp_skip >= 0:
+                sua = rec[33 + name_len + (1 - name_len % 2) :]
+                nm = b""
+                for sig, body in self._susp_entries(sua):
+                    if sig == b"NM" and body and not body[0] & 0x06:
+                        nm += body[1:]
+                    elif sig == b"RE":
+                        # A relocated directory. It is listed via its "CL"
+                        # entry.
+                        return None
+                    elif sig == b"CL" and len(body) >= 4:
+                        lba = _u32(body, 0)
+                        is_dir = True
+                        dot = self._pread(lba * SECTOR_SIZE, 34)
+                        size = _u32(dot, 10)
+                    elif sig == b"PX" and len(body) >= 4:
+                        if stat.S_ISLNK(_u32(body, 0)):
+                            # Symlinks are not supported (and not needed).
+                            return None
+                if nm:
+                    name = nm.decode(errors="surrogateescape")
+            if name is None:
+                if self._joliet:
+                    name = raw_name.decode("utf-16-be", errors="replace")
+                else:
+                    name = raw_name.decode("ascii", errors="replace")
+                if not is_dir:
+                    name = name.split(";", 1)[0]
+                    if name.endswith("."):
+                        name = name[:-1]
+
+        return Entry(
+            name=name,
+            is_dir=is_dir,
+            size=size,
+            mtime=_iso_time(rec[18:25]),
+            extents=(Extent(offset=lba * SECTOR_SIZE, length=size),),
+        )
+
+    def _read_dir(self, entry: Entry) -> list[Entry]:
+        data = self.read(entry, 0, entry.size)
+        result: list[Entry] = []
+        # The previous records of a multi-extent file.
+        pending: list[Entry] = []
+        pos = 0
+        while pos < len(data):
+            rec_len = data[pos]
+            if rec_len == 0:
+                # Records do not cross sector boundaries.
+                pos = (pos // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            rec = data[pos : pos + rec_len]
+            pos += rec_len
+            if rec_len < 34:
+                raise ValueError(f"{self.name}: corrupt directory {entry.name!r}")
+            e = self._parse_record(rec)
+            if e is None:
+                continue
+            if rec[25] & 0x80:
+                pending.append(e)
+                continue
+            if pending:
+                extents = tuple(x for p in pending for x in p.extents) + e.extents
+                e = dataclasses.replace(
+                    e,
+                    name=pending[0].name,
+                    size=sum(x.length for x in extents),
+                    extents=extents,
+                )
+                pending = []
+            result.append(e)
+        return result
+
+
+def _fat_time(date: int, time: int) -> float:
+    if date == 0:
+        return 0.0
+    try:
+        return float(
+            calendar.timegm(
+                (
+                    1980 + (date >> 9),
+                    (date >> 5) & 0x0F,
+                    date & 0x1F,
+                    time >> 11,
+                    (time >> 5) & 0x3F,
+                    (time & 0x1F) * 2,
+                )
+            )
+        )
+    except (ValueError, OverflowError):
+        return 0.0
+
+
+def _lfn_checksum(short_name: bytes) -> int:
+    s = 0
+    for c in short_name:
+        s = (((s & 1) << 7) + (s >> 1) + c) & 0xFF
+    return s
+
+
+class FatImage(ImageFs):
+    """
+    A FAT12/16/32 file system, like the EFI system partition image
+    "images/efiboot.img" in the ISO. It can be nested in another image (at
+    "offset" of the same file). Long file names are supported, and names are
+    case insensitive.
+    """
+
+    def __init__(
+        self,
+        fd: int,
+        *,
+        name: str,
+        offset: int = 0,
+        owns_fd: bool = False,
+        verified: Optional[VerifiedHashes] = None,
+    ) -> None:
+        super().__init__(
+            fd,
+            name=name,
+            case_sensitive=False,
+            owns_fd=owns_fd,
+            verified=verified,
+        )
+        self.offset = offset
+
+        bs = self._pread(offset, 512)
+        if bs[510:512] != b"\x55\xaa":
+            raise ValueError(f"{name}: not a FAT file system")
+        bytes_per_sector = _u16(bs, 11)
+        sectors_per_cluster = bs[13]
+        reserved = _u16(bs, 14)
+        fat_count = bs[16]
+        root_entries = _u16(bs, 17)
+        total_sectors = _u16(bs, 19) or _u32(bs, 32)
+        fat_sectors = _u16(bs, 22) or _u32(bs, 36)
+        if (
+            bytes_per_sector not in (512, 1024, 2048, 4096)
+            or sectors_per_cluster == 0
+            or sectors_per_cluster & (sectors_per_cluster - 1)
+            or fat_count == 0
+            or fat_sectors == 0
+        ):
+            raise ValueError(f"{name}: not a FAT file system")
+
+        root_sectors = (root_entries * 32 + bytes_per_sector - 1) // bytes_per_sector
+        first_data_sector = reserved + fat_count * fat_sectors + root_sectors
+        self._cluster_count = (total_sectors - first_data_sector) // sectors_per_cluster
+        if self._cluster_count < 4085:
+            self._fat_bits = 12
+        elif self._cluster_count < 65525:
+            self._fat_bits = 16
+        else:
+            self._fat_bits = 32
+        self._cluster_size = sectors_per_cluster * bytes_per_sector
+        self._data_offset = offset + first_data_sector * bytes_per_sector
+        self._fat = self._pread(
+            offset + reserved * bytes_per_sector, fat_sectors * bytes_per_sector
+        )
+
+        if self._fat_bits == 32:
+            extents = self._chain(_u32(bs, 44))
+        else:
+            extents = (
+                Extent(
+                    offset=offset
+                    + (reserved + fat_count * fat_sectors) * bytes_per_sector,
+                    length=root_entries * 32,
+                ),
+            )
+        self._root = Entry(
+            name="",
+            is_dir=True,
+            size=sum(e.length for e in extents),
+            mtime=0.0,
+            extents=extents,
+        )
+
+    @staticmethod
+    def from_image(fs: ImageFs, path: str) -> "FatImage":
+        # The FAT file system in file "path" of "fs". The file must be
+        # contiguous. It shares the file of "fs", and holds a reference on it.
+        entry = fs.lookup(path)
+        if entry is None or entry.is_dir:
+            raise FileNotFoundError(f"{fs.name}: {path}")
+        if len(entry.extents) != 1:
+            raise ValueError(f"{fs.name}: {path} is not contiguous")
+        fs.ref()
+        try:
+            fat = FatImage(
+                fs.fd,
+                name=f"{fs.name}:{path}",
+                offset=entry.extents[0].offset,
+                verified=fs.verified,
+            )
+        except BaseException:
+            fs.close()
+            raise
+        fat._parent = fs
+        return fat
+
+    @property
+    def root(self) -> Entry:
+        return self._root
+
+    def _identity(self) -> list[typing.Any]:
+        return [*super()._identity(), self.offset]
+
+    def _next_cluster(self, cluster: int) -> Optional[int]:
+        if self._fat_bits == 12:
+            v = _u16(self._fat, cluster + cluster // 2)
+            v = v >> 4 if cluster & 1 else v & 0xFFF
+            eoc = 0xFF8
+        elif self._fat_bits == 16:
+            v = _u16(self._fat, cluster * 2)
+            eoc = 0xFFF8
+        else:
+            v = _u32(self._fat, cluster * 4) & 0x0FFFFFFF
+            eoc = 0x0FFFFFF8
+        if v >= eoc:
+            return None
+        if v < 2 or v >= self._cluster_count + 2:
+            raise ValueError(f"{self.name}: corrupt cluster chain")
+        return v
+
+    def _chain(self, cluster: int, size: Optional[int] = None) -> tuple[Extent, ...]:
+        # The extents of the cluster chain that starts at "cluster". With
+        # "size", the chain is cut there.
+        extents: list[Extent] = []
+        remaining = size
+        count = 0
+        c: Optional[int] = cluster
+        while c is not None:
+            if remaining is not None and remaining <= 0:
+                break
+            count += 1
+            if c < 2 or count > self._cluster_count:
+                raise ValueError(f"{self.name}: corrupt cluster chain")
+            length = self._cluster_size
+            if remaining is not None:
+                length = min(length, remaining)
+                remaining -= length
+            offset = self._data_offset + (c - 2) * self._cluster_size
+            if extents and extents[-1].offset + extents[-1].length == offset:
+                extents[-1] = Extent(
+                    offset=extents[-1].offset, length=extents[-1].length + length
+                )
+            else:
+                extents.append(Extent(offset=offset, length=length))
+            c = self._next_cluster(c)
+        if remaining:
+            raise ValueError(f"{self.name}: cluster chain shorter than the file")
+        return tuple(extents)
+
+    def _read_dir(self, entry: Entry) -> list[Entry]:
+        data = self.read(entry, 0, entry.size)
+        result: list[Entry] = []
+        lfn: dict[int, str] = {}
+        lfn_checksum = -1
+        for pos in range(0, len(data) - 31, 32):
+            d = data[pos : pos + 32]
+            if d[0] == 0:
+                break
+            if d[0] == 0xE5:
+                lfn = {}
+                continue
+            attr = d[11]
+            if attr & 0x3F == 0x0F:
+                # A long file name part. They come in reverse order.
+                part = (d[1:11] + d[14:26] + d[28:32]).decode(
+                    "utf-16-le", errors="replace"
+                )
+                if d[0] & 0x40:
+                    lfn = {}
+                lfn[d[0] & 0x1F] = part.split("\0", 1)[0]
+                lfn_checksum = d[13]
+                continue
+            short_name = d[:11]
+            long_name = ""
+            if lfn and lfn_checksum == _lfn_checksum(short_name):
+                long_name = "".join(lfn[i] for i in sorted(lfn))
+            lfn = {}
+            if attr & 0x08:
+                # The volume label.
+                continue
+            base = short_name[:8].rstrip(b" ")
+            ext = short_name[8:].rstrip(b" ")
+            if base[:1] == b"\x05":
+                base = b"\xe5" + base[1:]
+            if base in (b".", b".."):
+                continue
+            name = long_name
+            if not name:
+                # Windows NT stores the case of 8.3 names in these flags.
+                b = base.decode("cp437")
+                e = ext.decode("cp437")
+                if d[12] & 0x08:
+                    b = b.lower()
+                if d[12] & 0x10:
+                    e = e.lower()
+                name = f"{b}.{e}" if e else b
+            is_dir = bool(attr & 0x10)
+            cluster = (_u16(d, 20) << 16) | _u16(d, 26)
+            size = _u32(d, 28)
+            extents: tuple[Extent, ...] = ()
+            if cluster != 0:
+                extents = self._chain(cluster, None if is_dir else size)
+            if is_dir:
+                size = sum(e.length for e in extents)
+            elif size > 0 and not extents:
+                raise ValueError(f"{self.name}: file {name!r} has no data")
+            result.append(
+                Entry(
+                    name=name,
+                    is_dir=is_dir,
+                    size=size,
+                    mtime=_fat_time(_u16(d, 24), _u16(d, 22)),
+                    extents=extents,
+                )
+            )
+        return result
+
+
+class Links:
+    """
+    Maps paths, relative to the root directory of a server, to files and
+    directories in images. Like symlinks into a mounted image. The links hold
+    a reference on their images, until close().
+    """
+
+    def __init__(self) -> None:
+        self._links: dict[str, tuple[ImageFs, str]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, path: str, fs: ImageFs, target: str = "") -> None:
+        path = posixpath.normpath("/" + path).strip("/")
+        entry = fs.lookup(target)
+        if entry is None:
+            raise FileNotFoundError(f"{fs.name}: {target}")
+        logger.info(f"iso-image: link {path!r} to {target!r} in {fs.name!r}")
+        with self._lock:
+            self._links = {**self._links, path: (fs.ref(), target)}
+
+    def lookup(self, path: str) -> Optional[tuple[ImageFs, Entry]]:
+        # Returns None if "path" is not in a link. Raises FileNotFoundError
+        # if it is, but does not exist in the image. The caller must close()
+        # the returned image, once it is done reading.
+        path = posixpath.normpath("/" + path).strip("/")
+        parts = path.split("/") if path else []
+        for i in range(len(parts), -1, -1):
+            with self._lock:
+                link = self._links.get("/".join(parts[:i]))
+                if link is None:
+                    continue
+                fs = link[0].ref()
+            try:
+                entry = fs.lookup("/".join([link[1], *parts[i:]]))
+            except BaseException:
+                fs.close()
+                raise
+            if entry is None:
+                fs.close()
+                raise FileNotFoundError(path)
+            return fs, entry
+        return None
+
+    def close(self) -> None:
+        with self._lock:
+            links = self._links
+            self._links = {}
+        for fs, _ in links.values():
+            fs.close()
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import fcntl
+import glob
+import hashlib
+import os
+import re
+import time
+import typing
+
+from collections.abc import Iterator
+from typing import Optional
+
+import common_dpu
+import downloader
+
+from common_dpu import logger
+
+
+DEFAULT_BUDGET = 32 * 1024 * 1024 * 1024
+
+_SIZE_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$", re.IGNORECASE)
+
+
+def store_dir(host_path: str) -> str:
+    return f"{common_dpu.cache_dir(host_path)}/iso-store"
+
+
+def parse_size(s: str) -> int:
+    m = _SIZE_PATTERN.match(s)
+    if not m:
+        raise ValueError(f"invalid size {s!r}")
+    return int(float(m.group(1)) * 1024 ** "_kmgt".index(m.group(2).lower() or "_"))
+
+
+def _format_size(n: int) -> str:
+    if n < 1024:
+        return f"{n}B"
+    val = n / 1024
+    for unit in ("KiB", "MiB", "GiB"):
+        if val < 1024:
+            return f"{val:.1f}{unit}"
+        val /= 1024
+    return f"{val:.1f}TiB"
+
+
+def _sha256_file(filename: str) -> str:
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _remove(filename: str) -> None:
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def _link_replace(src: str, dst: str) -> None:
+    # Make "dst" a hard link to "src", atomically.
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    _remove(tmp)
+    os.link(src, tmp)
+    os.replace(tmp, dst)
+
+
+class IsoStore:
+    """
+    The downloaded ISO images, in "{host_path}/var/cache/marvell-tools/iso-store".
+    Images are stored once per content (SHA-256), even if several URLs
+    point to them. When the images exceed the byte budget, the least recently
+    used ones are deleted. Pinned images are kept.
+
+    The download of each URL (with its downloader state, for revalidation)
+    is a hard link to the image in "images/".
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self._images = f"{directory}/images"
+        self._downloads = f"{directory}/downloads"
+        self._index_filename = f"{directory}/index.json"
+        os.makedirs(self._images, exist_ok=True)
+        os.makedirs(self._downloads, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"IsoStore({self.directory!r})"
+
+    def image_path(self, sha256: str) -> str:
+        return f"{self._images}/{sha256}.iso"
+
+    @contextlib.contextmanager
+    def _locked_index(self) -> Iterator[dict[str, typing.Any]]:
+        # Yields the index, and writes it back. Other processes wait.
+        with open(f"{self.directory}/.lock", "a") as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            index = common_dpu.json_read(self._index_filename)
+            if not isinstance(index, dict) or not isinstance(index.get("images"), dict):
+                index = {"images": {}}
+            yield index
+            common_dpu.json_write_atomic(self._index_filename, index)
+
+    @contextlib.contextmanager
+    def _url_lock(self, filename: str) -> Iterator[None]:
+        lockname = f"{filename}.lock"
+        while True:
+            with open(lockname, "a") as lockf:
+                fcntl.flock(lockf, fcntl.LOCK_EX)
+                try:
+                    if os.stat(lockname).st_ino != os.fstat(lockf.fileno()).st_ino:
+                        # _evict() deleted the lock file meanwhile.
+                        continue
+                except FileNotFoundError:
+                    continue
+                yield
+                return
+
+    def _stored_sha256(self, filename: str) -> Optional[str]:
+        # The SHA-256 of the image that the download "filename" is a hard
+        # link to. Needed for downloads without downloader state (like an
+        # adopted one), so that they are hashed only once.
+        with self._locked_index() as index:
+            for sha256, img in index["images"].items():
+                if os.path.basename(filename) not in img.get("downloads", ()):
+                    continue
+                try:
+                    if os.path.samefile(self.image_path(sha256), filename):
+                        return typing.cast(str, sha256)
+                except FileNotFoundError:
+                    pass
+        return None
+
+    def index(self) -> dict[str, typing.Any]:
+        with self._locked_index() as index:
+            return index
+
+    def budget(self, index: dict[str, typing.Any]) -> int:
+        val = index.get("budget")
+        return val if isinstance(val, int) else DEFAULT_BUDGET
+
+    def budget_set(self, budget: int) -> None:
+        with self._locked_index() as index:
+            index["budget"] = budget
+            self._evict(index)
+
+    def fetch(
+        self,
+        url: str,
+        *,
+        force: bool = False,
+        adopt: Optional[str] = None,
+    ) -> tuple[str, bool]:
+        # Download "url" (or revalidate the existing download), and return
+        # the path of the image and whether it was downloaded. If "adopt"
+        # exists, it is an earlier download of "url" that is moved into the
+        # store.
+        name, ext = os.path.splitext(url[(url.rfind("/") + 1) :])
+        digest = hashlib.sha256(url.encode()).hexdigest()[:8]
+        filename = f"{self._downloads}/{name}.{digest}{ext}"
+
+        if adopt is not None and not os.path.exists(filename):
+            try:
+                os.rename(adopt, filename)
+                logger.info(f"iso-store: adopt {adopt!r}")
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"iso-store: cannot adopt {adopt!r}: {e}")
+
+        with self._locked_index() as index:
+            # Make room. Assume the new image is as large as the current one
+            # of this URL, which is kept in case it is still up to date.
+            current = [
+                (sha256, img.get("size", 0))
+                for sha256, img in index["images"].items()
+                if url in img.get("urls", ())
+            ]
+            self._evict(
+                index,
+                reserve=max((size for _, size in current), default=0),
+                keep=current[0][0] if current else None,
+            )
+
+        # Only one process downloads this URL at a time.
+        with self._url_lock(filename):
+            result = downloader.download(url, filename, force=force)
+            sha256 = (
+                result.sha256 or self._stored_sha256(filename) or _sha256_file(filename)
+            )
+
+            with self._locked_index() as index:
+                path = self.image_path(sha256)
+                if not os.path.exists(path):
+                    os.link(filename, path)
+                elif os.path.samefile(path, filename):
+                    pass
+                elif force and result.downloaded:
+                    # Downloaded again, maybe because the stored image is
+                    # broken. Replace it, also for the other URLs.
+                    logger.info(f"iso-store: replace {path!r} with {url}")
+                    _link_replace(filename, path)
+                    for download in (
+                        index["images"].get(sha256, {}).get("downloads", ())
+                    ):
+                        other = f"{self._downloads}/{download}"
+                        if other != filename and os.path.exists(other):
+                            _link_replace(path, other)
+                else:
+                    # Another URL has the same content. Keep one copy.
+                    logger.info(
+                        f"iso-store: {url} is the same as {path!r}. Deduplicate"
+                    )
+                    _link_replace(path, filename)
+                for img in index["images"].values():
+                    # The URL now has other content.
+                    if url in img.get("urls", ()):
+                        img["urls"].remove(url)
+                img = index["images"].setdefault(sha256, {})
+                img["size"] = result.size
+                img["atime"] = time.time()
+                img.setdefault("pinned", False)
+                img["urls"] = sorted({*img.get("urls", ()), url})
+                img["downloads"] = sorted(
+                    {*img.get("downloads", ()), os.path.basename(filename)}
+                )
+                self._evict(index, keep=sha256)
+        return path, result.downloaded
+
+    def _evict(
+        self,
+        index: dict[str, typing.Any],
+        *,
+        reserve: int = 0,
+        keep: Optional[str] = None,
+        everything: bool = False,
+    ) -> None:
+        # Delete the least recently used images, until they fit into the
+        # budget (minus "reserve" bytes).
+        images = index["images"]
+        budget = self.budget(index) - reserve
+        total = sum(img.get("size", 0) for img in images.values())
+        for sha256, img in sorted(images.items(), key=lambda kv: kv[1].get("atime", 0)):
+            if total <= budget and not everything:
+                break
+            if img.get("pinned") or sha256 == keep:
+                continue
+            logger.info(
+                f"iso-store: delete {sha256[:12]} ({_format_size(img.get('size', 0))}, {', '.join(img.get('urls', ()))})"
+            )
+            for name in img.get("downloads", ()):
+                filename = f"{self._downloads}/{name}"
+                try:
+                    if not os.path.samefile(filename, self.image_path(sha256)):
+                        # The URL was downloaded again, with other content.
+                        continue
+                except FileNotFoundError:
+                    continue
+                _remove(filename)
+                _remove(downloader.state_filename(filename))
+                self._remove_url_lock(filename)
+            _remove(self.image_path(sha256))
+            total -= img.get("size", 0)
+            del images[sha256]
+
+    def _remove_url_lock(self, filename: str) -> None:
+        lockname = f"{filename}.lock"
+        try:
+            with open(lockname, "a") as lockf:
+                try:
+                    fcntl.flock(lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # It is being downloaded right now.
+                    return
+                _remove(lockname)
+        except OSError:
+            pass
+
+    def prune(self, *, everything: bool = False) -> None:
+        with self._locked_index() as index:
+            self._evict(index, everything=everything)
+
+    def find(self, index: dict[str, typing.Any], ident: str) -> list[str]:
+        # The images that match a SHA-256 prefix, URL, file name of the URL
+        # or download name.
+        return [
+            sha256
+            for sha256, img in index["images"].items()
+            if sha256.startswith(ident)
+            or ident in img.get("urls", ())
+            or any(url.endswith(f"/{ident}") for url in img.get("urls", ()))
+            or ident in img.get("downloads", ())
+        ]
+
+    def pin(self, ident: str, pinned: bool = True) -> list[str]:
+        with self._locked_index() as index:
+            found = self.find(index, ident)
+            for sha256 in found:
+                index["images"][sha256]["pinned"] = pinned
+            return found
+
+
+def legacy_files(host_path: str) -> list[str]:
+    # ISO images that older versions of create_iso_file() downloaded.
+    return sorted(glob.glob(f"{host_path}/root/rhel-iso-*"))
+
+
+def cmd_list(args: argparse.Namespace) -> None:
+    store = IsoStore(store_dir(args.host_path))
+    index = store.index()
+    images = index["images"]
+    total = sum(img.get("size", 0) for img in images.values())
+    print(
+        f"{store.directory}: {len(images)} images, {_format_size(total)} of {_format_size(store.budget(index))}"
+    )
+    for sha256, img in sorted(
+        images.items(), key=lambda kv: kv[1].get("atime", 0), reverse=True
+    ):
+        used = time.strftime("%Y-%m-%d %H:%M", time.localtime(img.get("atime", 0)))
+        pinned = "pinned" if img.get("pinned") else ""
+        print(
+            f"{sha256[:12]}  {_format_size(img.get('size', 0)):>9}  {used}  {pinned:6}  {' '.join(img.get('urls', ()))}"
+        )
+    for filename in legacy_files(args.host_path):
+        print(
+            f"{'unmanaged':12}  {_format_size(os.path.getsize(filename)):>9}  {filename}"
+        )
+
+
+def cmd_pin(args: argparse.Namespace) -> None:
+    store = IsoStore(store_dir(args.host_path))
+    found = store.pin(args.image, pinned=(args.command == "pin"))
+    if not found:
+        logger.error_and_exit(f"No image matches {args.image!r}")
+    for sha256 in found:
+        print(f"{args.command} {sha256}")
+
+
+def cmd_prune(args: argparse.Namespace) -> None:
+    store = IsoStore(store_dir(args.host_path))
+    store.prune(everything=args.all)
+    if args.legacy:
+        for filename in legacy_files(args.host_path):
+            logger.info(f"iso-store: delete {filename!r}")
+            _remove(filename)
+
+
+def cmd_budget(args: argparse.Namespace) -> None:
+    store = IsoStore(store_dir(args.host_path))
+    if args.size is not None:
+        try:
+            budget = parse_size(args.size)
+        except ValueError as e:
+            logger.error_and_exit(str(e))
+        store.budget_set(budget)
+    print(_format_size(store.budget(store.index())))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Manage the downloaded ISO images.\n\n"
+        "pxeboot.py keeps the ISO images it downloads in a store. Images with the same content are stored once. "
+        "When the images exceed the budget, the least recently used ones that are not pinned are deleted.",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--host-path",
+        type=str,
+        default="/host",
+        help='Where the host\'s root is mounted. The images are in "{host-path}/var/cache/marvell-tools/iso-store". Defaults to "/host".',
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_list = subparsers.add_parser("list", help="List the images.")
+    parser_list.set_defaults(func=cmd_list)
+
+    for command, help in (
+        ("pin", "Never delete the image."),
+        ("unpin", "Allow to delete the image again."),
+    ):
+        parser_pin = subparsers.add_parser(command, help=help)
+        parser_pin.add_argument(
+            "image",
+            help="The image, as SHA-256 (prefix), URL or file name of the URL.",
+        )
+        parser_pin.set_defaults(func=cmd_pin)
+
+    parser_prune = subparsers.add_parser(
+        "prune", help="Delete images beyond the budget."
+    )
+    parser_prune.add_argument(
+        "--all",
+        action="store_true",
+        help="Delete all images that are not pinned.",
+    )
+    parser_prune.add_argument(
+        "--legacy",
+        action="store_true",
+        help='Also delete the images that older versions downloaded to "/root/rhel-iso-*".',
+    )
+    parser_prune.set_defaults(func=cmd_prune)
+
+    parser_budget = subparsers.add_parser(
+        "budget", help="Show or set the budget for the images."
+    )
+    parser_budget.add_argument(
+        "size",
+        nargs="?",
+        default=None,
+        help=f'The new budget, like "50G". Defaults to {_format_size(DEFAULT_BUDGET)}.',
+    )
+    parser_budget.set_defaults(func=cmd_budget)
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    common_dpu.run_main(main)
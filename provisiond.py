@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+
+import argparse
+import dataclasses
+import json
+import os
+import shlex
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import typing
+
+from typing import Callable
+from typing import Optional
+
+from ktoolbox import common
+
+import common_dpu
+import console_broker
+import fwupdate
+import pxeboot
+import reset
+import timeline
+
+from common_dpu import logger
+
+
+DEFAULT_SOCKET = f"{common_dpu.CONSOLE_BROKER_DIR}/provisiond.sock"
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+JOB_DONE = (JOB_SUCCEEDED, JOB_FAILED)
+
+
+def _timeline_start(host_path: Optional[str], prefix: str) -> timeline.Timeline:
+    filename: Optional[str] = None
+    if host_path is not None:
+        filename = timeline.filename_create(common_dpu.log_dir(host_path), prefix)
+    return timeline.start(filename, finish_at_exit=False)
+
+
+def job_pxeboot(argv: list[str]) -> Optional[str]:
+    ctx = pxeboot.parse_args(argv)
+    if ctx.cfg.prompt:
+        raise ValueError('"--prompt" is not supported by provisiond')
+    tl = _timeline_start(ctx.cfg.host_path, "pxeboot-timeline")
+    try:
+        return " ".join(pxeboot.run(ctx))
+    finally:
+        ctx.ssh_privkey_file_cleanup()
+        tl.finish()
+
+
+def job_fwupdate(argv: list[str]) -> Optional[str]:
+    args = fwupdate.parse_args(argv)
+    if args.prompt:
+        raise ValueError('"--prompt" is not supported by provisiond')
+    tl = _timeline_start(args.host_path, "fwupdate-timeline")
+    try:
+        fwupdate.run(args)
+    finally:
+        tl.finish()
+    return None
+
+
+def job_reset(argv: list[str]) -> Optional[str]:
+    args = reset.parse_args(argv)
+    tl = _timeline_start(None, "reset-timeline")
+    try:
+        reset.run(args)
+    finally:
+        tl.finish()
+    return None
+
+
+# The arguments of a job are the command line arguments of the tool.
+JOB_KINDS: dict[str, Callable[[list[str]], Optional[str]]] = {
+    "pxeboot": job_pxeboot,
+    "fwupdate": job_fwupdate,
+    "reset": job_reset,
+}
+
+
+@dataclasses.dataclass(**common.KW_ONLY_DATACLASS)
+class Job:
+    id: int
+    kind: str
+    args: list[str]
+    state: str = JOB_QUEUED
+    error: Optional[str] = None
+    # For pxeboot, the IP addresses of the installed DPUs (separated by
+    # space).
+    result: Optional[str] = None
+    time_submitted: float = dataclasses.field(default_factory=time.time)
+    time_started: Optional[float] = None
+    time_finished: Optional[float] = None
+
+
+class Provisioner:
+    """
+    Runs the submitted jobs one after the other, in a worker thread of the
+    same process. The services that a job starts (dhcpd, TFTP, HTTP, ...)
+    keep running for the next one, which only swaps their configuration.
+    They are stopped when the process exits (see common_dpu.global_cleanup).
+    """
+
+    def __init__(self, *, keep_count: int = 100) -> None:
+        self.keep_count = keep_count
+        self._cond = threading.Condition()
+        self._jobs: dict[int, Job] = {}
+        self._queue: list[Job] = []
+        self._next_id = 1
+        self._thread = threading.Thread(
+            target=self._run,
+            name="provisiond-worker",
+            daemon=True,
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _job_dict(self, job: Job) -> dict[str, typing.Any]:
+        with self._cond:
+            return dataclasses.asdict(job)
+
+    def submit(self, kind: str, args: list[str]) -> dict[str, typing.Any]:
+        if kind not in JOB_KINDS:
+            raise ValueError(f"invalid job kind {kind!r}")
+        if not isinstance(args, list) or not all(isinstance(a, str) for a in args):
+            raise ValueError("args must be a list of strings")
+        with self._cond:
+            job = Job(id=self._next_id, kind=kind, args=list(args))
+            self._next_id += 1
+            self._jobs[job.id] = job
+            self._queue.append(job)
+            # Forget the oldest jobs that are done.
+            for old in list(self._jobs.values()):
+                if len(self._jobs) <= self.keep_count:
+                    break
+                if old.state in JOB_DONE:
+                    del self._jobs[old.id]
+            self._cond.notify_all()
+        logger.info(f"provisiond: job {job.id}: queued {kind} {shlex.join(args)}")
+        return self._job_dict(job)
+
+    def _get(self, job_id: int) -> Job:
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise ValueError(f"no job {job_id}")
+        return job
+
+    def status(self, job_id: Optional[int]) -> dict[str, typing.Any]:
+        with self._cond:
+            if job_id is not None:
+                return {"job": dataclasses.asdict(self._get(job_id))}
+            return {"jobs": [dataclasses.asdict(j) for j in self._jobs.values()]}
+
+    def wait(self, job_id: int, timeout: float) -> dict[str, typing.Any]:
+        # Returns the job, once it is done or after "timeout" seconds.
+        with self._cond:
+            job = self._get(job_id)
+            self._cond.wait_for(lambda: job.state in JOB_DONE, timeout)
+            return {"job": dataclasses.asdict(job)}
+
+    def handle(self, msg: dict[str, typing.Any]) -> dict[str, typing.Any]:
+        op = msg.get("op")
+        if op == "submit":
+            return {"job": self.submit(str(msg.get("kind")), msg.get("args", []))}
+        if op == "status":
+            job_id = msg.get("id")
+            return self.status(None if job_id is None else int(job_id))
+        if op == "wait":
+            return self.wait(int(msg["id"]), float(msg.get("timeout", 60.0)))
+        raise ValueError(f"invalid op {op!r}")
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: bool(self._queue))
+                job = self._queue.pop(0)
+                job.state = JOB_RUNNING
+                job.time_started = time.time()
+                self._cond.notify_all()
+            self._run_job(job)
+
+    def _run_job(self, job: Job) -> None:
+        logger.info(
+            f"provisiond: job {job.id}: start {job.kind} {shlex.join(job.args)}"
+        )
+        state = JOB_SUCCEEDED
+        error: Optional[str] = None
+        result: Optional[str] = None
+        try:
+            result = JOB_KINDS[job.kind](job.args)
+        except SystemExit as e:
+            # From argparse or logger.error_and_exit().
+            if e.code not in (None, 0):
+                state = JOB_FAILED
+                error = f"exit status {e.code}"
+        except Exception as e:
+            state = JOB_FAILED
+            error = str(e) or type(e).__name__
+        with self._cond:
+            job.state = state
+            job.error = error
+            job.result = result
+            job.time_finished = time.time()
+            self._cond.notify_all()
+        assert job.time_started is not None
+        logger.info(
+            f"provisiond: job {job.id}: {state} in {job.time_finished - job.time_started:.1f}s"
+            + (f" ({error})" if error is not None else "")
+        )
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: "_Server"
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                msg = json.loads(line)
+                reply = self.server.provisioner.handle(msg)
+            except Exception as e:
+                reply = {"error": str(e)}
+            try:
+                self.wfile.write(json.dumps(reply).encode() + b"\n")
+            except OSError:
+                return
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, provisioner: Provisioner) -> None:
+        self.provisioner = provisioner
+        super().__init__(path, _Handler)
+
+
+def _listen(path: str, provisioner: Provisioner) -> _Server:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(path)
+        except OSError:
+            # Stale socket from an earlier run.
+            os.unlink(path)
+        else:
+            raise RuntimeError(f"provisiond already running on {path}")
+        finally:
+            s.close()
+    server = _Server(path, provisioner)
+    os.chmod(path, 0o660)
+    logger.info(f"provisiond: listening on {path}")
+    return server
+
+
+class Connection:
+    # The control connection to provisiond. Messages are JSON objects, one per
+    # line.
+
+    def __init__(self, path: str = DEFAULT_SOCKET) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except BaseException:
+            self.sock.close()
+            raise
+        self._rfile = self.sock.makefile("rb")
+
+    def close(self) -> None:
+        self._rfile.close()
+        self.sock.close()
+
+    def request(self, msg: dict[str, typing.Any]) -> dict[str, typing.Any]:
+        self.sock.sendall(json.dumps(msg).encode() + b"\n")
+        line = self._rfile.readline()
+        if not line:
+            raise RuntimeError("provisiond closed connection")
+        reply: dict[str, typing.Any] = json.loads(line)
+        if "error" in reply:
+            raise RuntimeError(f"provisiond: {reply['error']}")
+        return reply
+
+
+def _console_broker_start() -> Optional[threading.Thread]:
+    # Own the serial consoles, unless another console broker does.
+    broker = console_broker.Broker()
+    for tty in (common_dpu.TTYUSB0, common_dpu.TTYUSB1):
+        try:
+            broker.add(tty)
+        except RuntimeError as e:
+            logger.info(f"provisiond: {e}")
+    if not broker.consoles:
+        broker.close()
+        return None
+
+    stopping = threading.Event()
+
+    def _run() -> None:
+        try:
+            broker.run(until=stopping.is_set)
+        finally:
+            broker.close()
+
+    thread = threading.Thread(target=_run, name="console-broker", daemon=True)
+    thread.start()
+
+    def _cleanup() -> None:
+        stopping.set()
+        thread.join()
+
+    common_dpu.global_cleanup.add(_cleanup)
+    return thread
+
+
+def serve(args: argparse.Namespace) -> None:
+    # On SIGTERM, stop the services like on CTRL+C.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if not args.no_console_broker:
+        _console_broker_start()
+    provisioner = Provisioner()
+    server = _listen(args.socket, provisioner)
+    try:
+        provisioner.start()
+        server.serve_forever()
+    finally:
+        server.server_close()
+        try:
+            os.unlink(args.socket)
+        except OSError:
+            pass
+
+
+def _job_print(job: dict[str, typing.Any]) -> None:
+    print(json.dumps(job))
+
+
+def submit(args: argparse.Namespace) -> None:
+    conn = Connection(args.socket)
+    try:
+        job = conn.request({"op": "submit", "kind": args.kind, "args": args.args})[
+            "job"
+        ]
+        if args.wait:
+            while job["state"] not in JOB_DONE:
+                job = conn.request({"op": "wait", "id": job["id"], "timeout": 60.0})[
+                    "job"
+                ]
+    finally:
+        conn.close()
+    _job_print(job)
+    if job["state"] == JOB_FAILED:
+        sys.exit(1)
+
+
+def status(args: argparse.Namespace) -> None:
+    conn = Connection(args.socket)
+    try:
+        reply = conn.request({"op": "status", "id": args.id})
+    finally:
+        conn.close()
+    for job in reply["jobs"] if args.id is None else [reply["job"]]:
+        _job_print(job)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Provision the Marvell DPU from a long-running daemon.\n\n"
+        '"serve" runs the jobs of pxeboot.py, fwupdate.py and reset.py one after the other. Unlike the tools, it keeps dhcpd, the TFTP and HTTP servers and the console broker running between jobs. '
+        "Each job only swaps their configuration (the DHCP host entry, the files of the ISO, the kickstart/ignition). "
+        f'"submit" and "status" talk to the daemon via a Unix socket (by default {DEFAULT_SOCKET}).',
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=DEFAULT_SOCKET,
+        help=f"The control socket of the daemon. Defaults to {DEFAULT_SOCKET}.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_serve = subparsers.add_parser("serve", help="Run the daemon.")
+    parser_serve.add_argument(
+        "--no-console-broker",
+        action="store_true",
+        help=f"Don't run a console broker for {common_dpu.TTYUSB0} and {common_dpu.TTYUSB1} (see console_broker.py).",
+    )
+    parser_serve.set_defaults(func=serve)
+
+    parser_submit = subparsers.add_parser(
+        "submit",
+        help='Queue a job, like "submit pxeboot -- --dev eno4 rhel:9.6".',
+    )
+    parser_submit.add_argument(
+        "--wait",
+        action="store_true",
+        help="Wait until the job is done. Exit with failure, if it failed.",
+    )
+    parser_submit.add_argument("kind", choices=list(JOB_KINDS))
+    parser_submit.add_argument(
+        "args",
+        nargs=argparse.REMAINDER,
+        help='The command line arguments of the tool. Use "--" before options.',
+    )
+    parser_submit.set_defaults(func=submit)
+
+    parser_status = subparsers.add_parser("status", help="Show the jobs.")
+    parser_status.add_argument("id", type=int, nargs="?", default=None)
+    parser_status.set_defaults(func=status)
+
+    args = parser.parse_args()
+
+    if args.command == "submit" and args.args[:1] == ["--"]:
+        args.args = args.args[1:]
+
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    common_dpu.run_main(main)
@@ -3,18 +3,22 @@
 import abc
 import argparse
 import collections.abc
+import contextlib
 import dataclasses
 import datetime
 import enum
+import fcntl
+import functools
+import glob
 import itertools
 import json
 import logging
 import os
 import re
 import shlex
-import shutil
 import signal
 import sys
+import threading
 import time
 import types
 import typing
@@ -25,7 +29,23 @@ from ktoolbox import common
 from ktoolbox import host
 from ktoolbox import netdev
 
+import artifact_cache
 import common_dpu
+import cpio_archive
+import dhcp
+import http_server
+import install_progress
+import iso_image
+import readiness
+import resolver_cache
+import serial_capture
+import serial_log
+import ssh_prober
+import ssh_session
+import stage_graph
+import tftp_server
+import timeline
+import vt100
 
 from common_dpu import ESC
 from common_dpu import KEY_UP
@@ -36,12 +56,28 @@ from reset import reset
 
 
 TFTP_PATH = "/var/lib/tftpboot"
-MNT_PATH = "/mnt/marvell_dpu_iso"
 WWW_PATH = "/www"
 
+# The UEFI setup browser draws the selected menu entry white on black. See
+# also "line_pattern" in uefi_boot_menu_process().
+UEFI_MENU_HIGHLIGHT = vt100.Attr(fg=vt100.WHITE, bg=vt100.BLACK)
+UEFI_MENU_START_MARKER = "UEFI Misc Device"
+UEFI_MENU_PXE_PATTERN = re.compile("^UEFI PXEv4 \\(MAC:([0-9a-fA-F]{12})\\)$")
+# The firmware clears the menu and prints this, once it starts a PXE entry.
+UEFI_PXE_START_PATTERN = re.compile(">>Start PXE over IPv4")
+
 
 _signal_sigusr1_received = False
 
+# The state that outlives one run in the same process (see provisiond.py).
+# The opened ISO images by path, with the (inode, size, mtime) of the file.
+_iso_images: dict[str, tuple[tuple[int, int, int], iso_image.IsoImage]] = {}
+# The (device, persist) that prepare_host() already configured.
+_host_prepared: set[tuple[str, bool]] = set()
+# The DPUs set up dhcpd again, when they scan their MAC addresses again (see
+# dpu_macs_rescan()).
+_setup_dhcp_lock = threading.Lock()
+
 
 def _signal_handler(signum: int, frame: typing.Any) -> None:
     global _signal_sigusr1_received
@@ -69,8 +105,16 @@ class Config:
     console_wait: float = 0.0
     prompt: bool = False
     cfg_dhcp_restricted: str = "auto"
+    dpu_macs_cache: bool = True
+    resolver_ttl: float = resolver_cache.DEFAULT_TTL
+    # The indexes of the DPUs to install (see common_dpu.dpu_get()).
+    dpus: tuple[int, ...] = (0,)
 
     def __post_init__(self) -> None:
+        if not self.dpus or len(set(self.dpus)) != len(self.dpus):
+            raise ValueError("dpus")
+        for index in self.dpus:
+            common_dpu.dpu_get(index)
         if self.yum_repos not in ("none", "rhel-nightly"):
             raise ValueError("yum_repos")
         if self.cfg_host_mode not in ("auto", "rhel", "coreos", "ephemeral"):
@@ -140,6 +184,95 @@ class RunContext(common.ImmutableDataclass):
     def host_mode_persist(self) -> bool:
         return self.host_mode in ("rhel", "coreos")
 
+    @property
+    def dpu(self) -> common_dpu.Dpu:
+        # The serial ports are looked up once per run (see
+        # common_dpu.dpu_get()).
+        index: int = self._field_get(
+            "dpu_index",
+            int,
+            on_missing=lambda: self.cfg.dpus[0],
+        )
+        val: common_dpu.Dpu = self._field_get(
+            "dpu",
+            common_dpu.Dpu,
+            on_missing=lambda: common_dpu.dpu_get(index),
+        )
+        return val
+
+    @property
+    def multi_dpu(self) -> bool:
+        return len(self.cfg.dpus) > 1
+
+    def dpu_contexts(self) -> list["RunContext"]:
+        # One context per DPU to install, starting with this one. The others
+        # share the ISO, the SSH keys and the host setup with this one (see
+        # dpu_shared_copy_from()).
+        def _create() -> list[RunContext]:
+            ctxs = [self]
+            for index in self.cfg.dpus[1:]:
+                ctx = RunContext(cfg=self.cfg)
+                ctx._field_set_once("dpu_index", index)
+                ctxs.append(ctx)
+            return ctxs
+
+        val: list[RunContext] = self._field_get(
+            "dpu_contexts",
+            list,
+            on_missing=_create,
+        )
+        return val
+
+    # The fields that the DPUs of a run share.
+    DPU_SHARED_FIELDS: typing.ClassVar[tuple[str, ...]] = (
+        "host_mode",
+        "ssh_keys",
+        "ssh_privkey_file",
+        "resolver",
+        "verified_hashes",
+        "iso_image",
+        "iso_kind",
+        "artifact_cache",
+        "yum_repo_url_thread",
+    )
+
+    def dpu_shared_copy_from(self, other: "RunContext") -> None:
+        for key in RunContext.DPU_SHARED_FIELDS:
+            val, has = other._field_check(key, object)
+            if has:
+                self._field_set_once(key, val)
+
+    def dpu_stage(self, name: str) -> str:
+        # The name of a stage, that runs once per DPU.
+        if not self.multi_dpu:
+            return name
+        return f"{name}[{self.dpu.name}]"
+
+    def dpu_timeline_set_once(self, tl: timeline.Timeline) -> None:
+        self._field_set_once("dpu_timeline", tl)
+
+    @property
+    def dpu_timeline(self) -> timeline.Timeline:
+        val: timeline.Timeline = self._field_get("dpu_timeline")
+        return val
+
+    @property
+    def grub_cfg_name(self) -> str:
+        # With several DPUs, each gets its own grub.cfg. Grub looks for the
+        # one with the MAC address first.
+        if not self.multi_dpu:
+            return "grub.cfg"
+        dpu_mac, _ = self.dpu_mac_ensure()
+        return f"grub.cfg-01-{dpu_mac.replace(':', '-')}"
+
+    @property
+    def http_config_path(self) -> str:
+        # The kickstart/ignition of the DPU, below WWW_PATH.
+        if not self.multi_dpu:
+            return self.iso_kind.HTTP_CONFIG_PATH
+        dpu_mac, _ = self.dpu_mac_ensure()
+        return f"dpu/{dpu_mac.replace(':', '-')}/{self.iso_kind.HTTP_CONFIG_PATH}"
+
     def ssh_keys_set_once(self, ssh_keys: collections.abc.Iterable[str]) -> None:
         self._field_set_once("ssh_keys", tuple(ssh_keys))
 
@@ -179,6 +312,69 @@ class RunContext(common.ImmutableDataclass):
         except Exception:
             pass
 
+    @property
+    def resolver(self) -> resolver_cache.ResolverCache:
+        val: resolver_cache.ResolverCache = self._field_get(
+            "resolver",
+            on_missing=lambda: resolver_cache.ResolverCache(
+                resolver_cache.cache_filename(self.cfg.host_path),
+                ttl=self.cfg.resolver_ttl,
+            ),
+        )
+        return val
+
+    def yum_repo_url_prefetch(self) -> common.FutureThread[str]:
+        # Look up the yum repository URL in the background, while setting
+        # up other things.
+        th: common.FutureThread[str] = self._field_get(
+            "yum_repo_url_thread",
+            on_missing=lambda: common.FutureThread(
+                lambda th: detect_yum_repo_url(self.iso_image, self.resolver),
+                start=True,
+            ),
+        )
+        return th
+
+    @property
+    def yum_repo_url(self) -> str:
+        val: str = self.yum_repo_url_prefetch().join_and_result()
+        return val
+
+    @property
+    def verified_hashes(self) -> iso_image.VerifiedHashes:
+        val: iso_image.VerifiedHashes = self._field_get(
+            "verified_hashes",
+            on_missing=lambda: iso_image.VerifiedHashes(
+                f"{common_dpu.cache_dir(self.cfg.host_path)}/verified-hashes.json"
+            ),
+        )
+        return val
+
+    def iso_image_set_once(self, iso: iso_image.IsoImage) -> None:
+        self._field_set_once("iso_image", iso)
+
+    def iso_image_close(self) -> None:
+        # Drop the reference of this job. The services hold their own, while
+        # they serve the image.
+        iso, has = self._field_check("iso_image", iso_image.IsoImage)
+        if has:
+            iso.close()
+
+    @property
+    def iso_image(self) -> iso_image.IsoImage:
+        val: iso_image.IsoImage = self._field_get("iso_image")
+        return val
+
+    @property
+    def artifact_cache(self) -> artifact_cache.ArtifactCache:
+        val: artifact_cache.ArtifactCache = self._field_get(
+            "artifact_cache",
+            on_missing=lambda: artifact_cache.ArtifactCache(
+                f"{common_dpu.cache_dir(self.cfg.host_path)}/artifacts"
+            ),
+        )
+        return val
+
     def iso_kind_set_once(self, iso_kind: "IsoKind") -> None:
         self._field_set_once("iso_kind", iso_kind)
 
@@ -190,10 +386,14 @@ class RunContext(common.ImmutableDataclass):
     @property
     def dpu_name(self) -> Optional[str]:
         if self.cfg.dpu_name:
-            return self.cfg.dpu_name
-        if isinstance(self.iso_kind, IsoKindRhel):
-            return "marvell-dpu"
-        return None
+            name = self.cfg.dpu_name
+        elif isinstance(self.iso_kind, IsoKindRhel):
+            name = "marvell-dpu"
+        else:
+            return None
+        if self.multi_dpu:
+            name = f"{name}-{self.dpu.index}"
+        return name
 
     def dpu_mac_ensure(
         self,
@@ -226,6 +426,48 @@ class RunContext(common.ImmutableDataclass):
         )
         return (dpu_macs, in_boot_menu)
 
+    def dpu_macs_load_cached(self) -> bool:
+        # Initialize "dpu_macs" from the persistent cache, if it is not yet
+        # known. Returns True, if "dpu_macs" is now known.
+        val, has = self._field_check("dpu_macs", dict)
+        if has:
+            return True
+        dpu_macs = dpu_macs_cache_load(self)
+        if dpu_macs is None:
+            return False
+        self._field_set_once("dpu_macs_from_cache", True)
+        self._field_set_once("dpu_macs", dpu_macs)
+        return True
+
+    def dpu_macs_set_once(self, dpu_macs: dict[int, str]) -> None:
+        self._field_set_once("dpu_macs", dpu_macs)
+
+    def dpu_macs_replace(self, dpu_macs: dict[int, str]) -> None:
+        # Use the MAC addresses scanned in the boot menu, instead of the
+        # cached ones.
+        self._field_set("dpu_macs", dpu_macs, valtype=dict, allow_exists=True)
+        self._field_set("dpu_macs_from_cache", False, valtype=bool, allow_exists=True)
+        val, has = self._field_check("dpu_mac", str)
+        if has:
+            dpu_mac, _ = detect_dpu_mac(self, reuse_serial_context=False)
+            self._field_set("dpu_mac", dpu_mac, valtype=str, allow_exists=True)
+
+    def boot_menu_parked_set(self) -> None:
+        self._field_set("boot_menu_parked", True, valtype=bool, allow_exists=True)
+
+    def boot_menu_parked_take(self) -> bool:
+        # Whether the DPU waits in the boot menu (see uefi_park_in_boot_menu()).
+        # Only the first boot attempt can use that.
+        val, had = self._field_set(
+            "boot_menu_parked", False, valtype=bool, allow_exists=True
+        )
+        return bool(val)
+
+    @property
+    def dpu_macs_from_cache(self) -> bool:
+        val, has = self._field_check("dpu_macs_from_cache", bool)
+        return has and bool(val)
+
     def dhcp_restricted_ensure(self) -> bool:
         return self._field_init_once(
             "dhcp_restricted",
@@ -233,12 +475,34 @@ class RunContext(common.ImmutableDataclass):
             valtype=bool,
         )
 
+    def uefi_screen_reset(self) -> vt100.Screen:
+        screen = vt100.Screen()
+        self._field_set("uefi_screen", screen, allow_exists=True)
+        return screen
+
+    @property
+    def uefi_screen(self) -> vt100.Screen:
+        val: vt100.Screen = self._field_get(
+            "uefi_screen",
+            vt100.Screen,
+            on_missing=vt100.Screen,
+        )
+        return val
+
     def serial_create(self) -> common.Serial:
 
         ser, was_created = self._field_get_or_create(
             "serial",
             common.Serial,
-            on_missing=lambda: create_serial(host_path=self.cfg.host_path),
+            on_missing=lambda: create_serial(
+                host_path=self.cfg.host_path,
+                tty=self.dpu.tty0,
+                capture_prefix=(
+                    f"pxeboot-serial-{self.dpu.name}"
+                    if self.multi_dpu
+                    else "pxeboot-serial"
+                ),
+            ),
         )
 
         if not was_created:
@@ -315,7 +579,7 @@ interface-name={ifname}
 
 [ipv4]
 method=auto
-address1={common_dpu.dpu_ip4addrnet},{common_dpu.host_ip4addr}
+address1={ctx.dpu.ip4addrnet},{common_dpu.host_ip4addr}
 dhcp-timeout=2147483647
 route-metric=120
 
@@ -370,13 +634,18 @@ class IsoKind(abc.ABC):
     NAME: typing.ClassVar[str]
     CHECK_FILES: typing.ClassVar[tuple[str, ...]]
     DHCP_PXE_FILENAME: typing.ClassVar[str]
+    # The grub.cfg template (see setup_grub_cfg()).
+    GRUB_CFG: typing.ClassVar[str]
+    # The kickstart or ignition below WWW_PATH, that the installer fetches.
+    # With several DPUs, see RunContext.http_config_path.
+    HTTP_CONFIG_PATH: typing.ClassVar[str]
     SSH_USER: typing.ClassVar[str] = "root"
 
     @staticmethod
     def detect_from_iso(
         *,
+        iso: Optional[iso_image.IsoImage],
         cfg_iso_kind: Optional[str] = None,
-        check_mount: bool = True,
         read_check: bool = False,
     ) -> Optional["IsoKind"]:
         if cfg_iso_kind:
@@ -390,12 +659,8 @@ class IsoKind(abc.ABC):
             if not is_auto and iso_kind.NAME != cfg_iso_kind:
                 continue
 
-            if check_mount:
-                if not common_dpu.check_files(
-                    iso_kind.CHECK_FILES,
-                    cwd=MNT_PATH,
-                    read_check=read_check,
-                ):
+            if iso is not None:
+                if not iso.check_files(iso_kind.CHECK_FILES, read_check=read_check):
                     continue
             else:
                 if is_auto:
@@ -409,10 +674,10 @@ class IsoKind(abc.ABC):
         return self.NAME
 
     @abc.abstractmethod
-    def setup_tftp_files(self) -> None:
+    def setup_tftp_files(self, ctx: RunContext, links: iso_image.Links) -> None:
         pass
 
-    def mount_nested_iso(self) -> None:
+    def check_iso(self, iso: iso_image.IsoImage) -> None:
         pass
 
     @abc.abstractmethod
@@ -429,16 +694,13 @@ class IsoKindRhel(IsoKind):
         "media.repo",
     )
     DHCP_PXE_FILENAME = "/grubaa64.efi"
+    GRUB_CFG = "manifests/pxeboot/grub.cfg.rhel"
+    HTTP_CONFIG_PATH = "kickstart.ks"
 
-    def setup_tftp_files(self) -> None:
-        shutil.copy(f"{MNT_PATH}/images/pxeboot/vmlinuz", f"{TFTP_PATH}/pxelinux")
-        shutil.copy(f"{MNT_PATH}/images/pxeboot/initrd.img", f"{TFTP_PATH}/pxelinux")
-        shutil.copy(f"{MNT_PATH}/EFI/BOOT/grubaa64.efi", f"{TFTP_PATH}/")
-        os.chmod(f"{TFTP_PATH}/grubaa64.efi", 0o744)
-        shutil.copy(
-            common_dpu.packaged_file("manifests/pxeboot/grub.cfg.rhel"),
-            f"{TFTP_PATH}/grub.cfg",
-        )
+    def setup_tftp_files(self, ctx: RunContext, links: iso_image.Links) -> None:
+        links.add("pxelinux/vmlinuz", ctx.iso_image, "images/pxeboot/vmlinuz")
+        links.add("pxelinux/initrd.img", ctx.iso_image, "images/pxeboot/initrd.img")
+        links.add("grubaa64.efi", ctx.iso_image, "EFI/BOOT/grubaa64.efi")
 
     def setup_http_files(self, ctx: RunContext) -> None:
         with open(common_dpu.packaged_file("manifests/pxeboot/kickstart.ks"), "r") as f:
@@ -463,7 +725,7 @@ class IsoKindRhel(IsoKind):
             nm_conf_unmanaged_devices(),
         )
         kickstart = kickstart.replace(
-            "@__YUM_REPO_URL__@", shlex.quote(detect_yum_repo_url())
+            "@__YUM_REPO_URL__@", shlex.quote(ctx.yum_repo_url)
         )
         kickstart = kickstart.replace(
             "@__YUM_REPO_ENABLED__@",
@@ -497,8 +759,10 @@ class IsoKindRhel(IsoKind):
         for ks_lines in kickstart.splitlines(keepends=True):
             logger.info(f"kickstart: {repr(ks_lines)}")
 
-        with open(f"{WWW_PATH}/kickstart.ks", "w") as f:
-            f.write(kickstart)
+        filename = f"{WWW_PATH}/{ctx.http_config_path}"
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        cache = ctx.artifact_cache
+        cache.stage(cache.put_bytes(kickstart.encode()), filename)
 
 
 class IsoKindRhcos(IsoKind):
@@ -511,69 +775,57 @@ class IsoKindRhcos(IsoKind):
         "images/pxeboot/vmlinuz",
     )
     DHCP_PXE_FILENAME = "/BOOTAA64.EFI"
+    GRUB_CFG = "manifests/pxeboot/grub.cfg.rhcos"
+    HTTP_CONFIG_PATH = "ign/config.ign"
     SSH_USER = "core"
 
-    MNT_EFIBOOT_PATH = "/mnt/efiboot"
+    EFIBOOT_IMG = "images/efiboot.img"
 
-    def mount_nested_iso(self) -> None:
-        success = common_dpu.mount_iso(
-            f"{MNT_PATH}/images/efiboot.img",
-            mount_path=IsoKindRhcos.MNT_EFIBOOT_PATH,
-        )
-        if not success:
+    @staticmethod
+    def efiboot_open(iso: iso_image.IsoImage) -> iso_image.FatImage:
+        return iso_image.FatImage.from_image(iso, IsoKindRhcos.EFIBOOT_IMG)
+
+    def check_iso(self, iso: iso_image.IsoImage) -> None:
+        try:
+            efiboot = self.efiboot_open(iso)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failure to open {IsoKindRhcos.EFIBOOT_IMG} in ISO: {e}")
+            raise RuntimeError("Failure to open efiboot image")
+        with efiboot:
+            ok = efiboot.check_files(
+                [
+                    "EFI/BOOT/BOOTAA64.EFI",
+                    "EFI/BOOT/grubaa64.efi",
+                ],
+                read_check=True,
+            )
+        if not ok:
             logger.error(
-                f"Failure to mount {MNT_PATH}/images/efiboot.img on {IsoKindRhcos.MNT_EFIBOOT_PATH}"
+                f"Cannot find expected files in {IsoKindRhcos.EFIBOOT_IMG} in ISO"
             )
-            raise RuntimeError("Failure to mount efiboot image")
-        if not common_dpu.check_files(
-            [
-                "EFI/BOOT/BOOTAA64.EFI",
-                "EFI/BOOT/grubaa64.efi",
-            ],
-            cwd=IsoKindRhcos.MNT_EFIBOOT_PATH,
-            read_check=True,
-        ):
-            logger.error(f"Cannot find expected files in {MNT_PATH}/images/efiboot.img")
             raise RuntimeError("Cannot find expected files in efiboot image")
 
-    def setup_tftp_files(self) -> None:
-        shutil.copy(f"{MNT_PATH}/images/pxeboot/vmlinuz", f"{TFTP_PATH}/pxelinux")
-        shutil.copy(f"{MNT_PATH}/images/pxeboot/initrd.img", f"{TFTP_PATH}/pxelinux")
-        shutil.copy(
-            f"{IsoKindRhcos.MNT_EFIBOOT_PATH}/EFI/BOOT/BOOTAA64.EFI",
-            f"{TFTP_PATH}/",
-        )
-        shutil.copy(
-            f"{IsoKindRhcos.MNT_EFIBOOT_PATH}/EFI/BOOT/grubaa64.efi",
-            f"{TFTP_PATH}/",
-        )
-        shutil.copy(
-            common_dpu.packaged_file("manifests/pxeboot/grub.cfg.rhcos"),
-            f"{TFTP_PATH}/grub.cfg",
-        )
+    def setup_tftp_files(self, ctx: RunContext, links: iso_image.Links) -> None:
+        links.add("pxelinux/vmlinuz", ctx.iso_image, "images/pxeboot/vmlinuz")
+        links.add("pxelinux/initrd.img", ctx.iso_image, "images/pxeboot/initrd.img")
+        with self.efiboot_open(ctx.iso_image) as efiboot:
+            links.add("BOOTAA64.EFI", efiboot, "EFI/BOOT/BOOTAA64.EFI")
+            links.add("grubaa64.efi", efiboot, "EFI/BOOT/grubaa64.efi")
 
     def setup_http_files(self, ctx: RunContext) -> None:
-        ign_dir = f"{WWW_PATH}/ign"
-        shutil.rmtree(ign_dir, ignore_errors=True)
-        os.makedirs(ign_dir)
-        ign_img = f"{MNT_PATH}/images/ignition.img"
-        host.local.run(
-            [
-                "bash",
-                "-e",
-                "-o",
-                "pipefail",
-                "-c",
-                f"gzip -dc {shlex.quote(ign_img)} | cpio -idmv && test -f ./config.ign",
-            ],
-            cwd=ign_dir,
-            die_on_error=True,
-        )
+        ign_dir = os.path.dirname(f"{WWW_PATH}/{ctx.http_config_path}")
+        os.makedirs(ign_dir, exist_ok=True)
+        cache = ctx.artifact_cache
 
-        ign_filename = f"{ign_dir}/config.ign"
-
-        with open(ign_filename, "r") as f:
-            ign = json.load(f)
+        # Only config.ign is needed. Reading stops, once it is found.
+        try:
+            with ctx.iso_image.open("images/ignition.img") as f:
+                ign_data = cpio_archive.read_file(f, "config.ign")
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"Failure to read images/ignition.img from ISO: {e}")
+        if ign_data is None:
+            raise RuntimeError("No config.ign in images/ignition.img of ISO")
+        ign = json.loads(ign_data)
 
         ign["passwd"]["users"] = [
             {
@@ -619,10 +871,15 @@ class IsoKindRhcos(IsoKind):
         for line in ign_json.splitlines(keepends=True):
             logger.info(f"ignition: {repr(line)}")
 
-        common.json_dump(ign, ign_filename)
+        cache.stage(cache.put_bytes(ign_json.encode()), f"{ign_dir}/config.ign")
+        # The same, as initrd that can be appended to the one from the ISO.
+        cache.stage(
+            cache.put_bytes(cpio_archive.write([("config.ign", ign_json.encode())])),
+            f"{ign_dir}/ignition.img",
+        )
 
 
-def parse_args() -> RunContext:
+def parse_args(argv: Optional[list[str]] = None) -> RunContext:
     parser = argparse.ArgumentParser(description="Process ISO file.")
     parser.add_argument(
         "iso",
@@ -666,6 +923,12 @@ def parse_args() -> RunContext:
         default=Config.yum_repos,
         help='We generate "/etc/yum.repos.d/marvell-tools-beaker.repo" with latest RHEL9 nightly compose. However, that repo is disabled unless "--yum-repos=rhel-nightly".',
     )
+    parser.add_argument(
+        "--resolver-ttl",
+        type=float,
+        default=Config.resolver_ttl,
+        help='How many seconds to reuse the URLs of the latest RHEL compose for "--iso=rhel:" and of the yum repository, before looking them up again. After that, the old URLs are still used for a day, but refreshed in the background. Set to 0 to always look them up (the old URLs are then only used if the lookup fails).',
+    )
     parser.add_argument(
         "--host-mode",
         choices=["auto", "rhel", "coreos", "ephemeral"],
@@ -689,7 +952,7 @@ def parse_args() -> RunContext:
         "--console-wait",
         type=float,
         default=Config.console_wait,
-        help='After installation is started, the tool will stay connected to the serial port for the specified amount of time. The benefit is that we see what happens in the output of the tool. The downside is that we cannot attach a second terminal to the serial port during that time. Defaults to 0 which means to stay connected until the program ends. You can force a close of the serial port by sending SIGUSR1 to the process. The console output is also written to "{host-path}/tmp/pxeboot-serial.*.log".',
+        help='After installation is started, the tool will stay connected to the serial port for the specified amount of time. The benefit is that we see what happens in the output of the tool. The downside is that we cannot attach a second terminal to the serial port during that time. Defaults to 0 which means to stay connected until the program ends. You can force a close of the serial port by sending SIGUSR1 to the process. The console output is also written to "{host-path}/var/log/marvell-tools/pxeboot-serial.*.log.gz". If "console_broker.py serve" runs, the serial port is shared and you can attach with "console_broker.py attach" at any time.',
     )
     parser.add_argument(
         "--nm-secondary-cloned-mac-address",
@@ -738,6 +1001,19 @@ def parse_args() -> RunContext:
         action="store_true",
         help="If true, install additional default packages during kickstart. See '@__DEFAULT_EXTRA_PACKAGES__@' in \"manifests/pxeboot/kickstart.ks\".",
     )
+    parser.add_argument(
+        "--no-dpu-macs-cache",
+        action="store_false",
+        dest="dpu_macs_cache",
+        default=Config.dpu_macs_cache,
+        help='The MAC addresses from the DPU\'s boot menu are remembered in "{host-path}/var/cache/marvell-tools/dpu-macs.json", for the USB serial adapter of the DPU\'s console. With the cache, "--dpu-dev" does not require an extra reset to find the MAC address. If booting fails or the boot menu shows other MAC addresses, they are detected again. Use this flag to always detect the MAC addresses.',
+    )
+    parser.add_argument(
+        "--dpu",
+        type=int,
+        action="append",
+        help='The DPU to install, if several are attached to the host. DPU 0 uses the serial ports /dev/ttyUSB0 and /dev/ttyUSB1, DPU N (from 1) the Nth other USB serial adapter, in the order of the USB ports (see /dev/serial/by-path). DPU N gets the address 172.131.100.{100+N}. Repeat the option to install several DPUs at the same time. They share the DHCP, TFTP and HTTP services, and each gets its own grub.cfg (for its MAC address), kickstart/ignition, host name (with suffix "-N"), log file and timeline. That requires stable MAC addresses. Defaults to 0.',
+    )
     parser.add_argument(
         "--dhcp-restricted",
         choices=["auto", "yes", "no"],
@@ -745,7 +1021,7 @@ def parse_args() -> RunContext:
         help='Control whether the DHCP server restricts requests to a specific MAC address. With "yes", the DHCP server only responds to the specific DPU MAC address that was detected, which is useful when running on a network with an existing DHCP server. With "no", the DHCP server responds to any PXEClient on the network. With "auto" (the default), the behavior is determined automatically based on the well known MAC address that shows up in the Marvell DPU\'s UEFI boot menu when the MAC address is not stable.',
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     try:
         dpu_dev = Config.validate_dpu_dev(args.dpu_dev)
@@ -754,6 +1030,19 @@ def parse_args() -> RunContext:
             'The dpu-dev is invalid. Must be "primary", "secondary" or a MAC address or a number'
         )
 
+    dpus = tuple(args.dpu or (0,))
+    if len(set(dpus)) != len(dpus) or not all(
+        0 <= index < common_dpu.DPU_MAX for index in dpus
+    ):
+        parser.error(
+            f"The dpu is invalid. Must be distinct numbers below {common_dpu.DPU_MAX}"
+        )
+    if len(dpus) > 1:
+        if netdev.validate_ethaddr_or_none(dpu_dev) is not None:
+            parser.error("The dpu-dev cannot be a MAC address with several DPUs")
+        if args.dhcp_restricted == "no":
+            parser.error('The dhcp-restricted cannot be "no" with several DPUs')
+
     cfg = Config(
         dpu_name=args.dpu_name,
         iso=args.iso,
@@ -774,6 +1063,9 @@ def parse_args() -> RunContext:
         console_wait=args.console_wait,
         prompt=args.prompt,
         cfg_dhcp_restricted=args.dhcp_restricted,
+        dpu_macs_cache=args.dpu_macs_cache,
+        resolver_ttl=args.resolver_ttl,
+        dpus=dpus,
     )
 
     if not common_dpu.check_files(
@@ -804,6 +1096,100 @@ def is_marvell_random_mac(mac: str) -> bool:
     return bool(re.search("^80:aa:99:88:77:6[67]$", mac))
 
 
+class DpuMacsStaleError(RuntimeError):
+    pass
+
+
+def dpu_macs_cache_key(ctx: RunContext) -> Optional[str]:
+    if not ctx.cfg.dpu_macs_cache:
+        return None
+    return common_dpu.serial_usb_id(ctx.dpu.tty0)
+
+
+def dpu_macs_cache_file(ctx: RunContext) -> str:
+    return f"{common_dpu.cache_dir(ctx.cfg.host_path)}/dpu-macs.json"
+
+
+def dpu_macs_cache_load(ctx: RunContext) -> Optional[dict[int, str]]:
+    key = dpu_macs_cache_key(ctx)
+    if key is None:
+        return None
+    data = common_dpu.json_read(dpu_macs_cache_file(ctx))
+    if not isinstance(data, dict):
+        data = {}
+    try:
+        dpu_macs = {
+            int(devidx): netdev.validate_ethaddr(mac)
+            for devidx, mac in data[key]["dpu_macs"].items()
+        }
+    except Exception:
+        logger.info(f"dpu-macs-cache: no MAC addresses cached for {key!r}")
+        return None
+    if not dpu_macs:
+        return None
+    logger.info(f"dpu-macs-cache: use cached MAC addresses {dpu_macs} for {key!r}")
+    return dpu_macs
+
+
+def dpu_macs_cache_store(ctx: RunContext, dpu_macs: Optional[dict[int, str]]) -> None:
+    # Remember the "dpu_macs" or, with None, drop the cache entry.
+    key = dpu_macs_cache_key(ctx)
+    if key is None:
+        return
+    filename = dpu_macs_cache_file(ctx)
+    # With several "--dpu", they update the file at the same time.
+    with open(f"{filename}.lock", "a") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        data = common_dpu.json_read(filename)
+        if not isinstance(data, dict):
+            data = {}
+        if dpu_macs is None:
+            if data.pop(key, None) is None:
+                return
+            logger.info(f"dpu-macs-cache: drop cached MAC addresses for {key!r}")
+        else:
+            data[key] = {
+                "dpu_macs": {str(devidx): mac for devidx, mac in dpu_macs.items()},
+                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            }
+            logger.info(f"dpu-macs-cache: store MAC addresses {dpu_macs} for {key!r}")
+        common_dpu.json_write_atomic(filename, data)
+
+
+def dpu_macs_cache_verify(ctx: RunContext) -> Optional[dict[int, str]]:
+    # We used the MAC addresses from the cache and are now in the boot menu.
+    # Check that they still match. If not, remember and return the ones from
+    # the boot menu.
+    if not ctx.dpu_macs_from_cache:
+        return None
+    boot_menu = uefi_boot_menu_detect(ctx)
+    if boot_menu is None:
+        return None
+    dpu_macs, _ = ctx.dpu_macs_ensure()
+    if boot_menu.dpu_macs == dpu_macs:
+        return None
+    logger.warning(
+        f"dpu-macs-cache: the cached MAC addresses {dpu_macs} don't match the boot menu {boot_menu.dpu_macs}"
+    )
+    dpu_macs_cache_store(ctx, boot_menu.dpu_macs)
+    return boot_menu.dpu_macs
+
+
+def dpu_macs_rescan(ctx: RunContext, dpu_ctx: RunContext) -> None:
+    # Scan the MAC addresses in the boot menu, instead of using the cached
+    # ones. Then update what depends on the MAC address of the DPU: the DHCP
+    # host entry, its grub.cfg and its kickstart/ignition. The DPU waits in
+    # the boot menu for the next boot.
+    with dpu_ctx.serial_open():
+        dpu_macs = uefi_enter_boot_menu_and_detect_dpu_macs(dpu_ctx)
+    dpu_ctx.dpu_macs_replace(dpu_macs)
+    dpu_ctx.boot_menu_parked_set()
+    with _setup_dhcp_lock:
+        setup_dhcp(ctx)
+    setup_grub_cfg(dpu_ctx)
+    dpu_ctx.iso_kind.setup_http_files(dpu_ctx)
+
+
 def detect_dhcp_restricted(ctx: RunContext) -> bool:
     if ctx.cfg.cfg_dhcp_restricted != "auto":
         return common.str_to_bool(ctx.cfg.cfg_dhcp_restricted)
@@ -828,24 +1214,17 @@ def detect_host_mode(*, host_path: str, iso_kind: Optional[IsoKind]) -> str:
     return "coreos"
 
 
-def ssh_cmd(ctx: RunContext, host_ip: str, *args: str) -> list[str]:
-    return [
-        "ssh",
-        "-i",
-        ctx.ssh_privkey_file,
-        "-o",
-        "StrictHostKeyChecking=no",
-        "-o",
-        "UserKnownHostsFile=/dev/null",
-        "-o",
-        "LogLevel=QUIET",
-        f"{ctx.iso_kind.SSH_USER}@{host_ip}",
-        *args,
-    ]
+def dpu_ssh(ctx: RunContext, host_ip: str) -> ssh_session.Session:
+    # All commands to the DPU share one SSH connection.
+    return ssh_session.get(
+        host_ip,
+        user=ctx.iso_kind.SSH_USER,
+        key_filename=ctx.ssh_privkey_file,
+    )
 
 
 def ssh_get_ipaddrs(ctx: RunContext, *, host_ip: str) -> Optional[list[str]]:
-    ret = host.local.run(ssh_cmd(ctx, host_ip, "hostname", "-I"))
+    ret = dpu_ssh(ctx, host_ip).run(["hostname", "-I"])
     if not ret:
         return []
     host_ips = set(ret.out.split())
@@ -853,46 +1232,26 @@ def ssh_get_ipaddrs(ctx: RunContext, *, host_ip: str) -> Optional[list[str]]:
     return sorted(host_ips)
 
 
-def check_ip_is_ready(ctx: RunContext, ips: list[str]) -> tuple[Optional[str], bool]:
-    ip = netdev.wait_ping(*ips)
-    if ip is None:
-        return None, False
-
-    ret = host.local.run(
-        ssh_cmd(ctx, ip, "uptime"),
+def ssh_is_ready(ctx: RunContext, host_ip: str) -> bool:
+    ret = dpu_ssh(ctx, host_ip).run(
+        ["uptime"],
         log_level_result=logging.DEBUG,
     )
-    if not ret:
-        return ip, False
-
-    return ip, True
-
-
-def check_host_is_booted(ctx: RunContext) -> Optional[str]:
-    ips_unique = set(common_dpu.DPU_DHCPRANGE)
-    ips_unique.discard(common_dpu.dpu_ip4addr)
-    ips = [common_dpu.dpu_ip4addr] + sorted(ips_unique)
-
-    while True:
-        ip, is_ready = check_ip_is_ready(ctx, ips)
-
-        if ip is None:
-            # No IP address is ready at all.
-            return None
-
-        if is_ready:
-            # This IP address is ready.
-            if ip != common_dpu.dpu_ip4addr:
-                # Just re-check, whether our static IP addess would also be
-                # ready and prefer that instead.
-                ip2, is_ready2 = check_ip_is_ready(ctx, [common_dpu.dpu_ip4addr])
-                if is_ready2:
-                    return ip2
-            return ip
-
-        # This IP address replied to pings, but is not ready. Retry, but
-        # without this IP.
-        ips.remove(ip)
+    return bool(ret)
+
+
+def create_boot_prober(ctx: RunContext) -> ssh_prober.BootProber:
+    # The static IP address comes first, so that it is preferred when the
+    # DPU also still has an address of the DHCP range. With several DPUs, an
+    # address of the DHCP range could be any of them. Only the static IP
+    # address tells them apart.
+    ips = [ctx.dpu.ip4addr]
+    if not ctx.multi_dpu:
+        ips.extend(sorted(set(common_dpu.DPU_DHCPRANGE) - {ctx.dpu.ip4addr}))
+    return ssh_prober.BootProber(
+        ips,
+        ready=lambda ip: ssh_is_ready(ctx, ip),
+    )
 
 
 def wait_for_boot(ctx: RunContext) -> str:
@@ -900,8 +1259,22 @@ def wait_for_boot(ctx: RunContext) -> str:
     has_ser = True
     time_start = time.monotonic()
     timeout = max(ctx.cfg.console_wait + 100.0, 1800.0)
-    logger.info(f"Wait for boot and IP address {common_dpu.dpu_ip4addr}")
-    sleep_time = 60
+    logger.info(f"Wait for boot and IP address {ctx.dpu.ip4addr}")
+    # Record when the boot milestones show up on the console.
+    milestones = serial_log.MilestoneWatcher()
+    if isinstance(ser, common_dpu.ConsoleBrokerSerial):
+        # We only watch the output from now on. Let others (minicom) type.
+        ser.keyboard_release()
+    prober = create_boot_prober(ctx)
+    dpu_mac, _ = ctx.dpu_mac_ensure()
+    progress = install_progress.InstallProgress(
+        host_ip=common_dpu.host_ip4addr,
+        config_path=ctx.http_config_path,
+        dpu_mac=dpu_mac,
+        # With several DPUs, the DHCP server gives each its static address.
+        client_ip=ctx.dpu.ip4addr if ctx.multi_dpu else None,
+    )
+    time_poll: Optional[float] = None
     while True:
 
         if has_ser and (
@@ -914,6 +1287,11 @@ def wait_for_boot(ctx: RunContext) -> str:
             logger.info(f"Closing serial console {ser.port}")
             has_ser = False
             ser.close()
+            timeline.mark("serial-closed")
+
+        # Our DHCP, TFTP and HTTP services see how far the DPU got. A stuck
+        # boot raises an error, so that it can be retried.
+        progress.update()
 
         # We rely on configuring a static IP address on the installed host.
         #
@@ -924,50 +1302,185 @@ def wait_for_boot(ctx: RunContext) -> str:
         # then we wouldn't easily know whether the installer is still running
         # or installation completed with successful. To find the static IP
         # address quite reliably tells us that the host is up.
-        ip = check_host_is_booted(ctx)
-        if ip is not None:
-            logger.info(f"got response from {ip}")
-            return ip
+        if (
+            time_poll is None
+            or time.monotonic() >= time_poll + progress.poll_interval()
+        ):
+            time_poll = time.monotonic()
+            ip = prober.poll()
+            if ip is not None:
+                logger.info(f"got response from {ip}")
+                timeline.mark("dpu-reachable", ip=ip)
+                return ip
 
         if time.monotonic() > time_start + timeout:
             raise RuntimeError(
-                f"Failed to detect booted Marvell DPU on {common_dpu.dpu_ip4addr} or DHCP range"
+                f"Failed to detect booted Marvell DPU on {ctx.dpu.ip4addr} or DHCP range"
             )
 
+        # Wait until the next poll, but check the progress at least every 2
+        # seconds.
+        wait_end_time = min(
+            time_poll + progress.poll_interval(),
+            time.monotonic() + ssh_prober.DEFAULT_INTERVAL,
+        )
         if has_ser:
             # Read and log the output for a bit longer. This way, we see how the
             # DPU starts installation.
-            sleep_end_time = time.monotonic() + sleep_time
             while (
-                (now := time.monotonic()) < sleep_end_time
+                (now := time.monotonic()) < wait_end_time
             ) and not _signal_sigusr1_received:
-                ser.sleep(min(2.0, sleep_end_time - now))
+                ser.sleep(min(2.0, wait_end_time - now))
+                for name in milestones.feed(ser.read_all()):
+                    timeline.mark(f"console-{name}")
         else:
-            time.sleep(sleep_time)
+            time.sleep(max(0.0, wait_end_time - time.monotonic()))
 
-        sleep_time = max(int(sleep_time / 1.3), 9)
 
-
-def create_serial(*, host_path: str) -> common.Serial:
-    # We also write the data from the serial port to "{host_path}/tmp/pxeboot-serial-*.log"
+def create_serial(*, host_path: str, tty: str, capture_prefix: str) -> common.Serial:
+    # We also write the data from the serial port to "{host_path}/var/log/marvell-tools/pxeboot-serial.*.log.gz"
     # on the host. For debugging, you can find what was written there.
-    log_stream_filename = (
-        f"{host_path}/tmp/pxeboot-serial.{datetime.datetime.now():%Y%m%d-%H%M%S.%f}.log"
+    log_stream = serial_capture.SerialCapture(
+        common_dpu.log_dir(host_path),
+        capture_prefix,
     )
 
-    logger.info(
-        f"Select entry and boot in {common_dpu.TTYUSB0} (log to {log_stream_filename})"
-    )
-
-    log_stream = open(log_stream_filename, "ab", buffering=0)
+    logger.info(f"Select entry and boot in {tty} (log to {log_stream.filename})")
 
-    return common.Serial(
-        common_dpu.TTYUSB0,
+    return common_dpu.serial_open(
+        tty,
         log_stream=log_stream,
         own_log_stream=True,
     )
 
 
+def uefi_boot_menu_parse_pxe_entry(line_entry: str) -> Optional[str]:
+    m = UEFI_MENU_PXE_PATTERN.search(line_entry)
+    if not m:
+        return None
+    (mac,) = m.groups()
+    mac = ":".join(mac[i : i + 2] for i in range(0, len(mac), 2))
+    return netdev.validate_ethaddr(mac)
+
+
+@dataclasses.dataclass(frozen=True)
+class UefiBootMenu:
+    menu: vt100.Menu
+    dpu_macs: dict[int, str]
+    # The index in "menu.entries" for each PXE boot entry's MAC address.
+    mac_entries: dict[str, int]
+
+
+def uefi_boot_menu_parse_screen(screen: vt100.Screen) -> Optional[UefiBootMenu]:
+    menu = screen.menu(
+        UEFI_MENU_HIGHLIGHT,
+        accept=lambda s: s.startswith("UEFI ") or s.startswith("EFI "),
+    )
+    if menu is None:
+        return None
+
+    try:
+        marker_idx = menu.entries.index(UEFI_MENU_START_MARKER)
+    except ValueError:
+        return None
+
+    # Number the PXE entries in the same order as walking the menu does (see
+    # uefi_boot_menu_process()). That is, starting after the start marker and
+    # wrapping around.
+    dpu_macs: dict[int, str] = {}
+    mac_entries: dict[str, int] = {}
+    for i in range(1, len(menu.entries)):
+        idx = (marker_idx + i) % len(menu.entries)
+        mac = uefi_boot_menu_parse_pxe_entry(menu.entries[idx])
+        if mac is None:
+            continue
+        mac_entries[mac] = idx
+        dpu_macs[len(dpu_macs)] = mac
+
+    if not dpu_macs:
+        return None
+
+    return UefiBootMenu(menu=menu, dpu_macs=dpu_macs, mac_entries=mac_entries)
+
+
+_SERIAL_ANY_OUTPUT = re.compile(".+", flags=re.DOTALL)
+
+
+def uefi_screen_update(
+    ctx: RunContext,
+    *,
+    quiet: float = 0.5,
+    timeout: float = 5.0,
+) -> vt100.Screen:
+    # Feed the pending output of the serial console to the screen model.
+    # Returns after the console was quiet for "quiet" seconds, which means
+    # that the firmware finished painting the screen.
+    ser = ctx.serial_get()
+    screen = ctx.uefi_screen
+    end_time = time.monotonic() + timeout
+    while time.monotonic() < end_time:
+        try:
+            s = ser.expect(_SERIAL_ANY_OUTPUT, quiet, verbose=False)
+        except Exception:
+            break
+        screen.feed(s)
+    return screen
+
+
+def uefi_boot_menu_detect(ctx: RunContext) -> Optional[UefiBootMenu]:
+    boot_menu = uefi_boot_menu_parse_screen(uefi_screen_update(ctx))
+    if boot_menu is None:
+        logger.info(f"Cannot parse boot menu from the screen: {str(ctx.uefi_screen)!r}")
+    return boot_menu
+
+
+def uefi_boot_menu_jump(
+    ctx: RunContext,
+    boot_menu: UefiBootMenu,
+    select_boot: str,
+) -> None:
+    # Move the cursor to the entry for "select_boot" with one burst of key
+    # presses. The menu wraps around, so we go whichever way is shorter.
+    menu = boot_menu.menu
+    target = boot_menu.mac_entries[select_boot]
+    n_down = (target - menu.cursor) % len(menu.entries)
+    n_up = (menu.cursor - target) % len(menu.entries)
+
+    ser = ctx.serial_get()
+    if n_down <= n_up:
+        keys = KEY_DOWN * n_down
+    else:
+        keys = KEY_UP * n_up
+    logger.info(
+        f"Jump from boot entry {menu.cursor_entry!r} to {menu.entries[target]!r} ({n_down if n_down <= n_up else -n_up} entries)"
+    )
+    if keys:
+        ser.send(keys, sleep=0)
+
+    # Only trust the cursor position that the firmware painted.
+    boot_menu2 = uefi_boot_menu_parse_screen(uefi_screen_update(ctx))
+    if (
+        boot_menu2 is None
+        or boot_menu2.menu.entries != menu.entries
+        or boot_menu2.menu.cursor != target
+    ):
+        cursor_entry = None if boot_menu2 is None else boot_menu2.menu.cursor_entry
+        raise RuntimeError(
+            f"Failure to select boot entry for {select_boot!r} (cursor is at {cursor_entry!r})"
+        )
+
+
+def uefi_boot_menu_boot(ctx: RunContext, select_boot: str) -> None:
+    # Press ENTER on the selected entry. Return once the firmware left the
+    # menu, instead of sleeping for a while.
+    ser = ctx.serial_get()
+    ser.send(KEY_ENTER, sleep=0)
+    try:
+        ser.expect(UEFI_PXE_START_PATTERN, 30, verbose=False)
+    except Exception:
+        raise RuntimeError(f"Failure to start PXE boot of {select_boot!r}")
+
+
 def uefi_boot_menu_process(
     ctx: RunContext,
     *,
@@ -977,9 +1490,33 @@ def uefi_boot_menu_process(
     if select_boot:
         logger.info(f"Parse boot menu to start booting {select_boot!r}")
         assert netdev.validate_ethaddr_or_none(select_boot) is not None
+
+        # If we know the menu layout from the screen, we can directly jump to
+        # the entry.
+        boot_menu = uefi_boot_menu_detect(ctx)
+        if boot_menu is not None:
+            if select_boot not in boot_menu.mac_entries:
+                raise RuntimeError(
+                    f"Didn't find boot menu entry for PXE boot {select_boot!r} in BIOS. Detected interfaces are {boot_menu.dpu_macs}."
+                )
+            uefi_boot_menu_jump(ctx, boot_menu, select_boot)
+            logger.info(
+                f"Detected interfaces are {boot_menu.dpu_macs}. Booting now {select_boot!r}."
+            )
+            uefi_boot_menu_boot(ctx, select_boot)
+            return boot_menu.dpu_macs
     else:
         logger.info("Parse boot menu to find all MAC addresses")
 
+        # The complete boot menu was already painted when we entered it. Try
+        # to find all entries on the screen, without walking the menu.
+        boot_menu = uefi_boot_menu_detect(ctx)
+        if boot_menu is not None:
+            for devidx, entry_mac in boot_menu.dpu_macs.items():
+                logger.info(f"Found PXE boot entry {devidx!r} with MAC {entry_mac!r}")
+            logger.info(f"Detected interfaces are {boot_menu.dpu_macs}")
+            return boot_menu.dpu_macs
+
     ser = ctx.serial_get()
 
     class ParsingState(enum.IntEnum):
@@ -1023,6 +1560,8 @@ def uefi_boot_menu_process(
             except Exception:
                 break
 
+            ctx.uefi_screen.feed(line_match_full)
+
             # Usually, after a KEY_DOWN we only expect to find a single
             # "line_pattern". But if there were multiple patterns inside the
             # buffer, we would want to parse them all but care most about the
@@ -1034,7 +1573,7 @@ def uefi_boot_menu_process(
             for line_match in line_matches:
                 (line_entry,) = line_match.groups()
 
-                is_start_marker = re.search("^UEFI Misc Device$", line_entry)
+                is_start_marker = line_entry == UEFI_MENU_START_MARKER
                 if is_start_marker:
                     # We need to detect wrap around in the menu. We take this
                     # "line_entry" as marker for that.
@@ -1052,11 +1591,8 @@ def uefi_boot_menu_process(
                         break
                     continue
 
-                pxe_line_match = re.search(
-                    "^UEFI PXEv4 \\(MAC:([0-9a-fA-F]{12})\\)$",
-                    line_entry,
-                )
-                if not pxe_line_match:
+                mac = uefi_boot_menu_parse_pxe_entry(line_entry)
+                if mac is None:
                     continue
 
                 if parsing_state == ParsingState.SAW_START_MARKER:
@@ -1067,9 +1603,6 @@ def uefi_boot_menu_process(
                     # Not yet parsing. We must first wrap around in the menu.
                     continue
 
-                (mac,) = pxe_line_match.groups()
-                mac = ":".join(mac[i : i + 2] for i in range(0, len(mac), 2))
-                mac = netdev.validate_ethaddr(mac)
                 devidx = len(dpu_macs)
                 logger.info(f"Found PXE boot entry {devidx!r} with MAC {mac!r}")
                 dpu_macs[devidx] = mac
@@ -1127,7 +1660,7 @@ def uefi_boot_menu_process(
     logger.info(
         f"Detected interfaces are (partial) {dpu_macs}. Booting now {select_boot!r}."
     )
-    ser.send(KEY_ENTER, sleep=10)
+    uefi_boot_menu_boot(ctx, select_boot)
     return dpu_macs
 
 
@@ -1136,7 +1669,7 @@ def uefi_reset_and_enter_boot_menu(ctx: RunContext) -> None:
 
     logger.info("Reset DPU and enter UEFI boot menu")
 
-    reset()
+    reset(tty=ctx.dpu.tty1)
 
     # Pop everything from the buffer first.
     ser.expect(".*")
@@ -1167,7 +1700,8 @@ def uefi_reset_and_enter_boot_menu(ctx: RunContext) -> None:
     logger.info("waiting for Boot manager entry")
     ser.expect("This selection will.*take you to the Boot.*Manager", 3)
     ser.send(KEY_ENTER)
-    ser.expect("Device Path")
+    screen = ctx.uefi_screen_reset()
+    screen.feed(ser.expect("Device Path"))
 
 
 def uefi_enter_boot_menu_and_detect_dpu_macs(ctx: RunContext) -> dict[int, str]:
@@ -1180,24 +1714,57 @@ def uefi_enter_boot_menu_and_detect_dpu_macs(ctx: RunContext) -> dict[int, str]:
     logger.info("Reset and enter boot menu to find all MAC addresses")
     uefi_reset_and_enter_boot_menu(ctx)
     dpu_macs = uefi_boot_menu_process(ctx)
+    dpu_macs_cache_store(ctx, dpu_macs)
     return dpu_macs
 
 
-def uefi_enter_boot_menu_and_boot(ctx: RunContext) -> None:
+def uefi_park_in_boot_menu(ctx: RunContext) -> None:
+    # Reset the DPU into the UEFI boot menu and detect the MAC addresses
+    # there (or verify the cached ones). The DPU then waits in the menu, until
+    # uefi_enter_boot_menu_and_boot() selects the boot entry without another
+    # reset. This runs while the ISO and the services are prepared.
+    logger.info("Reset and park the DPU in the boot menu")
+    try:
+        with ctx.serial_open():
+            uefi_reset_and_enter_boot_menu(ctx)
+            if ctx.dpu_macs_load_cached():
+                # The DHCP host entry and the grub.cfg are not yet set up. They
+                # can still use other MAC addresses.
+                scanned_macs = dpu_macs_cache_verify(ctx)
+                if scanned_macs is not None:
+                    ctx.dpu_macs_replace(scanned_macs)
+            else:
+                dpu_macs = uefi_boot_menu_process(ctx)
+                dpu_macs_cache_store(ctx, dpu_macs)
+                ctx.dpu_macs_set_once(dpu_macs)
+    except Exception as e:
+        # Not fatal. Booting resets the DPU again.
+        logger.warning(f"Failure to park the DPU in the boot menu: {e}")
+        return
+    ctx.boot_menu_parked_set()
+
+
+def uefi_enter_boot_menu_and_boot(ctx: RunContext, *, parked: bool = False) -> None:
     logger.info(f"Reset and enter boot menu to boot dpu-dev {ctx.cfg.dpu_dev!r}")
 
     dpu_mac, in_boot_menu = ctx.dpu_mac_ensure(reuse_serial_context=True)
 
-    if in_boot_menu:
+    if in_boot_menu or parked:
         # While fetching the "dpu_mac", we also needed to fetch the "dpu_macs",
-        # which already left us inside the boot menu. We are already there. We
-        # don't need to reset again.
+        # which already left us inside the boot menu. Or the DPU was parked
+        # there. We are already there. We don't need to reset again.
         pass
     else:
-        uefi_reset_and_enter_boot_menu(ctx)
+        with timeline.stage("reset-and-enter-boot-menu"):
+            uefi_reset_and_enter_boot_menu(ctx)
+        if dpu_macs_cache_verify(ctx) is not None:
+            # The services are set up for the cached MAC address. Retry (see
+            # dpu_pxeboot_retry()).
+            raise DpuMacsStaleError("The cached MAC addresses are outdated")
 
     # Boot the entry.
-    uefi_boot_menu_process(ctx, select_boot=dpu_mac)
+    with timeline.stage("select-boot-entry"):
+        uefi_boot_menu_process(ctx, select_boot=dpu_mac)
 
 
 def detect_dpu_mac(
@@ -1215,16 +1782,22 @@ def detect_dpu_mac(
         logger.info(
             f"dpu-mac-detect: parse all MAC addresses from BIOS menu to determine MAC for dpu-dev {ctx.cfg.dpu_dev!r}"
         )
-        if reuse_serial_context:
+        scanned = False
+        if ctx.dpu_macs_load_cached():
+            # We know the MAC addresses already (possibly from the cache). No
+            # need to touch the DPU.
+            dpu_macs, _ = ctx.dpu_macs_ensure()
+        elif reuse_serial_context:
             # We use the serial context created by the caller. In that case,
             # if dpu_macs_ensure() ends up entering the boot menu, we want to
             # stay there (and indicate that to the caller).
             dpu_macs, in_boot_menu = ctx.dpu_macs_ensure()
+            scanned = in_boot_menu
         else:
             # We create a new serial context. The caller does not care whehter we
             # stay inside the boot menu.
             with ctx.serial_open():
-                dpu_macs, _ = ctx.dpu_macs_ensure()
+                dpu_macs, scanned = ctx.dpu_macs_ensure()
 
         if ctx.cfg.dpu_dev == "primary":
             real_dpu_mac = dpu_macs[max(dpu_macs)]
@@ -1242,7 +1815,7 @@ def detect_dpu_mac(
             f"dpu-mac-detect: detected MAC addresses {real_dpu_mac!r} for dpu-dev {ctx.cfg.dpu_dev!r} (MACs are {dpu_macs})"
         )
 
-        if ctx.before_prompt:
+        if ctx.before_prompt and scanned:
             # We have "--prompt" option enabled, and are still before prompting.
             #
             # With prompting, I think the user will want to so something with the DPU. Don't
@@ -1257,7 +1830,7 @@ def detect_dpu_mac(
             # requirement and we can leave it in undefined (not "in_boot_menu")
             # state.
             in_boot_menu = False
-            reset()
+            reset(tty=ctx.dpu.tty1)
 
     if is_marvell_random_mac(real_dpu_mac):
         logger.warning(
@@ -1268,14 +1841,18 @@ def detect_dpu_mac(
 
 
 def write_hosts_entry(ctx: RunContext) -> None:
-    entries: collections.abc.Mapping[
+    # The entries of all DPUs, at once.
+    entries: dict[
         str,
         tuple[str, Optional[collections.abc.Iterable[str]]],
-    ]
-    if ctx.dpu_name:
-        entries = {ctx.dpu_name: (common_dpu.dpu_ip4addr, ["dpu"])}
-    else:
-        entries = {"dpu": (common_dpu.dpu_ip4addr, None)}
+    ] = {}
+    for dpu_ctx in ctx.dpu_contexts():
+        alias = dpu_ctx.dpu.name if dpu_ctx.multi_dpu else "dpu"
+        dpu_name = dpu_ctx.dpu_name
+        if dpu_name:
+            entries[dpu_name] = (dpu_ctx.dpu.ip4addr, [alias])
+        else:
+            entries[alias] = (dpu_ctx.dpu.ip4addr, None)
 
     common.etc_hosts_update_file(
         entries,
@@ -1288,62 +1865,104 @@ def post_pxeboot(ctx: RunContext) -> None:
         write_hosts_entry(ctx)
 
 
-def detect_yum_repo_url() -> str:
-    res = host.local.run(
-        [
-            "sed",
-            "-n",
-            "s/^name=Red Hat Enterprise Linux \\([0-9]\\+\\.[0-9]\\+\\).0$/\\1/p",
-            f"{MNT_PATH}/media.repo",
-        ]
+def detect_yum_repo_url(
+    iso: iso_image.IsoImage,
+    resolver: resolver_cache.ResolverCache,
+) -> str:
+    try:
+        with iso.open("media.repo") as f:
+            media_repo = f.read().decode(errors="replace")
+    except OSError:
+        media_repo = ""
+    versions = re.findall(
+        "(?m)^name=Red Hat Enterprise Linux ([0-9]+\\.[0-9]+).0$", media_repo
     )
-    if res.success and res.out:
-        os_version = res.out.splitlines()[-1].strip()
-        url_base = (
-            "http://download.hosts.prod.upshift.rdu2.redhat.com/rhel-9/composes/RHEL-9/"
-        )
+    if not versions:
+        return ""
+    os_version = versions[-1]
+    url_base = (
+        "http://download.hosts.prod.upshift.rdu2.redhat.com/rhel-9/composes/RHEL-9/"
+    )
+
+    def _fetch() -> str:
         sed_pattern = f's/.*href="\\(RHEL-{os_version}.0-updates[^"]*\\)".*/\\1/p'
         res = host.local.run(
             f"curl -L -s {shlex.quote(url_base)} | "
             f"sed -n {shlex.quote(sed_pattern)} | "
             "grep -v delete-me/ | sort | tail -n1"
         )
-        if res.success:
-            part = res.out.strip()
-            if part:
-                return f"{url_base}{part}"
-    return ""
+        part = res.out.strip()
+        if not res.success or not part:
+            raise RuntimeError(f"no updates compose for {os_version} at {url_base}")
+        return f"{url_base}{part}"
+
+    try:
+        return resolver.resolve(f"yum-repo-url:{os_version}", _fetch)
+    except Exception as e:
+        logger.warning(f"Failure to detect yum repo URL: {e}")
+        return ""
 
 
 def setup_http(ctx: RunContext) -> None:
     os.makedirs(WWW_PATH, exist_ok=True)
-    host.local.run(["ln", "-snf", MNT_PATH, f"{WWW_PATH}/marvell_dpu_iso"])
-
-    ctx.iso_kind.setup_http_files(ctx)
-
-    common_dpu.run_process(
-        "httpd",
-        [
-            sys.executable,
-            "-m",
-            "http.server",
-            "-d",
+    links = iso_image.Links()
+    links.add("marvell_dpu_iso", ctx.iso_image)
+
+    service = common_dpu.service_get(f"httpd[{http_server.DEFAULT_PORT}]")
+    if isinstance(service, http_server.HttpServer):
+        # Still running from the previous job (see provisiond.py).
+        service.links_set(links)
+        return
+    common_dpu.service_start(
+        http_server.HttpServer(
             WWW_PATH,
-            "24380",
-        ],
+            port=http_server.DEFAULT_PORT,
+            # Record the fetching of kickstart/ignition, and the kernel
+            # images and the rootfs in the timeline. But not each package.
+            mark_pattern="\\.(ks|ign|img)$|/\\.treeinfo$",
+            links=links,
+        )
     )
 
 
 def setup_tftp(ctx: RunContext) -> None:
     logger.info("Configuring TFTP")
-    os.makedirs(f"{TFTP_PATH}/pxelinux", exist_ok=True)
-    logger.info("starting in.tftpd")
-    host.local.run("killall in.tftpd")
-    common_dpu.run_process(
-        "tftp",
-        f"/usr/sbin/in.tftpd -v -v -s -B 1468 -L {shlex.quote(TFTP_PATH)}",
+    os.makedirs(TFTP_PATH, exist_ok=True)
+    # Grub prefers the grub.cfg for its MAC address. Drop the ones of earlier
+    # runs (see setup_grub_cfg()).
+    for filename in glob.glob(f"{TFTP_PATH}/grub.cfg-01-*"):
+        os.remove(filename)
+    links = iso_image.Links()
+    try:
+        ctx.iso_kind.setup_tftp_files(ctx, links)
+    except BaseException:
+        links.close()
+        raise
+    service = common_dpu.service_get(f"tftpd[{tftp_server.DEFAULT_PORT}]")
+    if isinstance(service, tftp_server.TftpServer):
+        service.links_set(links)
+        return
+    common_dpu.service_start(tftp_server.TftpServer(TFTP_PATH, links=links))
+
+
+def setup_grub_cfg(ctx: RunContext) -> None:
+    # The grub.cfg of the DPU points the installer to its kickstart/ignition.
+    with open(common_dpu.packaged_file(ctx.iso_kind.GRUB_CFG)) as f:
+        grub_cfg = f.read()
+    grub_cfg = grub_cfg.replace(
+        f"/{ctx.iso_kind.HTTP_CONFIG_PATH}",
+        f"/{ctx.http_config_path}",
     )
-    ctx.iso_kind.setup_tftp_files()
+    cache = ctx.artifact_cache
+    cache.stage(cache.put_bytes(grub_cfg.encode()), f"{TFTP_PATH}/{ctx.grub_cfg_name}")
+
+
+def setup_dpu_files(ctx: RunContext, dpu_ctx: RunContext) -> None:
+    # The files that differ per DPU: its grub.cfg and its kickstart/ignition.
+    if dpu_ctx is not ctx:
+        dpu_ctx.dpu_shared_copy_from(ctx)
+    setup_grub_cfg(dpu_ctx)
+    dpu_ctx.iso_kind.setup_http_files(dpu_ctx)
 
 
 def prepare_ssh_keys(ctx: RunContext) -> tuple[list[str], str]:
@@ -1389,6 +2008,10 @@ def prepare_ssh_keys(ctx: RunContext) -> tuple[list[str], str]:
 
 
 def prepare_host(ctx: RunContext) -> None:
+    key = (ctx.cfg.dev, ctx.host_mode_persist)
+    if key in _host_prepared:
+        logger.info("Host is already configured for Pxeboot")
+        return
     logger.info("Configure host for Pxeboot")
     if ctx.host_mode_persist:
         common_dpu.nmcli_setup_mngtiface(
@@ -1418,24 +2041,112 @@ def prepare_host(ctx: RunContext) -> None:
     common_dpu.nft_masquerade(ifname=ctx.cfg.dev, subnet=common_dpu.dpu_subnet)
 
     host.local.run("sysctl -w net.ipv4.ip_forward=1")
+    _host_prepared.add(key)
 
 
 def setup_dhcp(ctx: RunContext) -> None:
+    # One dhcpd for all DPUs, with a host entry (and static address) for each.
     dhcp_restricted = ctx.dhcp_restricted_ensure()
-    hardware_ethernet: Optional[str] = None
-    if dhcp_restricted:
-        hardware_ethernet, in_boot_menu = ctx.dpu_mac_ensure()
+    hosts: list[tuple[str, str]] = []
+    for dpu_ctx in ctx.dpu_contexts():
+        if dpu_ctx.multi_dpu and not dpu_ctx.dhcp_restricted_ensure():
+            raise RuntimeError(
+                f"Cannot install several DPUs at once, the MAC address of {dpu_ctx.dpu.name} is not stable (see docs/howto_fix_mac_addresses.txt)"
+            )
+        if dhcp_restricted:
+            dpu_mac, _ = dpu_ctx.dpu_mac_ensure()
+            hosts.append((dpu_mac, dpu_ctx.dpu.ip4addr))
 
     common_dpu.run_dhcpd(
         dhcpd_conf=common_dpu.packaged_file("manifests/pxeboot/dhcpd.conf"),
         pxe_filename=ctx.iso_kind.DHCP_PXE_FILENAME,
-        hardware_ethernet=hardware_ethernet,
+        hosts=hosts,
         dhcp_restricted=dhcp_restricted,
     )
+    if common_dpu.service_get(f"dhcp-watch[{ctx.cfg.dev}]") is not None:
+        return
+    try:
+        common_dpu.service_start(dhcp.Watcher(ctx.cfg.dev))
+    except OSError as e:
+        # Only the install progress misses the DHCP phase.
+        logger.warning(f"Failure to watch DHCP on {ctx.cfg.dev}: {e}")
+
+
+def wait_services_ready(ctx: RunContext) -> None:
+    # Instead of waiting a fixed time for the services, ask them like the
+    # DPU will: DHCP, the grub.cfg via TFTP and the kickstart/ignition via
+    # HTTP.
+    dhcp_ethaddr: Optional[str] = None
+    if ctx.dhcp_restricted_ensure():
+        dhcp_ethaddr, _ = ctx.dpu_mac_ensure()
+    probes = [
+        readiness.Probe(
+            name="dhcpd",
+            fcn=lambda timeout: readiness.probe_dhcp(
+                ctx.cfg.dev, timeout, ethaddr=dhcp_ethaddr
+            ),
+            timeout=20.0,
+        ),
+    ]
+    for dpu_ctx in ctx.dpu_contexts():
+        grub_cfg_name = dpu_ctx.grub_cfg_name
+        http_config_path = dpu_ctx.http_config_path
+        probes.append(
+            readiness.Probe(
+                name=dpu_ctx.dpu_stage("tftp"),
+                fcn=functools.partial(
+                    readiness.probe_tftp,
+                    common_dpu.host_ip4addr,
+                    tftp_server.DEFAULT_PORT,
+                    grub_cfg_name,
+                ),
+                timeout=10.0,
+            )
+        )
+        probes.append(
+            readiness.Probe(
+                name=dpu_ctx.dpu_stage("http"),
+                fcn=functools.partial(
+                    readiness.probe_http,
+                    f"http://{common_dpu.host_ip4addr}:{http_server.DEFAULT_PORT}/{http_config_path}",
+                ),
+                timeout=10.0,
+            )
+        )
+    readiness.wait_ready(probes)
+
+
+def iso_image_open(
+    iso_path: str,
+    *,
+    verified: iso_image.VerifiedHashes,
+) -> iso_image.IsoImage:
+    # Reuse the image that an earlier run opened, if the file did not change
+    # and the services still hold it open. Returns a new reference, for the
+    # caller to close(). The cache holds none: an image is closed once the
+    # last job and the last link (see iso_image.Links) drop it. Otherwise a
+    # long running process (see provisiond.py) keeps a file descriptor for
+    # each ISO it ever used, and the files that the ISO store deletes still
+    # take their space on disk.
+    st = os.stat(iso_path)
+    key = (st.st_ino, st.st_size, st.st_mtime_ns)
+    cached = _iso_images.get(iso_path)
+    if cached is not None and cached[0] == key:
+        try:
+            cached[1].ref()
+        except OSError:
+            pass
+        else:
+            logger.info(f"ISO {iso_path} is already open")
+            return cached[1]
+    iso = iso_image.IsoImage(iso_path, verified=verified)
+    _iso_images[iso_path] = (key, iso)
+    return iso
 
 
-def create_and_mount_iso(ctx: RunContext) -> IsoKind:
-    host.local.run(["umount", IsoKindRhcos.MNT_EFIBOOT_PATH])
+def create_and_open_iso(ctx: RunContext) -> tuple[IsoKind, iso_image.IsoImage]:
+    # The files are served directly from the ISO (see iso_image.py). It is not
+    # mounted.
     is_retry = False
     iso2 = ctx.cfg.iso
     while True:
@@ -1447,24 +2158,32 @@ def create_and_mount_iso(ctx: RunContext) -> IsoKind:
             iso2,
             chroot_path=ctx.cfg.host_path,
             force=is_retry,
+            resolver_ttl=ctx.cfg.resolver_ttl,
         )
 
-        success = common_dpu.mount_iso(
-            iso_path,
-            mount_path=MNT_PATH,
-        )
-        if success:
+        iso: Optional[iso_image.IsoImage] = None
+        try:
+            iso = iso_image_open(iso_path, verified=ctx.verified_hashes)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failure to open ISO {iso_path}: {e}")
+        if iso is not None:
             iso_kind = IsoKind.detect_from_iso(
+                iso=iso,
                 cfg_iso_kind=ctx.cfg.cfg_iso_kind,
                 read_check=True,
             )
             if iso_kind is not None:
-                logger.info(
-                    f"ISO {iso_path} successfully mounted at {MNT_PATH} (as {iso_kind})"
-                )
-                iso_kind.mount_nested_iso()
-                return iso_kind
-            host.local.run(["umount", MNT_PATH])
+                logger.info(f"ISO {iso_path} successfully opened (as {iso_kind})")
+                try:
+                    iso_kind.check_iso(iso)
+                except BaseException:
+                    iso.close()
+                    raise
+                return iso_kind, iso
+            # Only drop the reference of this job. A server thread may still
+            # read from the image.
+            _iso_images.pop(iso_path, None)
+            iso.close()
             logger.warning(
                 f"ISO {iso_path} does not look like and ISO kind {ctx.cfg.cfg_iso_kind!r}"
             )
@@ -1476,107 +2195,276 @@ def create_and_mount_iso(ctx: RunContext) -> IsoKind:
             #
             # But on retry, or if this was not a HTTP URL, this is a fatal
             # error.
-            logger.error(f"Failure to mount ISO {ctx.cfg.iso!r}")
-            raise RuntimeError(f"Failure to mount ISO {ctx.cfg.iso!r}")
+            logger.error(f"Failure to open ISO {ctx.cfg.iso!r}")
+            raise RuntimeError(f"Failure to open ISO {ctx.cfg.iso!r}")
 
         iso2 = common.unwrap(iso_url)
         is_retry = True
         logger.warning(f"ISO {iso_path} seems broken. Try re-downloading {iso2}")
 
 
+def open_iso(ctx: RunContext) -> None:
+    iso_kind, iso = create_and_open_iso(ctx)
+    ctx.iso_image_set_once(iso)
+    ctx.iso_kind_set_once(iso_kind)
+    if isinstance(iso_kind, IsoKindRhel):
+        # The kickstart file needs it, in setup_http().
+        ctx.yum_repo_url_prefetch()
+
+
+def prepare_host_mode_and_ssh_keys(ctx: RunContext) -> None:
+    host_mode = ctx.cfg.cfg_host_mode
+    if host_mode == "auto":
+        host_mode = detect_host_mode(host_path=ctx.cfg.host_path, iso_kind=ctx.iso_kind)
+    ctx.host_mode_set_once(host_mode)
+
+    ssh_keys, ssh_privkey_file = prepare_ssh_keys(ctx)
+    ctx.ssh_keys_set_once(ssh_keys)
+    ctx.ssh_privkey_file_set_once(ssh_privkey_file)
+
+
+def setup(ctx: RunContext) -> None:
+    # The steps until the DPU can PXE boot. They run as soon as their
+    # inputs are ready. The ISO is downloaded and checked, while the DPU
+    # resets into the boot menu. Several DPUs do that at the same time, and
+    # share the services.
+
+    def _prepare_host() -> None:
+        prepare_host_mode_and_ssh_keys(ctx)
+        prepare_host(ctx)
+
+    def _park(dpu_ctx: RunContext) -> None:
+        with dpu_scope(dpu_ctx):
+            uefi_park_in_boot_menu(dpu_ctx)
+
+    def _setup_dpu_files(dpu_ctx: RunContext) -> None:
+        with dpu_scope(dpu_ctx):
+            setup_dpu_files(ctx, dpu_ctx)
+
+    graph = stage_graph.StageGraph()
+    graph.add("create-and-open-iso", lambda: open_iso(ctx))
+    graph.add("prepare-host", _prepare_host, after=["create-and-open-iso"])
+    graph.add("setup-tftp", lambda: setup_tftp(ctx), after=["create-and-open-iso"])
+    graph.add("setup-http", lambda: setup_http(ctx), after=["prepare-host"])
+    dpu_stages = []
+    for dpu_ctx in ctx.dpu_contexts():
+        park_stages = []
+        if not ctx.cfg.prompt:
+            # With "--prompt", the user may want to use the DPU while we wait.
+            # Don't leave it in the boot menu.
+            park_stages.append(dpu_ctx.dpu_stage("park-in-boot-menu"))
+            graph.add(park_stages[0], functools.partial(_park, dpu_ctx))
+            dpu_stages.extend(park_stages)
+        # The kickstart/ignition needs the SSH keys and the interface names of
+        # the DPU. The grub.cfg needs its MAC address.
+        graph.add(
+            dpu_ctx.dpu_stage("setup-dpu-files"),
+            functools.partial(_setup_dpu_files, dpu_ctx),
+            after=["prepare-host", "setup-tftp", *park_stages],
+        )
+    # dhcpd needs the host's IP address, and maybe the MAC addresses of the
+    # DPUs.
+    graph.add(
+        "setup-dhcp", lambda: setup_dhcp(ctx), after=["prepare-host", *dpu_stages]
+    )
+    graph.run()
+
+
+@contextlib.contextmanager
+def dpu_scope(ctx: RunContext) -> typing.Iterator[None]:
+    # With several DPUs, what this thread logs gets the name of the DPU as
+    # prefix (and goes to its log file), and its stages and marks go to the
+    # timeline of the DPU (see dpu_logs()).
+    if not ctx.multi_dpu:
+        yield
+        return
+    with common_dpu.log_prefix(ctx.dpu.name), timeline.use(ctx.dpu_timeline):
+        yield
+
+
+@contextlib.contextmanager
+def dpu_logs(ctx: RunContext) -> typing.Iterator[None]:
+    # With several DPUs, each gets its own log file and timeline, next to the
+    # ones of the run: "{host-path}/var/log/marvell-tools/pxeboot-dpuN.*.log"
+    # and "pxeboot-timeline-dpuN.*.jsonl".
+    if not ctx.multi_dpu:
+        yield
+        return
+    directory = common_dpu.log_dir(ctx.cfg.host_path)
+    handlers: list[tuple[RunContext, logging.Handler]] = []
+    for dpu_ctx in ctx.dpu_contexts():
+        name = dpu_ctx.dpu.name
+        dpu_ctx.dpu_timeline_set_once(
+            timeline.Timeline(
+                timeline.filename_create(directory, f"pxeboot-timeline-{name}")
+            )
+        )
+        serial_capture.capture_cleanup(
+            directory,
+            f"pxeboot-{name}",
+            keep_count=199,
+            keep_bytes=256 * 1024 * 1024,
+        )
+        handler = logging.FileHandler(
+            f"{directory}/pxeboot-{name}.{datetime.datetime.now():%Y%m%d-%H%M%S.%f}.log"
+        )
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+
+        def _filter(record: logging.LogRecord, name: str = name) -> bool:
+            return common_dpu.log_prefix_get() == name
+
+        handler.addFilter(_filter)
+        logger.addHandler(handler)
+        logger.info(f"{name}: log to {handler.baseFilename!r}")
+        handlers.append((dpu_ctx, handler))
+    try:
+        yield
+    finally:
+        for dpu_ctx, dpu_handler in handlers:
+            logger.removeHandler(dpu_handler)
+            dpu_handler.close()
+            with common_dpu.log_prefix(dpu_ctx.dpu.name):
+                dpu_ctx.dpu_timeline.finish()
+
+
 def dpu_pxeboot(ctx: RunContext) -> str:
     logger.info(f"Start PXE boot with dpu-dev {ctx.cfg.dpu_dev!r}")
+    parked = ctx.boot_menu_parked_take()
     with ctx.serial_open():
-        uefi_enter_boot_menu_and_boot(ctx)
-        ip = wait_for_boot(ctx)
+        with timeline.stage("enter-boot-menu-and-boot", parked=parked):
+            uefi_enter_boot_menu_and_boot(ctx, parked=parked)
+        with timeline.stage("wait-for-boot"):
+            ip = wait_for_boot(ctx)
     return ip
 
 
-def main() -> None:
-    signal.signal(signal.SIGUSR1, _signal_handler)
+def dpu_pxeboot_retry(ctx: RunContext, dpu_ctx: RunContext) -> str:
+    rescan = False
+    for try_count in itertools.count(start=1):
+        logger.info(f"Starting UEFI PXE Boot (try {try_count})")
+        try:
+            with timeline.stage("pxeboot", try_count=try_count):
+                if rescan:
+                    rescan = False
+                    dpu_macs_rescan(ctx, dpu_ctx)
+                host_ip = dpu_pxeboot(dpu_ctx)
+        except Exception as e:
+            if dpu_ctx.dpu_macs_from_cache:
+                # Maybe the cached MAC addresses are wrong. Drop them, and
+                # scan the boot menu before the next try.
+                dpu_macs_cache_store(dpu_ctx, None)
+                rescan = True
+            if try_count >= 3:
+                raise RuntimeError(f"Failure to pxeboot: {e}") from e
+            logger.warning(f"Failure to pxeboot (try {try_count}): {e}")
+            continue
+        break
+    return host_ip
 
-    ctx = parse_args()
 
-    common_dpu.global_cleanup.add(ctx.ssh_privkey_file_cleanup)
+def dpu_pxeboot_all(ctx: RunContext) -> list[str]:
+    # Install the DPUs at the same time. A DPU that fails does not stop the
+    # others, but fails the run once they are done.
+    dpu_ctxs = ctx.dpu_contexts()
+    if len(dpu_ctxs) == 1:
+        return [dpu_pxeboot_retry(ctx, ctx)]
 
-    logger.info(f"pxeboot: {shlex.join(shlex.quote(s) for s in sys.argv)}")
+    host_ips: dict[int, str] = {}
+
+    def _pxeboot(dpu_ctx: RunContext) -> None:
+        with dpu_scope(dpu_ctx):
+            host_ips[dpu_ctx.dpu.index] = dpu_pxeboot_retry(ctx, dpu_ctx)
+
+    graph = stage_graph.StageGraph()
+    for dpu_ctx in dpu_ctxs:
+        graph.add(dpu_ctx.dpu_stage("pxeboot"), functools.partial(_pxeboot, dpu_ctx))
+    graph.run()
+    return [host_ips[dpu_ctx.dpu.index] for dpu_ctx in dpu_ctxs]
+
+
+def run(ctx: RunContext) -> list[str]:
+    # Set up the services and install the DPUs. Returns the IP addresses of
+    # the installed DPUs, in the order of "--dpu". The services keep running:
+    # main() stops them at exit, while provisiond.py keeps them for the next
+    # job.
     logger.info(f"pxeboot run context: {ctx}")
 
-    iso_kind: Optional[IsoKind] = None
-    if not ctx.cfg.host_setup_only:
-        iso_kind = create_and_mount_iso(ctx)
-    else:
-        iso_kind = (
+    if ctx.cfg.host_setup_only:
+        ctx.iso_kind_set_once(
             IsoKind.detect_from_iso(
+                iso=None,
                 cfg_iso_kind=ctx.cfg.cfg_iso_kind,
-                check_mount=False,
             )
             or IsoKindRhel()
         )
-    ctx.iso_kind_set_once(iso_kind)
+        prepare_host_mode_and_ssh_keys(ctx)
+        with timeline.stage("prepare-host"):
+            prepare_host(ctx)
+        for dpu_ctx in ctx.dpu_contexts()[1:]:
+            dpu_ctx.dpu_shared_copy_from(ctx)
+        host_ips = [dpu_ctx.dpu.ip4addr for dpu_ctx in ctx.dpu_contexts()]
+    else:
+        with dpu_logs(ctx), contextlib.ExitStack() as stack:
+            stack.callback(ctx.iso_image_close)
+            setup(ctx)
 
-    host_mode = ctx.cfg.cfg_host_mode
-    if host_mode == "auto":
-        host_mode = detect_host_mode(host_path=ctx.cfg.host_path, iso_kind=iso_kind)
-    ctx.host_mode_set_once(host_mode)
+            with timeline.stage("wait-services-ready"):
+                wait_services_ready(ctx)
+            common_dpu.check_services_running()
 
-    ssh_keys, ssh_privkey_file = prepare_ssh_keys(ctx)
-    ctx.ssh_keys_set_once(ssh_keys)
-    ctx.ssh_privkey_file_set_once(ssh_privkey_file)
+            if ctx.cfg.prompt:
+                try:
+                    input(
+                        "dhcp/tftp/http services started. Waiting. Press ENTER to continue or abort with CTRL+C"
+                    )
+                except KeyboardInterrupt:
+                    sys.exit(0)
 
-    prepare_host(ctx)
+            for dpu_ctx in ctx.dpu_contexts():
+                dpu_ctx.before_prompt_set_after()
 
-    if not ctx.cfg.host_setup_only:
+            host_ips = dpu_pxeboot_all(ctx)
 
-        setup_dhcp(ctx)
-        setup_tftp(ctx)
-        setup_http(ctx)
+    with timeline.stage("post-pxeboot"):
+        post_pxeboot(ctx)
 
-        logger.info("Giving services time to settle")
-        time.sleep(3)
+    return host_ips
 
-        common_dpu.check_services_running()
 
-        if ctx.cfg.prompt:
-            try:
-                input(
-                    "dhcp/tftp/http services started. Waiting. Press ENTER to continue or abort with CTRL+C"
-                )
-            except KeyboardInterrupt:
-                sys.exit(0)
+def main() -> None:
+    signal.signal(signal.SIGUSR1, _signal_handler)
 
-        ctx.before_prompt_set_after()
+    ctx = parse_args()
 
-        for try_count in itertools.count(start=1):
-            logger.info(f"Starting UEFI PXE Boot (try {try_count})")
-            try:
-                host_ip = dpu_pxeboot(ctx)
-            except Exception as e:
-                if try_count >= 3:
-                    raise RuntimeError(f"Failure to pxeboot: {e}") from e
-                logger.warning(f"Failure to pxeboot (try {try_count}): {e}")
-                continue
-            break
+    timeline.start(
+        timeline.filename_create(
+            common_dpu.log_dir(ctx.cfg.host_path), "pxeboot-timeline"
+        )
+    )
 
-    post_pxeboot(ctx)
+    common_dpu.global_cleanup.add(ctx.ssh_privkey_file_cleanup)
+
+    logger.info(f"pxeboot: {shlex.join(shlex.quote(s) for s in sys.argv)}")
+
+    host_ips = run(ctx)
 
     host_setup_only_msg = ""
-    host_ips_msg = ""
+    ssh_msgs = []
 
     if ctx.cfg.host_setup_only:
         host_setup_only_msg = " (host-setup-only)"
-        host_ip = common_dpu.dpu_ip4addr
-    else:
-        other_host_ips = ssh_get_ipaddrs(ctx, host_ip=host_ip)
-        if other_host_ips:
-            host_ips_msg = f" (or on {list(other_host_ips)}"
+    for dpu_ctx, host_ip in zip(ctx.dpu_contexts(), host_ips):
+        host_ips_msg = ""
+        if not ctx.cfg.host_setup_only:
+            other_host_ips = ssh_get_ipaddrs(dpu_ctx, host_ip=host_ip)
+            if other_host_ips:
+                host_ips_msg = f" (or on {list(other_host_ips)}"
+        ssh_msgs.append(f"`ssh {ctx.iso_kind.SSH_USER}@{host_ip}`{host_ips_msg}")
 
     logger.info("Terminating http, tftp, and dhcpd")
     common_dpu.global_cleanup.cleanup()
 
-    logger.info(
-        f"SUCCESS{host_setup_only_msg}. Try `ssh {ctx.iso_kind.SSH_USER}@{host_ip}`{host_ips_msg}"
-    )
+    logger.info(f"SUCCESS{host_setup_only_msg}. Try {' and '.join(ssh_msgs)}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+import concurrent.futures
+import dataclasses
+import os
+import select
+import socket
+import struct
+import time
+import urllib.request
+
+from typing import Callable
+from typing import Optional
+
+from ktoolbox import common
+
+import dhcp
+
+from common_dpu import logger
+
+
+_TFTP_OP_RRQ = 1
+_TFTP_OP_DATA = 3
+_TFTP_OP_ERROR = 5
+
+
+class ProbeError(Exception):
+    pass
+
+
+class ProbeSkipped(Exception):
+    # The probe cannot run here (like without the privileges for a packet
+    # socket). This says nothing about the service.
+    pass
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class Probe:
+    # "fcn" tries once (within the given timeout in seconds) and raises an
+    # exception, if the service does not serve yet.
+    name: str
+    fcn: Callable[[float], None]
+    timeout: float
+
+
+def _dev_ethaddr(dev: str) -> bytes:
+    with open(f"/sys/class/net/{dev}/address") as f:
+        return bytes.fromhex(f.read().strip().replace(":", ""))
+
+
+def probe_dhcp(dev: str, timeout: float, *, ethaddr: Optional[str] = None) -> None:
+    # Broadcast a DHCPDISCOVER on "dev" and wait for the DHCPOFFER. dhcpd
+    # answers via a packet socket, so the reply is not delivered to a UDP
+    # socket of the host. It is seen on a packet socket on "dev". The
+    # client is "ethaddr" (for a restricted dhcpd, the DPU's) or else the
+    # address of "dev". The offer is never requested, so no lease is taken.
+    chaddr = bytes.fromhex(ethaddr.replace(":", "")) if ethaddr else _dev_ethaddr(dev)
+    xid = struct.unpack("!I", os.urandom(4))[0]
+    try:
+        rsock = dhcp.open_packet_socket(dev)
+    except PermissionError as e:
+        raise ProbeSkipped(f"cannot open packet socket: {e}")
+    with rsock:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ssock:
+            ssock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            ssock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_BINDTODEVICE, dev.encode() + b"\0"
+            )
+            ssock.sendto(
+                dhcp.discover(xid, chaddr), ("255.255.255.255", dhcp.SERVER_PORT)
+            )
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ProbeError("no DHCPOFFER")
+            r, _, _ = select.select([rsock], [], [], remaining)
+            if not r:
+                continue
+            msg = dhcp.parse_ip(rsock.recv(65536))
+            if msg is not None and msg.xid == xid and msg.message_type == dhcp.OFFER:
+                logger.info(f"readiness: dhcpd on {dev} offers {msg.yiaddr}")
+                return
+
+
+def probe_tftp(host: str, port: int, filename: str, timeout: float) -> None:
+    # Read the first block of "filename" and then abort the transfer.
+    request = struct.pack("!H", _TFTP_OP_RRQ) + filename.encode() + b"\0" + b"octet\0"
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(request, (host, port))
+        try:
+            packet, server = sock.recvfrom(65536)
+        except socket.timeout:
+            raise ProbeError(f"no reply for {filename!r}")
+        if len(packet) < 4:
+            raise ProbeError("short reply")
+        opcode, block = struct.unpack_from("!HH", packet)
+        if opcode == _TFTP_OP_ERROR:
+            msg = packet[4:].split(b"\0")[0].decode(errors="replace")
+            raise ProbeError(f"error {block} for {filename!r}: {msg}")
+        if opcode != _TFTP_OP_DATA or block != 1:
+            raise ProbeError(f"unexpected reply (opcode {opcode}, block {block})")
+        sock.sendto(
+            struct.pack("!HH", _TFTP_OP_ERROR, 0) + b"readiness probe done\0",
+            server,
+        )
+
+
+def probe_http(url: str, timeout: float) -> None:
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        if response.status != 200:
+            raise ProbeError(f"status {response.status} for {url}")
+        response.read()
+
+
+def _wait_one(probe: Probe) -> Optional[str]:
+    # Try "probe" until it succeeds or its timeout expires. Returns the
+    # error, or None on success.
+    time_start = time.monotonic()
+    deadline = time_start + probe.timeout
+    attempt = 0
+    while True:
+        attempt += 1
+        remaining = deadline - time.monotonic()
+        try:
+            probe.fcn(max(0.1, min(remaining, 2.0)))
+        except ProbeSkipped as e:
+            logger.warning(f"readiness: skip probe {probe.name}: {e}")
+            return None
+        except Exception as e:
+            if time.monotonic() + 0.2 >= deadline:
+                return f"{e} (after {attempt} attempts)"
+            time.sleep(0.2)
+            continue
+        logger.info(
+            f"readiness: {probe.name} ready after {time.monotonic() - time_start:.2f}s"
+        )
+        return None
+
+
+def wait_ready(probes: list[Probe]) -> None:
+    # Run all probes in parallel, each until it succeeds or times out. Exits
+    # if a service does not become ready.
+    if not probes:
+        return
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(probes),
+        thread_name_prefix="readiness",
+    ) as executor:
+        errors = list(executor.map(_wait_one, probes))
+    failed = [f"{p.name}: {e}" for p, e in zip(probes, errors) if e is not None]
+    if failed:
+        logger.error_and_exit(f"Services not ready: {'; '.join(failed)}")
@@ -6,15 +6,14 @@ import time
 
 from typing import Optional
 
-from ktoolbox import common
-
 import common_dpu
+import timeline
 
 from common_dpu import KEY_CTRL_M
 from common_dpu import logger
 
 
-def parse_args() -> argparse.Namespace:
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Reset/reboot Marvell DPU.\n\n"
         f"Connects to {common_dpu.TTYUSB1} to reset the DPU. Note that this might not work, if the DPU hangs in early boot. In that case, manually connect to {common_dpu.TTYUSB0} and resolve the problem.",
@@ -27,8 +26,14 @@ def parse_args() -> argparse.Namespace:
         default="none",
         help='If set to "primary"/"secondary", select the requested boot device in the boot menu. Defaults to "none" to skip this.',
     )
+    parser.add_argument(
+        "--dpu",
+        type=int,
+        default=0,
+        help="The DPU to reset, if several are attached to the host. DPU 0 uses /dev/ttyUSB0 and /dev/ttyUSB1, DPU N (from 1) the Nth other USB serial adapter, in the order of the USB ports (see /dev/serial/by-path). Defaults to 0.",
+    )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.boot_device in ("1", "primary"):
         args.boot_device = 1
@@ -40,9 +45,9 @@ def parse_args() -> argparse.Namespace:
     return args
 
 
-def _reset(try_idx: int, retry_count: int) -> None:
-    logger.debug(f"serial: reset {common_dpu.TTYUSB1} (try {try_idx} of {retry_count})")
-    with common.Serial(common_dpu.TTYUSB1) as ser:
+def _reset(try_idx: int, retry_count: int, tty: str) -> None:
+    logger.debug(f"serial: reset {tty} (try {try_idx} of {retry_count})")
+    with common_dpu.serial_open(tty) as ser:
         for i in range(10):
             time.sleep(1)
             ser.send(KEY_CTRL_M * 2)
@@ -60,17 +65,23 @@ def _reset(try_idx: int, retry_count: int) -> None:
             else:
                 continue
         else:
-            raise RuntimeError(f"Error rebooting DPU via {common_dpu.TTYUSB1}")
+            raise RuntimeError(f"Error rebooting DPU via {tty}")
         logger.debug(
             f"serial[{ser.port}]: reset complete (buffer content {repr(buffer)})"
         )
 
 
-def reset(retry_count: int = 5) -> None:
+def reset(retry_count: int = 5, *, tty: Optional[str] = None) -> None:
+    # "tty" is the SCP console of the DPU. Defaults to TTYUSB1.
+    with timeline.stage("reset"):
+        _reset_retry(retry_count, tty or common_dpu.TTYUSB1)
+
+
+def _reset_retry(retry_count: int, tty: str) -> None:
     try_idx = 0
     while True:
         try:
-            _reset(try_idx, retry_count)
+            _reset(try_idx, retry_count, tty)
         except Exception as e:
             logger.debug(f"serial: reset failed: {e}")
             if try_idx + 1 == retry_count:
@@ -82,14 +93,16 @@ def reset(retry_count: int = 5) -> None:
         return
 
 
-def select_boot_device(boot_device: Optional[int]) -> None:
+def select_boot_device(
+    boot_device: Optional[int], *, tty: Optional[str] = None
+) -> None:
 
     if boot_device is None:
         return
 
     logger.info("selecting pxe entry")
 
-    with common.Serial(common_dpu.TTYUSB0) as ser:
+    with common_dpu.serial_open(tty or common_dpu.TTYUSB0) as ser:
 
         while True:
 
@@ -107,10 +120,14 @@ def select_boot_device(boot_device: Optional[int]) -> None:
             ser.send(str(boot_device))
 
 
+def run(args: argparse.Namespace) -> None:
+    dpu = common_dpu.dpu_get(args.dpu)
+    reset(tty=dpu.tty1)
+    select_boot_device(args.boot_device, tty=dpu.tty0)
+
+
 def main() -> None:
-    args = parse_args()
-    reset()
-    select_boot_device(args.boot_device)
+    run(parse_args())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,158 @@
+import contextlib
+import fcntl
+import threading
+import time
+import typing
+
+from collections.abc import Iterator
+from typing import Callable
+from typing import Optional
+
+from ktoolbox import common
+
+import common_dpu
+
+from common_dpu import logger
+
+
+DEFAULT_TTL = 3600.0
+
+DEFAULT_STALE = 24 * 3600.0
+
+
+# The background refreshes of all ResolverCaches (there is one per run), by
+# file and key. They are not in the thread list, where
+# check_services_running() would take a finished one for a crashed service.
+_refreshing: dict[tuple[str, str], common.FutureThread[Optional[str]]] = {}
+_refreshing_lock = threading.Lock()
+_refreshing_join_at_exit = False
+
+
+def cache_filename(host_path: str) -> str:
+    return f"{common_dpu.cache_dir(host_path)}/resolver.json"
+
+
+def join() -> None:
+    # Wait for the background refreshes.
+    with _refreshing_lock:
+        threads = list(_refreshing.values())
+    for th in threads:
+        th.join_and_result()
+
+
+class ResolverCache:
+    """
+    Remembers the results of slow remote lookups (like the URL of the latest
+    RHEL compose), in a file on the host. A result is used without asking
+    again for "ttl" seconds. For another "stale" seconds, the old result is
+    still used, but refreshed in the background for the next time. If the
+    lookup fails, an older result is better than none.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        *,
+        ttl: float = DEFAULT_TTL,
+        stale: float = DEFAULT_STALE,
+    ) -> None:
+        self.filename = filename
+        self.ttl = ttl
+        self.stale = stale
+
+    def __repr__(self) -> str:
+        return f"ResolverCache({self.filename!r})"
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[dict[str, typing.Any]]:
+        with open(f"{self.filename}.lock", "a") as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            data = common_dpu.json_read(self.filename)
+            if not isinstance(data, dict):
+                data = {}
+            yield data
+
+    def _get(self, key: str) -> Optional[tuple[str, float]]:
+        with self._locked() as data:
+            entry = data.get(key)
+        if (
+            not isinstance(entry, dict)
+            or not isinstance(entry.get("value"), str)
+            or not isinstance(entry.get("time"), (int, float))
+        ):
+            return None
+        return entry["value"], float(entry["time"])
+
+    def _put(self, key: str, value: str) -> None:
+        with self._locked() as data:
+            data[key] = {"value": value, "time": time.time()}
+            common_dpu.json_write_atomic(self.filename, data)
+
+    def _fetch(self, key: str, fetch: Callable[[], str]) -> str:
+        time_start = time.monotonic()
+        value = fetch()
+        logger.info(
+            f"resolver: {key} is {value!r} (took {time.monotonic() - time_start:.2f}s)"
+        )
+        self._put(key, value)
+        return value
+
+    def _refresh(self, key: str, fetch: Callable[[], str]) -> None:
+        def _run(th: common.FutureThread[Optional[str]]) -> Optional[str]:
+            try:
+                return self._fetch(key, fetch)
+            except Exception as e:
+                logger.warning(f"resolver: failure to refresh {key}: {e}")
+                return None
+            finally:
+                with _refreshing_lock:
+                    _refreshing.pop((self.filename, key), None)
+
+        global _refreshing_join_at_exit
+        with _refreshing_lock:
+            if (self.filename, key) in _refreshing:
+                return
+            if not _refreshing_join_at_exit:
+                # The cleanup waits for the thread, so that the next run gets
+                # the new result.
+                _refreshing_join_at_exit = True
+                common_dpu.global_cleanup.add(join)
+            _refreshing[(self.filename, key)] = common.FutureThread(_run, start=True)
+
+    def resolve(
+        self,
+        key: str,
+        fetch: Callable[[], str],
+        *,
+        ttl: Optional[float] = None,
+        stale: Optional[float] = None,
+    ) -> str:
+        # Returns the result of "fetch()", which raises an exception on
+        # failure. With "ttl" 0, always fetch (there is also no stale period).
+        # The cached result is then only used, if the fetch fails.
+        if ttl is None:
+            ttl = self.ttl
+        if stale is None:
+            stale = self.stale
+        cached = self._get(key)
+        if cached is not None and ttl > 0:
+            value, fetched = cached
+            age = time.time() - fetched
+            if 0 <= age < ttl:
+                logger.info(f"resolver: {key} is {value!r} (cached {age:.0f}s ago)")
+                return value
+            if 0 <= age < ttl + stale:
+                logger.info(
+                    f"resolver: {key} is {value!r} (cached {age:.0f}s ago, refreshing)"
+                )
+                self._refresh(key, fetch)
+                return value
+        try:
+            return self._fetch(key, fetch)
+        except Exception as e:
+            if cached is None:
+                raise
+            logger.warning(
+                f"resolver: failure to resolve {key} ({e}). Use old result {cached[0]!r}"
+            )
+            return cached[0]
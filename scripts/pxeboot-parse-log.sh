@@ -1,21 +1,6 @@
 #!/bin/bash
 
-set -e
+# Print the console output of /dev/ttyUSB0 from the log of pxeboot.py.
+# See "serial_log.py --help" for more.
 
-_parse() {
-    sed -e 's/\r$//' "$1" | \
-      sed -n 's/.* serial\[\/dev\/ttyUSB0\]: read [^"'\'']\+\(.*\)$/\1/p'
-}
-
-_parse_to_py() {
-    printf 'a = ( '\\\\'\n'
-    _parse "$1" | sed 's/$/ + \\/'
-    printf '"" )\n'
-}
-
-_parse_to_py "$1" > /tmp/marvell_tools_pxeboot_output.py
-cd /tmp
-python -c 'if True:
-    import marvell_tools_pxeboot_output as o
-    print(o.a)
-'
+exec python "$(dirname "$0")/../serial_log.py" "$@"
@@ -0,0 +1,163 @@
+import datetime
+import glob
+import gzip
+import io
+import os
+import threading
+import time
+import typing
+
+from typing import Optional
+
+from common_dpu import logger
+
+
+class SerialCapture(io.RawIOBase, typing.BinaryIO):
+    """
+    A log file for the output of a serial console. Pass it as "log_stream" to
+    common.Serial.
+
+    The data is collected in memory and written out in batches, once
+    "flush_size" bytes are pending or after "flush_interval" seconds. Each
+    line is prefixed with the monotonic time since the capture started. The
+    files are gzip compressed, and rotated after "max_size" bytes. Of the files
+    in "directory" that start with "prefix", only the newest "keep_count" are
+    kept, up to a total size of "keep_bytes".
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        prefix: str,
+        *,
+        flush_size: int = 64 * 1024,
+        flush_interval: float = 1.0,
+        max_size: int = 64 * 1024 * 1024,
+        keep_count: int = 50,
+        keep_bytes: int = 512 * 1024 * 1024,
+    ) -> None:
+        super().__init__()
+        self.directory = directory
+        self.prefix = prefix
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.keep_count = keep_count
+        self.keep_bytes = keep_bytes
+        self._lock = threading.Lock()
+        self._pending = bytearray()
+        self._timer: Optional[threading.Timer] = None
+        self._at_line_start = True
+        self._time_start = time.monotonic()
+        self._file: Optional[gzip.GzipFile] = None
+        self._file_size = 0
+        self.filename = ""
+        os.makedirs(directory, exist_ok=True)
+        self._open_file()
+
+    def _open_file(self) -> None:
+        now = datetime.datetime.now()
+        self.filename = f"{self.directory}/{self.prefix}.{now:%Y%m%d-%H%M%S.%f}.log.gz"
+        self._file = gzip.open(self.filename, "wb")
+        self._file_size = 0
+        self._file.write(
+            f"# {self.prefix}: {now.isoformat()} is at {time.monotonic() - self._time_start:.6f}\n".encode()
+        )
+        capture_cleanup(
+            self.directory,
+            self.prefix,
+            keep_count=self.keep_count,
+            keep_bytes=self.keep_bytes,
+            keep=self.filename,
+        )
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: typing.Any) -> int:
+        data = bytes(data)
+        if not data:
+            return 0
+        timestamp = f"[{time.monotonic() - self._time_start:12.6f}] ".encode()
+        with self._lock:
+            if self._file is None:
+                raise ValueError("write to closed capture file")
+            lines = data.split(b"\n")
+            for i, line in enumerate(lines):
+                if i > 0:
+                    self._pending += b"\n"
+                    self._at_line_start = True
+                if not line:
+                    continue
+                if self._at_line_start:
+                    self._pending += timestamp
+                    self._at_line_start = False
+                self._pending += line
+            if len(self._pending) >= self.flush_size:
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return len(data)
+
+    def _flush_locked(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending or self._file is None:
+            return
+        self._file.write(self._pending)
+        # A sync flush, so that "zcat" sees the data already while the file
+        # is still open.
+        self._file.flush()
+        self._file_size += len(self._pending)
+        self._pending.clear()
+        if self._file_size >= self.max_size:
+            self._file.close()
+            self._open_file()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._flush_locked()
+                self._file.close()
+                self._file = None
+        super().close()
+
+
+def capture_cleanup(
+    directory: str,
+    prefix: str,
+    *,
+    keep_count: int,
+    keep_bytes: int,
+    keep: Optional[str] = None,
+) -> None:
+    # Delete the oldest capture files (compressed or not), until at most
+    # "keep_count" files with "keep_bytes" in total are left.
+    files = []
+    for filename in glob.glob(f"{glob.escape(directory)}/{glob.escape(prefix)}.*"):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, filename))
+    files.sort(reverse=True)
+
+    count = 0
+    total = 0
+    for _, size, filename in files:
+        count += 1
+        total += size
+        if filename == keep or (count <= keep_count and total <= keep_bytes):
+            continue
+        logger.info(f"serial-capture: delete old capture file {filename!r}")
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import dataclasses
+import gzip
+import os
+import re
+import sys
+import typing
+
+from typing import Optional
+
+from ktoolbox import common
+
+import common_dpu
+
+from common_dpu import logger
+
+
+INDEX_VERSION = 1
+
+# The lines that ktoolbox's common.Serial logs for the data that it reads.
+# The data is the repr() of the string.
+READ_LINE_PATTERN = re.compile(
+    rb" serial\[(?P<port>[^\]]+)\]: read [^\"']*(?P<repr>['\"].*?)\r?\n?$"
+)
+
+# The milestones of a DPU boot, in the order in which they appear.
+MILESTONES: tuple[tuple[str, re.Pattern[str]], ...] = (
+    ("scp-menu", re.compile("SCP Main Menu")),
+    ("boot", re.compile("Boot: .*using SPI[01]_CS0")),
+    ("uefi", re.compile("Press ESCAPE for boot options")),
+    ("grub", re.compile("GNU GRUB|grub>")),
+    ("kernel", re.compile("Booting Linux on physical CPU|Linux version [0-9]")),
+    ("anaconda", re.compile("Starting installer|anaconda [0-9]")),
+    ("login", re.compile("(?m)^\\S+ login: ")),
+)
+
+MILESTONE_NAMES = tuple(name for name, _ in MILESTONES)
+
+
+# Matches may span chunks. Keep this much of the previous output to search
+# in.
+_TAIL_SIZE = 256
+
+_SCAN_SIZE = 256 * 1024
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class Chunk:
+    port: str
+    data: str
+    # The byte offset of the log line in the log file.
+    log_offset: int
+    # The offset of "data" in the console output of "port".
+    stream_offset: int
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class Milestone:
+    run: int
+    name: str
+    port: str
+    log_offset: int
+    # Where the milestone starts, as number of characters to skip of the
+    # chunk at "log_offset".
+    skip: int
+    stream_offset: int
+
+
+def log_open(filename: str) -> typing.BinaryIO:
+    f = open(filename, "rb")
+    if f.read(2) == b"\x1f\x8b":
+        f.close()
+        return typing.cast(typing.BinaryIO, gzip.open(filename, "rb"))
+    f.seek(0)
+    return f
+
+
+def _decode_repr(s: str) -> str:
+    # Like ast.literal_eval() for the repr() of a str, but much faster.
+    if len(s) < 2 or s[0] not in "'\"" or s[-1] != s[0]:
+        raise ValueError(f"not a string literal: {s!r}")
+    s = s[1:-1]
+    if "\\" not in s:
+        return s
+    # Non-latin1 characters are kept as "\uXXXX" escapes for "unicode_escape".
+    return s.encode("latin-1", "backslashreplace").decode("unicode_escape")
+
+
+def iter_chunks(
+    f: typing.BinaryIO,
+    *,
+    log_offset: int = 0,
+    stream_offsets: Optional[dict[str, int]] = None,
+) -> typing.Iterator[Chunk]:
+    # Lazily read the log lines starting at "log_offset" and yield the
+    # decoded data of the "read" lines.
+    if stream_offsets is None:
+        stream_offsets = {}
+    f.seek(log_offset)
+    offset = log_offset
+    for line in f:
+        line_offset = offset
+        offset += len(line)
+        m = READ_LINE_PATTERN.search(line)
+        if not m:
+            continue
+        try:
+            data = _decode_repr(m.group("repr").decode(errors="surrogateescape"))
+        except ValueError:
+            logger.warning(f"serial-log: cannot parse line at offset {line_offset}")
+            continue
+        if not data:
+            continue
+        port = m.group("port").decode(errors="replace")
+        stream_offset = stream_offsets.get(port, 0)
+        stream_offsets[port] = stream_offset + len(data)
+        yield Chunk(
+            port=port,
+            data=data,
+            log_offset=line_offset,
+            stream_offset=stream_offset,
+        )
+
+
+class MilestoneWatcher:
+    # Finds the first occurrence of each milestone in console output that is
+    # fed incrementally.
+
+    def __init__(self) -> None:
+        self._tail = ""
+        self.seen: set[str] = set()
+
+    def feed(self, data: str) -> list[str]:
+        window = self._tail + data
+        found = []
+        for name, pattern in MILESTONES:
+            if name in self.seen:
+                continue
+            m = pattern.search(window)
+            if m and m.end() > len(self._tail):
+                self.seen.add(name)
+                found.append((m.start(), name))
+        self._tail = window[-_TAIL_SIZE:]
+        return [name for _, name in sorted(found)]
+
+
+class _PortScanner:
+    # Collects the output of one port and searches it for milestones in
+    # batches. Searching each chunk separately would be much slower.
+
+    def __init__(self, port: str) -> None:
+        self.port = port
+        self.chunks: list[Chunk] = []
+        self.size = 0
+        # The end of the previous batch. Matches may start there.
+        self.tail = ""
+        self.tail_chunks: list[Chunk] = []
+
+    def add(self, chunk: Chunk) -> None:
+        self.chunks.append(chunk)
+        self.size += len(chunk.data)
+
+    def scan(self) -> list[tuple[int, int, str, Chunk]]:
+        # Returns the milestones as (log-offset, skip, name, chunk) tuples.
+        if not self.chunks:
+            return []
+        chunks = self.tail_chunks + self.chunks
+        window = self.tail + "".join(c.data for c in self.chunks)
+        window_start = self.chunks[0].stream_offset - len(self.tail)
+        starts = [c.stream_offset for c in chunks]
+
+        found = []
+        for name, pattern in MILESTONES:
+            for m in pattern.finditer(window):
+                if m.end() <= len(self.tail):
+                    continue
+                stream_offset = max(window_start + m.start(), starts[0])
+                chunk = chunks[bisect.bisect_right(starts, stream_offset) - 1]
+                found.append(
+                    (chunk.log_offset, stream_offset - chunk.stream_offset, name, chunk)
+                )
+
+        self.tail = window[-_TAIL_SIZE:]
+        tail_start = window_start + len(window) - len(self.tail)
+        self.tail_chunks = [
+            c for c in chunks if c.stream_offset + len(c.data) > tail_start
+        ]
+        self.chunks = []
+        self.size = 0
+        return found
+
+
+def build_index(f: typing.BinaryIO) -> list[Milestone]:
+    result: list[Milestone] = []
+    run = 0
+    run_milestones: set[str] = set()
+    scanners: dict[str, _PortScanner] = {}
+
+    def _scan() -> None:
+        nonlocal run, run_milestones
+        # Scan all ports at once. Sorted by the position in the log, the
+        # milestones of all ports are in order.
+        found = [x for scanner in scanners.values() for x in scanner.scan()]
+        for log_offset, skip, name, chunk in sorted(found, key=lambda x: x[:2]):
+            if name in ("scp-menu", "boot") and run_milestones - {"scp-menu"}:
+                # The DPU was reset (via the SCP menu) or booted again.
+                run += 1
+                run_milestones = set()
+            if name in run_milestones:
+                continue
+            run_milestones.add(name)
+            result.append(
+                Milestone(
+                    run=run,
+                    name=name,
+                    port=chunk.port,
+                    log_offset=log_offset,
+                    skip=skip,
+                    stream_offset=chunk.stream_offset + skip,
+                )
+            )
+
+    size = 0
+    for chunk in iter_chunks(f):
+        scanner = scanners.get(chunk.port)
+        if scanner is None:
+            scanner = _PortScanner(chunk.port)
+            scanners[chunk.port] = scanner
+        scanner.add(chunk)
+        size += len(chunk.data)
+        if size >= _SCAN_SIZE:
+            _scan()
+            size = 0
+    _scan()
+    return result
+
+
+def index_filename(filename: str) -> str:
+    return f"{filename}.index.json"
+
+
+def load_index(filename: str, *, rebuild: bool = False) -> list[Milestone]:
+    # The index is stored next to the log file. It is valid as long as the
+    # log file does not change.
+    st = os.stat(filename)
+    stamp = {"version": INDEX_VERSION, "size": st.st_size, "mtime": st.st_mtime}
+    idx_file = index_filename(filename)
+
+    if not rebuild:
+        data = common_dpu.json_read(idx_file)
+        if isinstance(data, dict) and data.get("stamp") == stamp:
+            try:
+                return [Milestone(**e) for e in data["milestones"]]
+            except Exception:
+                pass
+
+    logger.info(f"serial-log: indexing {filename!r}")
+    with log_open(filename) as f:
+        milestones = build_index(f)
+    try:
+        common_dpu.json_write_atomic(
+            idx_file,
+            {
+                "stamp": stamp,
+                "milestones": [dataclasses.asdict(m) for m in milestones],
+            },
+        )
+    except OSError as e:
+        logger.warning(f"serial-log: cannot write index {idx_file!r}: {e}")
+    return milestones
+
+
+def find_milestone(
+    milestones: list[Milestone],
+    *,
+    run: int,
+    name: str,
+) -> Optional[Milestone]:
+    for m in milestones:
+        if m.run == run and m.name == name:
+            return m
+    return None
+
+
+def write_stream(
+    f: typing.BinaryIO,
+    out: typing.TextIO,
+    *,
+    port: str,
+    start: Optional[Milestone] = None,
+    end: Optional[Milestone] = None,
+) -> None:
+    # Write the console output of "port", from milestone "start" up to
+    # milestone "end".
+    skip = 0
+    stream_offsets: dict[str, int] = {}
+    log_offset = 0
+    if start is not None:
+        log_offset = start.log_offset
+        skip = start.skip
+        stream_offsets[port] = start.stream_offset - start.skip
+    for chunk in iter_chunks(f, log_offset=log_offset, stream_offsets=stream_offsets):
+        if chunk.port != port:
+            continue
+        data = chunk.data[skip:]
+        if end is not None:
+            limit = end.stream_offset - chunk.stream_offset - skip
+            if limit <= 0:
+                break
+            data = data[:limit]
+        skip = 0
+        out.write(data)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Extract the serial console output from the log of pxeboot.py/fwupdate.py/reset.py.\n\n"
+        'The log contains the data as "serial[/dev/ttyUSB0]: read ..." lines. This prints the decoded console output. '
+        f'With "--list", "--from" or "--to", the tool uses an index of the boot milestones ({", ".join(MILESTONE_NAMES)}). '
+        "The index is stored next to the log file, so that later calls can jump right to a milestone. "
+        "A new run starts when the DPU gets reset again.",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("logfile", help="The log file. It may be gzip compressed.")
+    parser.add_argument(
+        "--port",
+        default=common_dpu.TTYUSB0,
+        help=f"The serial port to show. Defaults to {common_dpu.TTYUSB0}.",
+    )
+    parser.add_argument(
+        "-l",
+        "--list",
+        action="store_true",
+        help="List the milestones per run instead of printing the output.",
+    )
+    parser.add_argument(
+        "-r",
+        "--run",
+        type=int,
+        default=None,
+        help="The run for --from/--to. Defaults to the last run.",
+    )
+    parser.add_argument(
+        "--from",
+        dest="from_milestone",
+        choices=MILESTONE_NAMES,
+        default=None,
+        help="Start printing at this milestone.",
+    )
+    parser.add_argument(
+        "--to",
+        dest="to_milestone",
+        choices=MILESTONE_NAMES,
+        default=None,
+        help="Stop printing at this milestone.",
+    )
+    parser.add_argument(
+        "--reindex",
+        action="store_true",
+        help="Rebuild the index, even if it seems up to date.",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    milestones: list[Milestone] = []
+    if args.list or args.from_milestone or args.to_milestone or args.reindex:
+        milestones = load_index(args.logfile, rebuild=args.reindex)
+
+    if args.list:
+        for m in milestones:
+            print(
+                f"run {m.run:3}  {m.name:<10} {m.port:<14} log-offset {m.log_offset:>12}  stream-offset {m.stream_offset:>10}"
+            )
+        return
+
+    run = args.run
+    if run is None:
+        run = max((m.run for m in milestones), default=0)
+
+    start: Optional[Milestone] = None
+    end: Optional[Milestone] = None
+    if args.from_milestone:
+        start = find_milestone(milestones, run=run, name=args.from_milestone)
+        if start is None:
+            logger.error_and_exit(f"No milestone {args.from_milestone!r} in run {run}")
+    if args.to_milestone:
+        end = find_milestone(milestones, run=run, name=args.to_milestone)
+        if end is None:
+            logger.error_and_exit(f"No milestone {args.to_milestone!r} in run {run}")
+    if start is not None and end is not None and start.port != end.port:
+        logger.error_and_exit("--from and --to are on different serial ports")
+    port = start.port if start else (end.port if end else args.port)
+
+    with log_open(args.logfile) as f:
+        write_stream(f, sys.stdout, port=port, start=start, end=end)
+
+
+if __name__ == "__main__":
+    common_dpu.run_main(main)
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+from collections.abc import Iterable
+from typing import Callable
+from typing import Optional
+
+from common_dpu import logger
+
+
+SSH_PORT = 22
+
+# How often BootProber.poll() should be called.
+DEFAULT_INTERVAL = 2.0
+
+
+async def _read_banner(ip: str, port: int, timeout: float) -> Optional[str]:
+    # The identification string ("SSH-2.0-OpenSSH_9.9") that an SSH server
+    # sends first, or None.
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(ip, port),
+            timeout,
+        )
+    except (OSError, asyncio.TimeoutError):
+        return None
+    try:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+    except (OSError, asyncio.TimeoutError, ValueError):
+        return None
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+    if not line.startswith(b"SSH-"):
+        return None
+    return line.rstrip(b"\r\n").decode(errors="replace")
+
+
+async def _read_banners(
+    ips: list[str], port: int, timeout: float
+) -> list[Optional[str]]:
+    return await asyncio.gather(*(_read_banner(ip, port, timeout) for ip in ips))
+
+
+def probe_banners(
+    ips: Iterable[str],
+    *,
+    port: int = SSH_PORT,
+    timeout: float = 1.0,
+) -> dict[str, str]:
+    # Connect to all "ips" at once. Returns the ones with an SSH server (in
+    # the order of "ips") and their banner. Unreachable addresses take at
+    # most "timeout" seconds, in parallel.
+    ips = list(ips)
+    banners = asyncio.run(_read_banners(ips, port, timeout))
+    return {ip: banner for ip, banner in zip(ips, banners) if banner is not None}
+
+
+class BootProber:
+    """
+    Watches the addresses where the booting DPU may show up, for an SSH
+    server. Each poll() connects to all of them at once and reads the SSH
+    banner. Only for the first address that answers, "ready" runs a real
+    (authenticated) command. An address that has SSH but is not "ready"
+    (like the installer) is asked again after "retry_not_ready" seconds.
+    """
+
+    def __init__(
+        self,
+        ips: Iterable[str],
+        *,
+        ready: Callable[[str], bool],
+        port: int = SSH_PORT,
+        timeout: float = 1.0,
+        retry_not_ready: float = 30.0,
+    ) -> None:
+        self.ips = list(ips)
+        self.ready = ready
+        self.port = port
+        self.timeout = timeout
+        self.retry_not_ready = retry_not_ready
+        self._not_ready: dict[str, float] = {}
+        self._banners: dict[str, str] = {}
+
+    def poll(self) -> Optional[str]:
+        # Returns the first of "ips" that is ready, or None.
+        answered = probe_banners(self.ips, port=self.port, timeout=self.timeout)
+        for ip, banner in answered.items():
+            if self._banners.get(ip) != banner:
+                self._banners[ip] = banner
+                logger.info(f"ssh-prober: {ip} answers with {banner!r}")
+            now = time.monotonic()
+            if now < self._not_ready.get(ip, 0.0):
+                continue
+            if self.ready(ip):
+                return ip
+            logger.info(f"ssh-prober: {ip} has SSH, but is not ready")
+            self._not_ready[ip] = now + self.retry_not_ready
+        return None
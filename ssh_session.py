@@ -0,0 +1,253 @@
+import dataclasses
+import logging
+import select
+import shlex
+import socket
+import threading
+import time
+
+from collections.abc import Iterable
+from typing import Optional
+from typing import Union
+
+import paramiko
+
+from ktoolbox import common
+
+import common_dpu
+
+from common_dpu import logger
+
+
+# Like ssh(1), when the connection fails.
+RETURNCODE_CONNECTION_FAILED = 255
+
+# Like "ssh -o LogLevel=QUIET". We log the results ourselves.
+logging.getLogger("paramiko").setLevel(logging.WARNING)
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class Result:
+    out: str
+    err: str
+    returncode: int
+
+    @property
+    def success(self) -> bool:
+        return self.returncode == 0
+
+    def __bool__(self) -> bool:
+        return self.success
+
+
+class SessionError(Exception):
+    pass
+
+
+class Session:
+    """
+    One authenticated SSH connection to "host". Commands and file transfers
+    run on channels of the same transport, so only the first one pays for
+    the connection and key exchange. If the transport dies (like when the
+    host reboots), the next command connects again. Like pxeboot did with
+    "ssh -o StrictHostKeyChecking=no", host keys are not checked.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        *,
+        user: str,
+        key_filename: str,
+        port: int = 22,
+        connect_timeout: float = 10.0,
+    ) -> None:
+        self.host = host
+        self.user = user
+        self.key_filename = key_filename
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self._lock = threading.Lock()
+        self._client: Optional[paramiko.SSHClient] = None
+
+    def __repr__(self) -> str:
+        return f"Session({self.user}@{self.host}:{self.port})"
+
+    def _close_locked(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_locked()
+
+    def _transport(self) -> tuple[paramiko.Transport, bool]:
+        # Returns the transport, and whether it was reused.
+        with self._lock:
+            if self._client is not None:
+                transport = self._client.get_transport()
+                if transport is not None and transport.is_active():
+                    return transport, True
+                self._close_locked()
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            time_start = time.monotonic()
+            try:
+                client.connect(
+                    self.host,
+                    port=self.port,
+                    username=self.user,
+                    key_filename=self.key_filename,
+                    timeout=self.connect_timeout,
+                    banner_timeout=self.connect_timeout,
+                    auth_timeout=self.connect_timeout,
+                    look_for_keys=False,
+                    allow_agent=False,
+                )
+            except (paramiko.SSHException, OSError, EOFError) as e:
+                client.close()
+                raise SessionError(f"{self!r}: {e}")
+            transport = common.unwrap(client.get_transport())
+            # Notice a dead connection (the DPU reboots) while it is idle.
+            transport.set_keepalive(5)
+            logger.debug(
+                f"ssh: connected {self!r} in {time.monotonic() - time_start:.3f}s"
+            )
+            self._client = client
+            return transport, False
+
+    def _exec(
+        self,
+        transport: paramiko.Transport,
+        cmd: str,
+        timeout: Optional[float],
+    ) -> Result:
+        chan = transport.open_session(timeout=self.connect_timeout)
+        with chan:
+            chan.exec_command(cmd)
+            chan.shutdown_write()
+            out: list[bytes] = []
+            err: list[bytes] = []
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                if chan.recv_ready():
+                    out.append(chan.recv(65536))
+                    continue
+                if chan.recv_stderr_ready():
+                    err.append(chan.recv_stderr(65536))
+                    continue
+                if chan.exit_status_ready():
+                    break
+                wait = 1.0
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout(f"command timed out after {timeout}s")
+                    wait = min(wait, remaining)
+                select.select([chan], [], [], wait)
+            # After the exit status, the remaining output may still arrive.
+            while data := chan.recv(65536):
+                out.append(data)
+            while data := chan.recv_stderr(65536):
+                err.append(data)
+            return Result(
+                out=b"".join(out).decode(errors="replace"),
+                err=b"".join(err).decode(errors="replace"),
+                returncode=chan.recv_exit_status(),
+            )
+
+    def run(
+        self,
+        cmd: Union[str, Iterable[str]],
+        *,
+        timeout: Optional[float] = 60.0,
+        log_level_result: int = logging.INFO,
+    ) -> Result:
+        # Run "cmd" (a shell command, or the arguments to quote) on the host.
+        # A failure to connect is returned with returncode 255, like ssh(1).
+        if not isinstance(cmd, str):
+            cmd = shlex.join(cmd)
+        time_start = time.monotonic()
+        for _ in range(2):
+            try:
+                transport, reused = self._transport()
+            except SessionError as e:
+                result = Result(
+                    out="", err=str(e), returncode=RETURNCODE_CONNECTION_FAILED
+                )
+                break
+            try:
+                result = self._exec(transport, cmd, timeout)
+                break
+            except (paramiko.SSHException, OSError, EOFError) as e:
+                self.close()
+                result = Result(
+                    out="",
+                    err=f"{self!r}: {e}",
+                    returncode=RETURNCODE_CONNECTION_FAILED,
+                )
+                if not reused or isinstance(e, socket.timeout):
+                    break
+                # The connection broke since the last command. Connect again.
+        logger.log(
+            log_level_result,
+            f"ssh: {self.user}@{self.host}: {cmd!r} returned {result.returncode} in {time.monotonic() - time_start:.3f}s (out {result.out!r}, err {result.err!r})",
+        )
+        return result
+
+
+class SessionPool:
+    """
+    The Sessions of this process, one per host, user and key.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._sessions: dict[tuple[str, int, str, str], Session] = {}
+        self._close_at_exit = False
+
+    def get(
+        self,
+        host: str,
+        *,
+        user: str,
+        key_filename: str,
+        port: int = 22,
+    ) -> Session:
+        key = (host, port, user, key_filename)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = Session(
+                    host,
+                    user=user,
+                    key_filename=key_filename,
+                    port=port,
+                )
+                self._sessions[key] = session
+                if not self._close_at_exit:
+                    # Only processes that use SSH close their sessions at exit.
+                    self._close_at_exit = True
+                    common_dpu.global_cleanup.add(self.close)
+            return session
+
+    def close(self) -> None:
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+_pool = SessionPool()
+
+
+def get(
+    host: str,
+    *,
+    user: str,
+    key_filename: str,
+    port: int = 22,
+) -> Session:
+    return _pool.get(host, user=user, key_filename=key_filename, port=port)
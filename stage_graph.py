@@ -0,0 +1,85 @@
+import threading
+
+from collections.abc import Iterable
+from typing import Callable
+from typing import Optional
+
+import timeline
+
+from common_dpu import logger
+
+
+class StageGraph:
+    """
+    Named stages (functions) that run as soon as the stages they depend on
+    are done. Independent stages run at the same time, each in its own
+    thread and recorded in the timeline. After a stage fails, no further
+    stages are started. run() waits for the running ones and raises the
+    first failure.
+    """
+
+    def __init__(self) -> None:
+        self._stages: dict[str, tuple[Callable[[], None], tuple[str, ...]]] = {}
+
+    def add(
+        self,
+        name: str,
+        fcn: Callable[[], None],
+        *,
+        after: Iterable[str] = (),
+    ) -> None:
+        after = tuple(after)
+        if name in self._stages:
+            raise ValueError(f"stage {name!r} already exists")
+        for dep in after:
+            if dep not in self._stages:
+                raise ValueError(f"stage {name!r} depends on unknown stage {dep!r}")
+        self._stages[name] = (fcn, after)
+
+    def run(self) -> None:
+        cond = threading.Condition()
+        done: set[str] = set()
+        running: set[str] = set()
+        error: Optional[BaseException] = None
+
+        def _run(name: str, fcn: Callable[[], None]) -> None:
+            nonlocal error
+            try:
+                with timeline.stage(name):
+                    fcn()
+            except BaseException as e:
+                logger.error(f"stage {name!r} failed: {e}")
+                with cond:
+                    if error is None:
+                        error = e
+            finally:
+                with cond:
+                    running.discard(name)
+                    done.add(name)
+                    cond.notify_all()
+
+        threads = []
+        pending = dict(self._stages)
+        with cond:
+            while True:
+                if error is None:
+                    for name, (fcn, after) in list(pending.items()):
+                        if not all(dep in done for dep in after):
+                            continue
+                        del pending[name]
+                        running.add(name)
+                        th = threading.Thread(
+                            target=_run,
+                            args=(name, fcn),
+                            name=f"stage-{name}",
+                            daemon=True,
+                        )
+                        threads.append(th)
+                        th.start()
+                if not running:
+                    break
+                cond.wait()
+        for th in threads:
+            th.join()
+        if error is not None:
+            raise error
@@ -0,0 +1,452 @@
+import concurrent.futures
+import contextlib
+import errno
+import mmap
+import os
+import select
+import socket
+import struct
+import threading
+import time
+import typing
+
+from typing import Optional
+
+import common_dpu
+import events
+import iso_image
+import timeline
+
+from common_dpu import logger
+
+
+DEFAULT_PORT = 69
+
+# The largest block that fits into one ethernet frame (1500 bytes MTU, minus
+# the IP, UDP and TFTP headers).
+DEFAULT_MAX_BLKSIZE = 1468
+
+DEFAULT_MAX_WINDOWSIZE = 64
+
+_OP_RRQ = 1
+_OP_WRQ = 2
+_OP_DATA = 3
+_OP_ACK = 4
+_OP_ERROR = 5
+_OP_OACK = 6
+
+_ERR_UNDEFINED = 0
+_ERR_NOT_FOUND = 1
+_ERR_ACCESS = 2
+_ERR_ILLEGAL_OP = 4
+_ERR_UNKNOWN_TID = 5
+
+
+class _TransferError(Exception):
+    pass
+
+
+def _error_packet(code: int, msg: str) -> bytes:
+    return struct.pack("!HH", _OP_ERROR, code) + msg.encode() + b"\0"
+
+
+def _parse_request(packet: bytes) -> tuple[int, str, str, dict[str, str]]:
+    # Returns (opcode, filename, mode, options) of a RRQ/WRQ. The option names
+    # are lower case.
+    if len(packet) < 2:
+        raise ValueError("short packet")
+    (opcode,) = struct.unpack_from("!H", packet)
+    fields = packet[2:].split(b"\0")
+    if len(fields) < 3 or fields[-1] != b"":
+        raise ValueError("malformed request")
+    fields = fields[:-1]
+    filename = fields[0].decode(errors="surrogateescape")
+    mode = fields[1].decode(errors="replace").lower()
+    options: dict[str, str] = {}
+    for i in range(2, len(fields) - 1, 2):
+        options[fields[i].decode(errors="replace").lower()] = fields[i + 1].decode(
+            errors="replace"
+        )
+    return opcode, filename, mode, options
+
+
+def _option_int(options: dict[str, str], name: str) -> Optional[int]:
+    try:
+        return int(options[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class _ImageData:
+    # A file in an image, that can be sliced like bytes.
+
+    def __init__(self, fs: iso_image.ImageFs, entry: iso_image.Entry) -> None:
+        self.fs = fs
+        self.entry = entry
+
+    def __len__(self) -> int:
+        return self.entry.size
+
+    def __getitem__(self, s: slice) -> bytes:
+        return self.fs.read(self.entry, s.start, s.stop - s.start)
+
+
+_Data = typing.Union[bytes, mmap.mmap, _ImageData]
+
+
+class _Transfer:
+    # One read transfer, from its own UDP socket ("transfer identifier").
+
+    def __init__(
+        self,
+        server: "TftpServer",
+        sock: socket.socket,
+        client: tuple[str, int],
+        filename: str,
+        options: dict[str, str],
+    ) -> None:
+        self.server = server
+        self.sock = sock
+        self.client = client
+        self.filename = filename
+        self.options = options
+        self.blksize = 512
+        self.windowsize = 1
+        self.timeout = server.timeout
+        self.retransmits = 0
+
+    def _send(self, packet: bytes) -> None:
+        self.sock.sendto(packet, self.client)
+
+    def _recv(self, timeout: float) -> Optional[tuple[int, int]]:
+        # Returns the (opcode, block) of the next packet from the client, or
+        # None on timeout.
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            r, _, _ = select.select([self.sock], [], [], remaining)
+            if not r:
+                return None
+            packet, addr = self.sock.recvfrom(65536)
+            if addr != self.client:
+                self.sock.sendto(
+                    _error_packet(_ERR_UNKNOWN_TID, "Unknown transfer ID"), addr
+                )
+                continue
+            if len(packet) < 4:
+                continue
+            opcode, block = struct.unpack_from("!HH", packet)
+            if opcode == _OP_ERROR:
+                msg = packet[4:].split(b"\0")[0].decode(errors="replace")
+                raise _TransferError(f"client error {block}: {msg}")
+            return opcode, block
+
+    def _negotiate(self, size: int) -> dict[str, str]:
+        # The options of RFC 2347 (option extension), RFC 2348 (blksize),
+        # RFC 2349 (timeout, tsize) and RFC 7440 (windowsize) that we accept.
+        # Unknown options are ignored.
+        oack: dict[str, str] = {}
+        blksize = _option_int(self.options, "blksize")
+        if blksize is not None and blksize >= 8:
+            self.blksize = min(blksize, self.server.max_blksize)
+            oack["blksize"] = str(self.blksize)
+        windowsize = _option_int(self.options, "windowsize")
+        if windowsize is not None and windowsize >= 1:
+            self.windowsize = min(windowsize, self.server.max_windowsize)
+            oack["windowsize"] = str(self.windowsize)
+        timeout = _option_int(self.options, "timeout")
+        if timeout is not None and 1 <= timeout <= 255:
+            self.timeout = float(timeout)
+            oack["timeout"] = str(timeout)
+        if "tsize" in self.options:
+            oack["tsize"] = str(size)
+        return oack
+
+    def _send_oack(self, oack: dict[str, str]) -> None:
+        packet = struct.pack("!H", _OP_OACK) + b"".join(
+            k.encode() + b"\0" + v.encode() + b"\0" for k, v in oack.items()
+        )
+        for _ in range(self.server.retries + 1):
+            self._send(packet)
+            while True:
+                reply = self._recv(self.timeout)
+                if reply is None:
+                    break
+                if reply == (_OP_ACK, 0):
+                    return
+            self.retransmits += 1
+        raise _TransferError("timeout waiting for the ACK of the OACK")
+
+    def run(self, data: _Data) -> int:
+        # Send "data" and return the number of bytes sent.
+        size = len(data)
+        oack = self._negotiate(size)
+        if oack:
+            self._send_oack(oack)
+
+        blksize = self.blksize
+        # The last block is shorter than "blksize", possibly empty.
+        block_count = size // blksize + 1
+        # The first block that was not yet acknowledged. Blocks are numbered
+        # from 1, and the 16 bit number on the wire wraps around.
+        base = 1
+        tries = 0
+        # The "base" for which a duplicate ACK made us send the window again.
+        dup_base = 0
+        while base <= block_count:
+            last = min(base + self.windowsize - 1, block_count)
+            for block in range(base, last + 1):
+                offset = (block - 1) * blksize
+                self._send(
+                    struct.pack("!HH", _OP_DATA, block & 0xFFFF)
+                    + data[offset : offset + blksize]
+                )
+
+            while True:
+                reply = self._recv(self.timeout)
+                if reply is None:
+                    tries += 1
+                    if tries > self.server.retries:
+                        raise _TransferError(f"timeout waiting for ACK of block {base}")
+                    self.retransmits += last - base + 1
+                    break
+                opcode, ack = reply
+                if opcode != _OP_ACK:
+                    continue
+                # The block (in the current window, or the one before) that
+                # the 16 bit number refers to.
+                acked = base - 1 + ((ack - (base - 1)) & 0xFFFF)
+                if acked == base - 1:
+                    # A duplicate ACK. With a window, the client missed the
+                    # first block of the window and asks for it again. Only
+                    # do that once, because the client sends a duplicate ACK
+                    # for each of the other blocks too. In lock-step mode,
+                    # this would lead to the "Sorcerer's Apprentice" problem,
+                    # so wait for our timeout instead.
+                    if self.windowsize > 1 and dup_base != base:
+                        dup_base = base
+                        self.retransmits += last - base + 1
+                        break
+                    continue
+                if acked > last:
+                    # An old ACK.
+                    continue
+                tries = 0
+                base = acked + 1
+                # If the client missed a block of the window, it acknowledges
+                # the last one in sequence. Continue from there.
+                break
+        return size
+
+
+class TftpServer(common_dpu.Service):
+    """
+    Serve the files below "root" via TFTP (read only). The block size, window
+    size, timeout and transfer size options are negotiated, so that clients
+    like UEFI and u-boot can have several large blocks in flight. Each
+    transfer is served by a thread of a pool. Paths in "links" are served
+    from images, instead of from "root".
+    """
+
+    def __init__(
+        self,
+        root: str,
+        *,
+        port: int = DEFAULT_PORT,
+        host: str = "",
+        max_blksize: int = DEFAULT_MAX_BLKSIZE,
+        max_windowsize: int = DEFAULT_MAX_WINDOWSIZE,
+        timeout: float = 1.0,
+        retries: int = 5,
+        threads: int = 32,
+        links: Optional[iso_image.Links] = None,
+    ) -> None:
+        super().__init__(f"tftpd[{port}]")
+        self.root = root
+        self.port = port
+        self.host = host
+        self.max_blksize = max_blksize
+        self.max_windowsize = max_windowsize
+        self.timeout = timeout
+        self.retries = retries
+        self.threads = threads
+        self.links = links
+        self._sock: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._stop_r = -1
+        self._stop_w = -1
+        self._stats_lock = threading.Lock()
+        self.stats_transfers = 0
+        self.stats_bytes = 0
+
+    def start(self) -> None:
+        assert self._sock is None
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind((self.host, self.port))
+        except OSError as e:
+            sock.close()
+            if e.errno == errno.EADDRINUSE:
+                raise RuntimeError(
+                    f"tftp: port {self.port} is in use. Is in.tftpd (or tftp.socket) still running on the host?"
+                ) from e
+            raise
+        self._sock = sock
+        self.port = sock.getsockname()[1]
+        self._stop_r, self._stop_w = os.pipe()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.threads,
+            thread_name_prefix="tftp",
+        )
+        self._thread = threading.Thread(
+            target=self._serve,
+            name=self.name,
+            daemon=True,
+        )
+        self._thread.start()
+        logger.info(f"tftp: serving {self.root!r} on port {self.port}")
+
+    def stop(self) -> None:
+        if self._sock is None:
+            return
+        os.write(self._stop_w, b"x")
+        assert self._thread is not None
+        self._thread.join()
+        assert self._executor is not None
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._sock.close()
+        os.close(self._stop_r)
+        os.close(self._stop_w)
+        logger.info(
+            f"tftp: served {self.stats_transfers} transfers with {self.stats_bytes} bytes"
+        )
+        self._sock = None
+        self._thread = None
+        self._executor = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def links_set(self, links: Optional[iso_image.Links]) -> None:
+        # Serve other images (for the next job), without restarting. The
+        # transfers in progress still hold a reference on the old images.
+        old_links = self.links
+        self.links = links
+        if old_links is not None and old_links is not links:
+            old_links.close()
+
+    def _serve(self) -> None:
+        assert self._sock is not None
+        assert self._executor is not None
+        while True:
+            r, _, _ = select.select([self._sock.fileno(), self._stop_r], [], [])
+            if self._stop_r in r:
+                return
+            try:
+                packet, client = self._sock.recvfrom(65536)
+            except OSError:
+                continue
+            self._executor.submit(self._handle, packet, client)
+
+    def _resolve(self, filename: str) -> str:
+        # Like "in.tftpd --secure": paths are relative to the root, and may
+        # not leave it.
+        path = os.path.normpath("/" + filename.lstrip("/"))
+        if "\0" in path:
+            raise PermissionError(filename)
+        return os.path.join(self.root, path.lstrip("/"))
+
+    @contextlib.contextmanager
+    def _open(self, filename: str) -> typing.Iterator["_Data"]:
+        links = self.links
+        image = links.lookup(filename) if links is not None else None
+        if image is not None:
+            fs, entry = image
+            with fs:
+                if entry.is_dir:
+                    raise IsADirectoryError(filename)
+                yield _ImageData(fs, entry)
+            return
+        with open(self._resolve(filename), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                yield b""
+                return
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except OSError:
+                yield f.read()
+                return
+            with m:
+                yield m
+
+    def _handle(self, packet: bytes, client: tuple[str, int]) -> None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind((self.host, 0))
+            self._handle_request(sock, packet, client)
+        except Exception as e:
+            logger.warning(f"tftp: {client[0]}:{client[1]}: {e}")
+        finally:
+            sock.close()
+
+    def _handle_request(
+        self, sock: socket.socket, packet: bytes, client: tuple[str, int]
+    ) -> None:
+        try:
+            opcode, filename, mode, options = _parse_request(packet)
+        except ValueError as e:
+            sock.sendto(_error_packet(_ERR_ILLEGAL_OP, str(e)), client)
+            return
+        if opcode == _OP_WRQ:
+            sock.sendto(_error_packet(_ERR_ACCESS, "Read-only server"), client)
+            return
+        if opcode != _OP_RRQ:
+            sock.sendto(_error_packet(_ERR_ILLEGAL_OP, "Illegal operation"), client)
+            return
+        if mode not in ("octet", "netascii"):
+            sock.sendto(
+                _error_packet(_ERR_UNDEFINED, f"Unsupported mode {mode}"), client
+            )
+            return
+
+        events.emit("tftp-request", client=client[0], path=filename)
+        transfer = _Transfer(self, sock, client, filename, options)
+        time_start = time.monotonic()
+        with contextlib.ExitStack() as stack:
+            try:
+                data = stack.enter_context(self._open(filename))
+            except FileNotFoundError:
+                logger.info(f"tftp: {client[0]}: RRQ {filename!r}: not found")
+                sock.sendto(_error_packet(_ERR_NOT_FOUND, "File not found"), client)
+                return
+            except OSError:
+                logger.info(f"tftp: {client[0]}: RRQ {filename!r}: access denied")
+                sock.sendto(_error_packet(_ERR_ACCESS, "Access violation"), client)
+                return
+            try:
+                sent = transfer.run(data)
+            except _TransferError as e:
+                logger.warning(f"tftp: {client[0]}: RRQ {filename!r}: {e}")
+                return
+
+        duration = time.monotonic() - time_start
+        rate = sent / duration / (1024 * 1024) if duration > 0 else 0.0
+        logger.info(
+            f"tftp: {client[0]}: RRQ {filename!r} {sent} bytes in {duration:.3f}s ({rate:.1f} MiB/s, blksize {transfer.blksize}, windowsize {transfer.windowsize}, {transfer.retransmits} retransmits)"
+        )
+        with self._stats_lock:
+            self.stats_transfers += 1
+            self.stats_bytes += sent
+        timeline.mark(
+            "tftp-get",
+            path=filename,
+            bytes=sent,
+            duration=duration,
+            blksize=transfer.blksize,
+            windowsize=transfer.windowsize,
+            retransmits=transfer.retransmits,
+        )
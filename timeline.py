@@ -0,0 +1,180 @@
+import contextlib
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+import typing
+
+from typing import Optional
+
+import common_dpu
+import serial_capture
+
+from common_dpu import logger
+
+
+class Timeline:
+    """
+    Records how long the named stages of a run take, and the time of single
+    events ("marks"). With a filename, each record is appended there as one
+    JSON object per line. Times are monotonic, in seconds since the timeline
+    started.
+    """
+
+    def __init__(self, filename: Optional[str] = None) -> None:
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._time_start = time.monotonic()
+        self._file: Optional[typing.TextIO] = None
+        self._finished = False
+        self._depth = threading.local()
+        # (depth, name, start, duration, status) for the summary. "duration"
+        # is None for marks and for stages that did not end yet.
+        self._records: list[tuple[int, str, float, Optional[float], str]] = []
+        if filename is not None:
+            self._file = open(filename, "a")
+            self._write(
+                {
+                    "event": "timeline",
+                    "tool": os.path.basename(sys.argv[0]),
+                    "argv": sys.argv,
+                    "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                }
+            )
+
+    def now(self) -> float:
+        return time.monotonic() - self._time_start
+
+    def _write(self, record: dict[str, typing.Any]) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(record) + "\n")
+                self._file.flush()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **data: typing.Any) -> typing.Iterator[None]:
+        depth = getattr(self._depth, "value", 0)
+        start = self.now()
+        with self._lock:
+            idx = len(self._records)
+            self._records.append((depth, name, start, None, "running"))
+        self._write({"event": "start", "name": name, "t": start, **data})
+        self._depth.value = depth + 1
+        status = "ok"
+        error: Optional[str] = None
+        try:
+            yield
+        except BaseException as e:
+            status = "failed"
+            error = str(e) or type(e).__name__
+            raise
+        finally:
+            self._depth.value = depth
+            end = self.now()
+            with self._lock:
+                self._records[idx] = (depth, name, start, end - start, status)
+            record: dict[str, typing.Any] = {
+                "event": "end",
+                "name": name,
+                "t": end,
+                "duration": end - start,
+                "status": status,
+            }
+            if error is not None:
+                record["error"] = error
+            self._write(record)
+
+    def mark(self, name: str, **data: typing.Any) -> None:
+        t = self.now()
+        with self._lock:
+            self._records.append(
+                (getattr(self._depth, "value", 0), name, t, None, "mark")
+            )
+        self._write({"event": "mark", "name": name, "t": t, **data})
+
+    def summary(self) -> list[str]:
+        with self._lock:
+            records = list(self._records)
+        if not records:
+            return []
+        width = max(len("stage"), *(2 * d + len(n) for d, n, *_ in records))
+        lines = [f"{'stage':<{width}}  {'start':>9}  {'seconds':>9}  status"]
+        for depth, name, start, duration, status in records:
+            name = "  " * depth + name
+            seconds = "" if duration is None else f"{duration:9.2f}"
+            lines.append(f"{name:<{width}}  {start:9.2f}  {seconds:>9}  {status}")
+        return lines
+
+    def finish(self) -> None:
+        # Log the summary and close the file. Only the first call does so.
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        for line in self.summary():
+            logger.info(f"timeline: {line}")
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_timeline = Timeline()
+
+_local = threading.local()
+
+
+def filename_create(directory: str, prefix: str, *, keep_count: int = 200) -> str:
+    # A new file name for a timeline. Only the newest "keep_count" timeline
+    # files are kept.
+    serial_capture.capture_cleanup(
+        directory,
+        prefix,
+        keep_count=keep_count - 1,
+        keep_bytes=64 * 1024 * 1024,
+    )
+    return f"{directory}/{prefix}.{datetime.datetime.now():%Y%m%d-%H%M%S.%f}.jsonl"
+
+
+def start(filename: Optional[str], *, finish_at_exit: bool = True) -> Timeline:
+    # Start recording the timeline of this run. At exit, the summary is
+    # logged (see common_dpu.global_cleanup). Without "finish_at_exit", the
+    # caller calls Timeline.finish() itself (like provisiond.py after each
+    # job).
+    global _timeline
+    _timeline = Timeline(filename)
+    if filename is not None:
+        logger.info(f"timeline: record to {filename!r}")
+    if finish_at_exit:
+        common_dpu.global_cleanup.add(_timeline.finish)
+    return _timeline
+
+
+def get() -> Timeline:
+    tl: Optional[Timeline] = getattr(_local, "timeline", None)
+    return _timeline if tl is None else tl
+
+
+@contextlib.contextmanager
+def use(tl: Timeline) -> typing.Iterator[None]:
+    # Record the stages and marks of this thread to "tl", instead of the
+    # timeline of the run. With several DPUs, each has its own timeline.
+    old: Optional[Timeline] = getattr(_local, "timeline", None)
+    _local.timeline = tl
+    try:
+        yield
+    finally:
+        _local.timeline = old
+
+
+def stage(name: str, **data: typing.Any) -> typing.ContextManager[None]:
+    return get().stage(name, **data)
+
+
+def mark(name: str, **data: typing.Any) -> None:
+    get().mark(name, **data)
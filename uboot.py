@@ -0,0 +1,115 @@
+import dataclasses
+import itertools
+import re
+import time
+
+from typing import Optional
+
+from ktoolbox import common
+
+from common_dpu import KEY_CTRL_M
+from common_dpu import logger
+
+
+UBOOT_PROMPT = "crb106-pcie>"
+
+
+class UBootError(RuntimeError):
+    pass
+
+
+@dataclasses.dataclass(frozen=True, **common.KW_ONLY_DATACLASS)
+class UBootResult:
+    cmd: str
+    output: str
+    # The exit status from "$?". None, if the shell does not support it.
+    status: Optional[int]
+    duration: float
+
+    @property
+    def success(self) -> bool:
+        return self.status is None or self.status == 0
+
+
+class UBoot:
+    """
+    Run commands on the u-boot prompt of the serial console. Each command
+    returns as soon as u-boot prints its exit status and the prompt comes
+    back, instead of sleeping for a fixed time.
+    """
+
+    def __init__(self, ser: common.Serial, *, prompt: str = UBOOT_PROMPT) -> None:
+        self.ser = ser
+        self.prompt = prompt
+        self._counter = itertools.count(1)
+
+    def run(
+        self,
+        cmd: str,
+        *,
+        timeout: float = 10.0,
+        check: bool = True,
+        expect: Optional[str] = None,
+        fail_pattern: Optional[str] = None,
+    ) -> UBootResult:
+        # The command is followed by "echo" of a unique marker with the exit
+        # status. The marker is printed at the start of a line, the echo of
+        # the command line that we type is not.
+        marker = f"__uboot_rc_{next(self._counter)}"
+        pattern = f"\n(?P<rc>{marker}=(\\S*))\r?\n"
+        if fail_pattern is not None:
+            pattern = f"{pattern}|(?P<fail>{fail_pattern})"
+
+        logger.info(f"u-boot: run {cmd!r}")
+        time_start = time.monotonic()
+        self.ser.send(f"{cmd}; echo {marker}=$?{KEY_CTRL_M}", sleep=0)
+        try:
+            buffer = self.ser.expect(re.compile(pattern), timeout)
+        except Exception as e:
+            # Interrupt the command, so that the prompt is usable again.
+            self.ser.send("\x03", sleep=0)
+            raise UBootError(
+                f"u-boot: command {cmd!r} did not complete within {timeout} seconds"
+            ) from e
+        duration = time.monotonic() - time_start
+
+        m = re.search(pattern, buffer)
+        assert m
+        if m.group("rc") is None:
+            self.ser.send("\x03", sleep=0)
+            raise UBootError(
+                f"u-boot: command {cmd!r} failed after {duration:.1f} seconds ({m.group('fail')!r})"
+            )
+
+        # Skip the echo of the command line that we typed.
+        output = buffer[: m.start()]
+        output = output.split("\n", 1)[1] if "\n" in output else ""
+        output = output.replace("\r", "")
+
+        status: Optional[int]
+        try:
+            status = int(m.group(2))
+        except ValueError:
+            status = None
+
+        # Wait for the prompt, which follows right away.
+        try:
+            self.ser.expect(self.prompt, 5, verbose=False)
+        except Exception:
+            pass
+
+        result = UBootResult(cmd=cmd, output=output, status=status, duration=duration)
+        logger.info(
+            f"u-boot: command {cmd!r} completed with status {status} in {duration:.1f} seconds"
+        )
+
+        if check:
+            if not result.success:
+                raise UBootError(
+                    f"u-boot: command {cmd!r} failed with status {status}: {output!r}"
+                )
+            if expect is not None and not re.search(expect, output):
+                raise UBootError(
+                    f"u-boot: command {cmd!r} did not print {expect!r}: {output!r}"
+                )
+        return result
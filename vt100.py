@@ -0,0 +1,303 @@
+import dataclasses
+import typing
+
+from typing import Optional
+
+
+# SGR color codes. DEFAULT_COLOR is the terminal's default color, as
+# selected by SGR 39/49 (and reset).
+BLACK = 0
+WHITE = 7
+DEFAULT_COLOR = -1
+
+
+@dataclasses.dataclass(frozen=True)
+class Attr:
+    fg: int = DEFAULT_COLOR
+    bg: int = DEFAULT_COLOR
+    bold: bool = False
+    reverse: bool = False
+
+
+DEFAULT_ATTR = Attr()
+
+
+@dataclasses.dataclass(frozen=True)
+class Cell:
+    char: str = " "
+    attr: Attr = DEFAULT_ATTR
+
+
+BLANK = Cell()
+
+
+@dataclasses.dataclass(frozen=True)
+class Menu:
+    # The entries of a vertical menu, from top to bottom, and the index of
+    # the highlighted entry.
+    entries: tuple[str, ...]
+    rows: tuple[int, ...]
+    col: int
+    cursor: int
+
+    @property
+    def cursor_entry(self) -> str:
+        return self.entries[self.cursor]
+
+
+class Screen:
+    """
+    A terminal emulator for the subset of VT100/ANSI that firmware setup
+    browsers use. Output from the serial console is fed incrementally with
+    feed(), escape sequences may be split across calls. The screen content is
+    kept as a grid of cells with their colors.
+    """
+
+    def __init__(self, *, rows: int = 60, cols: int = 200) -> None:
+        self.rows = rows
+        self.cols = cols
+        self._grid = [[BLANK] * cols for _ in range(rows)]
+        self._row = 0
+        self._col = 0
+        self._saved = (0, 0)
+        self._attr = DEFAULT_ATTR
+        self._pending = ""
+        # Counts the "erase display" requests. A full redraw of the UEFI
+        # setup browser starts with one.
+        self.clear_count = 0
+        self.generation = 0
+
+    def feed(self, data: str) -> None:
+        if not data:
+            return
+        self.generation += 1
+        s = self._pending + data
+        self._pending = ""
+        i = 0
+        n = len(s)
+        while i < n:
+            c = s[i]
+            if c == "\x1b":
+                end = self._parse_escape(s, i)
+                if end is None:
+                    # Incomplete. Wait for more data.
+                    self._pending = s[i:]
+                    return
+                i = end
+                continue
+            i += 1
+            if c == "\r":
+                self._col = 0
+            elif c == "\n":
+                self._linefeed()
+            elif c in ("\x08",):
+                self._col = max(0, self._col - 1)
+            elif c == "\t":
+                self._col = min(self.cols - 1, (self._col // 8 + 1) * 8)
+            elif c < " " or c == "\x7f":
+                pass
+            else:
+                self._put(c)
+
+    def _linefeed(self) -> None:
+        if self._row + 1 < self.rows:
+            self._row += 1
+        else:
+            del self._grid[0]
+            self._grid.append([BLANK] * self.cols)
+
+    def _put(self, c: str) -> None:
+        if self._col >= self.cols:
+            self._col = 0
+            self._linefeed()
+        self._grid[self._row][self._col] = Cell(c, self._attr)
+        self._col += 1
+
+    def _parse_escape(self, s: str, i: int) -> Optional[int]:
+        # Returns the index after the escape sequence starting at s[i], or
+        # None if the sequence is not yet complete.
+        if i + 1 >= len(s):
+            return None
+        c = s[i + 1]
+        if c == "[":
+            j = i + 2
+            while j < len(s):
+                if "\x40" <= s[j] <= "\x7e":
+                    self._csi(s[i + 2 : j], s[j])
+                    return j + 1
+                j += 1
+            return None
+        if c in "()":
+            # Character set designation. Ignored.
+            if i + 2 >= len(s):
+                return None
+            return i + 3
+        if c == "7":
+            self._saved = (self._row, self._col)
+        elif c == "8":
+            self._row, self._col = self._saved
+        elif c == "c":
+            self._erase(0, 0, self.rows, self.cols)
+            self._row, self._col = 0, 0
+            self._attr = DEFAULT_ATTR
+        return i + 2
+
+    def _csi(self, params_str: str, cmd: str) -> None:
+        if params_str.startswith("?"):
+            # Private modes (like hiding the cursor). Ignored.
+            return
+        params: list[int] = []
+        for p in params_str.split(";") if params_str else ():
+            try:
+                params.append(int(p))
+            except ValueError:
+                params.append(0)
+
+        def _p(idx: int, default: int) -> int:
+            if idx < len(params) and params[idx] != 0:
+                return params[idx]
+            return default
+
+        if cmd in "Hf":
+            self._row = min(self.rows, _p(0, 1)) - 1
+            self._col = min(self.cols, _p(1, 1)) - 1
+        elif cmd == "A":
+            self._row = max(0, self._row - _p(0, 1))
+        elif cmd == "B":
+            self._row = min(self.rows - 1, self._row + _p(0, 1))
+        elif cmd == "C":
+            self._col = min(self.cols - 1, self._col + _p(0, 1))
+        elif cmd == "D":
+            self._col = max(0, self._col - _p(0, 1))
+        elif cmd == "G":
+            self._col = min(self.cols, _p(0, 1)) - 1
+        elif cmd == "d":
+            self._row = min(self.rows, _p(0, 1)) - 1
+        elif cmd == "J":
+            mode = params[0] if params else 0
+            if mode == 0:
+                self._erase(self._row, self._col, self._row + 1, self.cols)
+                self._erase(self._row + 1, 0, self.rows, self.cols)
+            elif mode == 1:
+                self._erase(0, 0, self._row, self.cols)
+                self._erase(self._row, 0, self._row + 1, self._col + 1)
+            else:
+                self._erase(0, 0, self.rows, self.cols)
+                self.clear_count += 1
+        elif cmd == "K":
+            mode = params[0] if params else 0
+            if mode == 0:
+                self._erase(self._row, self._col, self._row + 1, self.cols)
+            elif mode == 1:
+                self._erase(self._row, 0, self._row + 1, self._col + 1)
+            else:
+                self._erase(self._row, 0, self._row + 1, self.cols)
+        elif cmd == "m":
+            self._sgr(params or [0])
+        elif cmd == "s":
+            self._saved = (self._row, self._col)
+        elif cmd == "u":
+            self._row, self._col = self._saved
+
+    def _sgr(self, params: list[int]) -> None:
+        attr = self._attr
+        for p in params:
+            if p == 0:
+                attr = DEFAULT_ATTR
+            elif p == 1:
+                attr = dataclasses.replace(attr, bold=True)
+            elif p == 22:
+                attr = dataclasses.replace(attr, bold=False)
+            elif p == 7:
+                attr = dataclasses.replace(attr, reverse=True)
+            elif p == 27:
+                attr = dataclasses.replace(attr, reverse=False)
+            elif 30 <= p <= 37:
+                attr = dataclasses.replace(attr, fg=p - 30)
+            elif 90 <= p <= 97:
+                attr = dataclasses.replace(attr, fg=p - 90 + 8)
+            elif p == 39:
+                attr = dataclasses.replace(attr, fg=DEFAULT_ATTR.fg)
+            elif 40 <= p <= 47:
+                attr = dataclasses.replace(attr, bg=p - 40)
+            elif 100 <= p <= 107:
+                attr = dataclasses.replace(attr, bg=p - 100 + 8)
+            elif p == 49:
+                attr = dataclasses.replace(attr, bg=DEFAULT_ATTR.bg)
+        self._attr = attr
+
+    def _erase(self, row0: int, col0: int, row1: int, col1: int) -> None:
+        # Erasing fills with blanks in the current background color.
+        cell = Cell(" ", Attr(bg=self._attr.bg))
+        for row in range(max(0, row0), min(self.rows, row1)):
+            line = self._grid[row]
+            for col in range(max(0, col0), min(self.cols, col1)):
+                line[col] = cell
+
+    def row_text(self, row: int) -> str:
+        return "".join(cell.char for cell in self._grid[row]).rstrip()
+
+    def text(self) -> str:
+        return "\n".join(self.row_text(row) for row in range(self.rows)).rstrip()
+
+    def find_cells(self, attr: Attr) -> list[tuple[int, int, str]]:
+        # Find the runs of non-blank text drawn with "attr". Returns a list of
+        # (row, col, text) tuples.
+        result = []
+        for row, line in enumerate(self._grid):
+            col = 0
+            while col < self.cols:
+                if line[col].attr != attr or line[col].char == " ":
+                    col += 1
+                    continue
+                end = col
+                while end < self.cols and line[end].attr == attr:
+                    end += 1
+                result.append(
+                    (row, col, "".join(c.char for c in line[col:end]).rstrip())
+                )
+                col = end
+        return result
+
+    def _field_at(self, row: int, col: int) -> str:
+        # The text starting at (row, col). Fields end at two consecutive
+        # blanks, which separate a menu entry from the help text next to it.
+        line = self.row_text(row)
+        if col > 0 and line[col - 1 : col].strip():
+            return ""
+        return line[col:].split("  ")[0].strip()
+
+    def menu(
+        self,
+        highlight: Attr,
+        *,
+        accept: Optional[typing.Callable[[str], bool]] = None,
+    ) -> Optional[Menu]:
+        # Detect a vertical menu, where the selected entry is drawn with
+        # "highlight". The other entries are the rows above and below that
+        # have text in the same column. With "accept", only highlighted text
+        # for which it returns True is considered to be a menu entry.
+        found = self.find_cells(highlight)
+        if accept is not None:
+            found = [f for f in found if accept(f[2])]
+        if len(found) != 1:
+            return None
+        cursor_row, col, _ = found[0]
+
+        first_row = cursor_row
+        while first_row > 0 and self._field_at(first_row - 1, col):
+            first_row -= 1
+        last_row = cursor_row
+        while last_row + 1 < self.rows and self._field_at(last_row + 1, col):
+            last_row += 1
+
+        rows = tuple(range(first_row, last_row + 1))
+        return Menu(
+            entries=tuple(self._field_at(row, col) for row in rows),
+            rows=rows,
+            col=col,
+            cursor=cursor_row - first_row,
+        )
+
+    def __str__(self) -> str:
+        return self.text()